@@ -1,12 +1,37 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from os import path, environ
 from dotenv import load_dotenv
+from sqlite3 import Connection as SQLiteConnection
+from app.assets import AssetPipeline
+from app.events import MessageEvents
+from app.hashing import PasswordHasher
+from app.instrumentation import QueryTimer
+from app.pool import PoolMonitor
+from app.replica import ReplicaRouter, RoutingSQLAlchemy
+
+# Create instance of the database; its sessions can read from a replica (see app/replica.py)
+db = RoutingSQLAlchemy()
+hasher = PasswordHasher()
+query_timer = QueryTimer()
+pool_monitor = PoolMonitor()
+replica_router = ReplicaRouter()
+assets = AssetPipeline()
+events = MessageEvents()
+
+
+# SQLite ignores foreign keys unless asked, which would leave rows behind that the
+# 'ondelete' cascades remove in PostgreSQL (ie timeline entries for a deleted message)
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """Turn on foreign key enforcement for SQLite connections."""
+
+    if isinstance(dbapi_connection, SQLiteConnection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
 
-# Create instance of the database
-db = SQLAlchemy()
-bcrypt = Bcrypt()
 
 # The argument refers to which .env file to use, ie test.env, dev.env
 # The default of .env is used for production on Heroku
@@ -26,8 +51,15 @@ def init_app(envFile=".env"):
     app = Flask(__name__)
     app.config.from_object(environ.get("CONFIG"))
 
-    # Initialize database
+    # Initialize database, with the engine options of the pool settings
+    pool_monitor.init_app(app)
     db.init_app(app)
+    replica_router.init_app(app)
+    hasher.init_app(app)
+    # before the blueprints, so its timing starts before their before_request handlers
+    query_timer.init_app(app)
+    assets.init_app(app)
+    events.init_app(app)
 
     """ 
     Use app_context to ensure functions within the block can access current_app, which
@@ -37,10 +69,16 @@ def init_app(envFile=".env"):
         from app.user import user_bp
         from app.message import message_bp
         from app.home import home_bp
+        from app.api import api_bp
+        from app.schema import schema_cli
 
         # Register blueprints. If needed, url_prefix param can be set to append a string (ie '/users') to the route url.
         app.register_blueprint(user_bp)
         app.register_blueprint(message_bp)
         app.register_blueprint(home_bp)
+        app.register_blueprint(api_bp)
+
+        # Register CLI command groups that aren't tied to a blueprint, ie 'flask schema upgrade'
+        app.cli.add_command(schema_cli)
 
         return app
@@ -0,0 +1,6 @@
+from flask import Blueprint
+
+api_bp = Blueprint("api", __name__, url_prefix="/api/v1")
+
+# These imports occur after blueprint creation to avoid circular imports
+from . import api_routes
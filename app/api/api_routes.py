@@ -0,0 +1,117 @@
+from flask import abort, g, request
+from werkzeug.exceptions import HTTPException
+from . import api_bp
+from app import db
+from app.api.api_util import json_response, message_page_payload, user_page_payload
+from app.eager import MESSAGE_COLUMNS, USER_COLUMNS
+from app.instrumentation import query_budget
+from app.models import Follows, Likes, Message, User
+from app.pagination import decode_cursor, paginate_messages, paginate_users
+from app.replica import use_replica
+from app.timeline import home_timeline
+
+
+def require_login():
+    """Abort with a 401 if nobody is logged in."""
+
+    if not g.user:
+        abort(401)
+
+
+def require_user(user_id):
+    """Abort with a 404 if there's no user with `user_id`."""
+
+    db.session.query(User.id).filter(User.id == user_id).first_or_404()
+
+
+# Registered on the app rather than the blueprint, so that requests for API paths
+# that match no route (404) or none of a route's methods (405) are covered too
+@api_bp.app_errorhandler(HTTPException)
+def handle_error(error):
+    """Report errors of API requests as JSON, rather than as HTML pages."""
+
+    if not request.path.startswith(api_bp.url_prefix):
+        return error
+
+    return json_response({"error": error.name}, error.code)
+
+
+@api_bp.route("/timeline")
+@query_budget(5)
+@use_replica
+def timeline():
+    """Get a page of the logged-in user's home timeline, before the optional 'before' cursor."""
+
+    require_login()
+
+    before = decode_cursor(request.args.get("before"))
+    page = home_timeline(g.user, before, columns=MESSAGE_COLUMNS)
+    return json_response(message_page_payload(page))
+
+
+@api_bp.route("/users/<int:user_id>/messages")
+@query_budget(5)
+@use_replica
+def user_messages(user_id):
+    """Get a page of a user's own messages, before the optional 'before' cursor."""
+
+    require_user(user_id)
+
+    before = decode_cursor(request.args.get("before"))
+    messages = db.session.query(*MESSAGE_COLUMNS).filter(Message.user_id == user_id)
+    page = paginate_messages(messages, before)
+    return json_response(message_page_payload(page))
+
+
+@api_bp.route("/users/<int:user_id>/likes")
+@query_budget(5)
+@use_replica
+def user_likes(user_id):
+    """Get a page of the messages a user has liked, before the optional 'before' cursor."""
+
+    require_user(user_id)
+
+    before = decode_cursor(request.args.get("before"))
+    liked_messages = (
+        db.session.query(*MESSAGE_COLUMNS)
+        .join(Likes, Likes.message_id == Message.id)
+        .filter(Likes.user_id == user_id)
+    )
+    page = paginate_messages(liked_messages, before)
+    return json_response(message_page_payload(page))
+
+
+@api_bp.route("/users/<int:user_id>/following")
+@query_budget(4)
+@use_replica
+def user_following(user_id):
+    """Get a page of the users a user follows, after the optional 'after' username."""
+
+    require_login()
+    require_user(user_id)
+
+    users = (
+        db.session.query(*USER_COLUMNS)
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == user_id)
+    )
+    page = paginate_users(users, request.args.get("after"))
+    return json_response(user_page_payload(page))
+
+
+@api_bp.route("/users/<int:user_id>/followers")
+@query_budget(4)
+@use_replica
+def user_followers(user_id):
+    """Get a page of a user's followers, after the optional 'after' username."""
+
+    require_login()
+    require_user(user_id)
+
+    users = (
+        db.session.query(*USER_COLUMNS)
+        .join(Follows, Follows.user_following_id == User.id)
+        .filter(Follows.user_being_followed_id == user_id)
+    )
+    page = paginate_users(users, request.args.get("after"))
+    return json_response(user_page_payload(page))
@@ -0,0 +1,65 @@
+"""Payloads of Warbler's JSON API.
+
+The API's queries select only the columns they return, so rows are never
+hydrated into ORM objects or tracked by the session. Pages of messages list
+each author once, beside the messages, rather than repeating them in every
+message:
+
+    {
+      "messages": [{"id": 7, "text": "...", "timestamp": "...", "user_id": 2,
+                    "like_count": 0}, ...],
+      "users": [{"id": 2, "username": "...", "image_url": "..."}, ...],
+      "liked": [7],
+      "next": "<cursor>"
+    }
+
+and are encoded with orjson, without whitespace.
+"""
+
+import orjson
+from flask import current_app
+from app import db
+from app.eager import AUTHOR_COLUMNS
+from app.models import User
+from app.user.user_util import following_ids, liked_ids
+
+
+def json_response(payload, status=200):
+    """Encode `payload` as a compact JSON response."""
+
+    return current_app.response_class(
+        orjson.dumps(payload), status=status, mimetype="application/json"
+    )
+
+
+def rows_payload(rows):
+    """Turn column-only rows into a list of dicts."""
+
+    return [row._asdict() for row in rows]
+
+
+def message_page_payload(page):
+    """Build the payload of a Page of message rows, with their authors."""
+
+    author_ids = {msg.user_id for msg in page.items}
+    authors = (
+        db.session.query(*AUTHOR_COLUMNS).filter(User.id.in_(author_ids)).all()
+        if author_ids
+        else []
+    )
+    return {
+        "messages": rows_payload(page.items),
+        "users": rows_payload(authors),
+        "liked": sorted(liked_ids(page.items)),
+        "next": page.next_cursor,
+    }
+
+
+def user_page_payload(page):
+    """Build the payload of a Page of user rows, with those the viewer follows."""
+
+    return {
+        "users": rows_payload(page.items),
+        "following": sorted(following_ids(page.items)),
+        "next": page.next_cursor,
+    }
@@ -0,0 +1,242 @@
+"""Fingerprinted static assets for Warbler.
+
+Every file in app/static is copied into ASSETS_DIR under a name including a
+hash of its contents (ie stylesheets/style.3f2a1b9c0d4e.css), and served from
+/assets/ with a year-long, `immutable` Cache-Control. A changed file gets a new
+URL, so browsers never need to revalidate the old one. Compressible files (ie
+stylesheets) also get precomputed gzip variants, and brotli ones if the brotli
+package is installed, which are sent to browsers that accept them.
+
+Templates link to assets with asset_url('stylesheets/style.css'). The /static/
+URLs inside stylesheets are rewritten to their fingerprinted ones too, so a
+stylesheet's hash changes along with the images it uses.
+
+The assets are built by 'flask assets build', and when the app starts if they
+haven't been built yet (or on every start, with ASSETS_REBUILD). Files missing
+from the build are still linked to, and served from, /static/.
+"""
+
+import gzip
+import json
+import re
+from hashlib import sha256
+from mimetypes import guess_type
+from os import makedirs, path, replace, walk
+from tempfile import NamedTemporaryFile
+import click
+from flask import abort, current_app, request, send_from_directory, url_for
+from flask.cli import AppGroup
+
+try:
+    import brotli
+except ImportError:  # optional; without it, only gzip variants are built
+    brotli = None
+
+ASSETS_URL = "/assets"
+MANIFEST_FILE = "manifest.json"
+FINGERPRINT_LENGTH = 12
+# A year, the longest max-age browsers honour
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+# Other formats (ie images) are already compressed
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".ico", ".txt", ".json"}
+# Precomputed encodings and their file suffixes, best first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+STATIC_URL = re.compile(r"""url\((["']?)/static/([^"')]+)\1\)""")
+
+
+class Manifest:
+    """The fingerprinted name of each built asset, and its precomputed encodings."""
+
+    def __init__(self, assets=None, encodings=None):
+        self.assets = assets or {}
+        self.encodings = encodings or {}
+        self.built = set(self.assets.values())
+        # changes whenever any asset does, ie for the ETags of pages linking to them
+        self.version = sha256(self.to_json().encode("UTF-8")).hexdigest()[
+            :FINGERPRINT_LENGTH
+        ]
+
+    def to_json(self):
+        return json.dumps(
+            {"assets": self.assets, "encodings": self.encodings}, indent=2
+        )
+
+
+def fingerprinted(name, content):
+    """Add a hash of `content` to a file name, ie style.css -> style.3f2a1b9c0d4e.css."""
+
+    root, extension = path.splitext(name)
+    return f"{root}.{sha256(content).hexdigest()[:FINGERPRINT_LENGTH]}{extension}"
+
+
+def compress(content):
+    """Get the precomputed {encoding: bytes} variants of `content` that are smaller than it."""
+
+    variants = {"gzip": gzip.compress(content, 9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(content, quality=11)
+
+    return {
+        encoding: data
+        for encoding, data in variants.items()
+        if len(data) < len(content)
+    }
+
+
+def rewrite_urls(css, assets):
+    """Point the /static/ URLs in a stylesheet at the already built `assets`."""
+
+    def fingerprinted_url(match):
+        quote, name = match.groups()
+        if name not in assets:
+            return match.group(0)
+        return f"url({quote}{ASSETS_URL}/{assets[name]}{quote})"
+
+    return STATIC_URL.sub(fingerprinted_url, css.decode("UTF-8")).encode("UTF-8")
+
+
+def write_file(file_path, content):
+    """Write a file in one step, so other workers never serve it half written."""
+
+    directory = path.dirname(file_path)
+    makedirs(directory, exist_ok=True)
+    with NamedTemporaryFile(dir=directory, delete=False) as file:
+        file.write(content)
+    replace(file.name, file_path)
+
+
+def static_files(static_folder):
+    """Yield the '/' separated path of every file in `static_folder`."""
+
+    for directory, _, names in walk(static_folder):
+        for name in names:
+            file_path = path.relpath(path.join(directory, name), static_folder)
+            yield file_path.replace(path.sep, "/")
+
+
+def build(static_folder, assets_dir):
+    """Fingerprint and compress every static file into `assets_dir`, returning the Manifest."""
+
+    # stylesheets last, so the files they use already have their fingerprinted names
+    names = sorted(
+        static_files(static_folder), key=lambda name: (name.endswith(".css"), name)
+    )
+
+    assets, encodings = {}, {}
+    for name in names:
+        with open(path.join(static_folder, name), "rb") as file:
+            content = file.read()
+        if name.endswith(".css"):
+            content = rewrite_urls(content, assets)
+
+        built = fingerprinted(name, content)
+        write_file(path.join(assets_dir, built), content)
+        assets[name] = built
+
+        if path.splitext(name)[1] in COMPRESSIBLE_EXTENSIONS:
+            variants = compress(content)
+            for encoding, suffix in ENCODINGS:
+                if encoding in variants:
+                    write_file(
+                        path.join(assets_dir, built + suffix), variants[encoding]
+                    )
+            encodings[built] = [
+                encoding for encoding, _ in ENCODINGS if encoding in variants
+            ]
+
+    manifest = Manifest(assets, encodings)
+    write_file(path.join(assets_dir, MANIFEST_FILE), manifest.to_json().encode("UTF-8"))
+    return manifest
+
+
+def load_manifest(assets_dir):
+    """Load the Manifest of the assets built in `assets_dir`, or None if there isn't one."""
+
+    try:
+        with open(path.join(assets_dir, MANIFEST_FILE)) as file:
+            return Manifest(**json.load(file))
+    except FileNotFoundError:
+        return None
+
+
+def asset_url(filename):
+    """Get the fingerprinted URL of a static file, or its /static/ URL if it isn't built."""
+
+    built = current_app.extensions["asset_manifest"].assets.get(filename)
+    if built is None:
+        return url_for("static", filename=filename)
+
+    return url_for("assets", filename=built)
+
+
+def send_asset(filename):
+    """Serve a built asset, precompressed if the browser accepts one of its encodings."""
+
+    manifest = current_app.extensions["asset_manifest"]
+    if filename not in manifest.built:
+        abort(404)
+
+    available = manifest.encodings.get(filename, [])
+    encoding, suffix = next(
+        (
+            (encoding, suffix)
+            for encoding, suffix in ENCODINGS
+            if encoding in available and request.accept_encodings[encoding]
+        ),
+        (None, ""),
+    )
+
+    response = send_from_directory(
+        current_app.config["ASSETS_DIR"],
+        filename + suffix,
+        # typed as the file it encodes, rather than as ie a .gz archive
+        mimetype=guess_type(filename)[0] or "application/octet-stream",
+        max_age=ASSET_MAX_AGE,
+    )
+    response.cache_control.immutable = True
+    if encoding:
+        response.content_encoding = encoding
+    if available:
+        response.vary.add("Accept-Encoding")
+
+    return response
+
+
+class AssetPipeline:
+    """Flask extension serving fingerprinted, precompressed static assets."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Serve the assets of `app`, building them first if they need to be."""
+
+        app.extensions["assets"] = self
+        app.cli.add_command(assets_cli)
+        app.add_url_rule(f"{ASSETS_URL}/<path:filename>", "assets", send_asset)
+        app.add_template_global(asset_url)
+
+        assets_dir = app.config["ASSETS_DIR"]
+        manifest = None if app.config["ASSETS_REBUILD"] else load_manifest(assets_dir)
+        if manifest is None:
+            try:
+                manifest = build(app.static_folder, assets_dir)
+            except OSError as e:
+                # ie a read-only filesystem; every file is served from /static/ instead
+                app.logger.warning("Could not build the static assets: %s", e)
+                manifest = Manifest()
+
+        app.extensions["asset_manifest"] = manifest
+
+
+assets_cli = AppGroup("assets", help="Build the fingerprinted static assets.")
+
+
+@assets_cli.command("build")
+def build_command():
+    """Fingerprint and compress the static files into ASSETS_DIR."""
+
+    manifest = build(current_app.static_folder, current_app.config["ASSETS_DIR"])
+    current_app.extensions["asset_manifest"] = manifest
+    click.echo(f"Built {len(manifest.assets)} assets.")
@@ -0,0 +1,39 @@
+"""Conditional GETs for Warbler's pages.
+
+Pages showing a single message or user are tagged with a strong ETag, built
+from the version stamps of everything they show: the message's version, the
+updated_at of the users shown and of the logged-in user (whose likes and
+follows change the page's buttons), and the version of the built assets the
+page links to. The stamps are read with one indexed lookup before anything
+else is queried or rendered, so a browser that already has the current page
+gets a 304 Not Modified without it being built again.
+"""
+
+from hashlib import sha256
+from flask import current_app, g, make_response, request, session
+
+
+def page_etag(*stamps):
+    """Build an ETag for a page from the version stamps of the rows it shows."""
+
+    viewer = (g.user.id, g.user.updated_at) if g.user else None
+    parts = (*stamps, viewer, current_app.extensions["asset_manifest"].version)
+    return sha256(repr(parts).encode("UTF-8")).hexdigest()[:32]
+
+
+def render_if_modified(etag, render):
+    """Respond 304 if the browser already has the page tagged `etag`, or else render() it.
+
+    Pages with flashed messages aren't tagged, since those are only shown once.
+    """
+
+    if "_flashes" in session:
+        return render()
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+    return response
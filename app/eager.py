@@ -0,0 +1,43 @@
+"""Named loader profiles for the rows Warbler's pages render.
+
+Relationships are lazy loaded by default, so a feed template touching
+`msg.user.username` for every card would run a SELECT per author. Instead, the
+routes apply one of these profiles to their queries, ie
+
+    Message.query.options(*MESSAGE_CARD)
+
+so each page renders in the same number of queries however many rows it shows.
+
+Each profile also only loads the columns its cards show (load_only). Any other
+column is loaded with a query of its own when first accessed, so a profile must
+be widened whenever a template starts showing more of its rows.
+"""
+
+from sqlalchemy.orm import joinedload, load_only
+from app.models import Message, User
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.user_id,
+    Message.like_count,
+)
+
+# A message's author shows as a username and avatar
+AUTHOR_COLUMNS = (User.id, User.username, User.image_url)
+
+# Messages shown with their author, ie on the homepage, likes page and search
+# results; messages always have an author, so they're joined with an inner join
+MESSAGE_CARD = (
+    load_only(*MESSAGE_COLUMNS),
+    joinedload(Message.user, innerjoin=True).load_only(*AUTHOR_COLUMNS),
+)
+
+# Messages shown on their author's own profile, which already has the author
+PROFILE_MESSAGE_CARD = (load_only(*MESSAGE_COLUMNS),)
+
+# Users shown as cards, ie in the user directory and following/followers lists
+USER_COLUMNS = (User.id, User.username, User.image_url, User.header_image_url, User.bio)
+
+USER_CARD = (load_only(*USER_COLUMNS),)
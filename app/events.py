@@ -0,0 +1,227 @@
+"""Server-Sent Events of new messages for Warbler.
+
+A logged-in browser opens GET /messages/stream (an EventSource) and is sent the
+id of every message posted by a user it follows, or by itself, as soon as it's
+committed:
+
+    id: 42
+    event: message
+    data: 42
+
+so the page can fetch just the new messages (ie from /api/v1/timeline) rather
+than being reloaded. A comment is sent every EVENTS_HEARTBEAT_SECONDS to keep
+proxies from closing an idle stream, and each stream ends after
+EVENTS_STREAM_SECONDS, when the browser reconnects by itself; that also picks
+up any follows made since it connected.
+
+Each worker delivers events to its own streams through an in-process Broker.
+Messages posted to other workers reach it through the EVENTS_BACKEND:
+
+- 'local' delivers only within the posting worker, ie for a single worker, or
+  in development and the tests
+- 'postgres' sends every event with PostgreSQL NOTIFY, which each worker
+  LISTENs for on a connection of its own
+
+Further backends (ie Redis pub/sub) only need a publish() and a start().
+
+An open stream holds no database connection, but it does hold a sync worker
+for as long as it's open; see gunicorn.conf.py for the async worker mode that
+lets each worker keep thousands of them.
+"""
+
+import os
+import select
+from collections import defaultdict
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy import select as select_sql
+
+NOTIFY_CHANNEL = "warbler_messages"
+# Milliseconds a browser waits before reconnecting to a stream that has ended
+RETRY_MS = 3000
+
+
+class Subscription:
+    """One stream's queue of new message ids, from the authors it follows."""
+
+    def __init__(self, author_ids, queue_size):
+        self.author_ids = frozenset(author_ids)
+        self.queue = Queue(queue_size)
+
+    def put(self, message_id):
+        try:
+            self.queue.put_nowait(message_id)
+        except Full:
+            # a stream that has stopped reading misses ids, rather than holding them all
+            pass
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds for a message id, or return None."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class Broker:
+    """In-process pub/sub, delivering each new message to the streams following its author."""
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscriptions = defaultdict(set)
+        self._lock = Lock()
+
+    def subscribe(self, author_ids):
+        subscription = Subscription(author_ids, self.queue_size)
+        with self._lock:
+            for author_id in subscription.author_ids:
+                self._subscriptions[author_id].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for author_id in subscription.author_ids:
+                subscriptions = self._subscriptions.get(author_id)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self._subscriptions[author_id]
+
+    def deliver(self, author_id, message_id):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(author_id, ()))
+
+        for subscription in subscriptions:
+            subscription.put(message_id)
+
+    def subscription_count(self):
+        with self._lock:
+            return len(set().union(*self._subscriptions.values()))
+
+
+class LocalBackend:
+    """Deliver events to the streams of the posting worker only."""
+
+    def __init__(self, broker, app):
+        self.broker = broker
+
+    def start(self):
+        pass
+
+    def publish(self, author_id, message_id):
+        self.broker.deliver(author_id, message_id)
+
+
+class PostgresBackend:
+    """Deliver events to the streams of every worker, with PostgreSQL NOTIFY and LISTEN."""
+
+    # seconds between checks that the listening connection is still open
+    POLL_SECONDS = 5
+
+    def __init__(self, broker, app):
+        self.broker = broker
+        self.app = app
+        self._pid = None
+        self._lock = Lock()
+
+    def engine(self):
+        return self.app.extensions["sqlalchemy"].db.get_engine(self.app)
+
+    def start(self):
+        """Start listening in this process, unless it already is.
+
+        Workers are forked from the process that created the app, so each one
+        starts its own listener when its first stream opens.
+        """
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                Thread(target=self.listen, daemon=True).start()
+
+    def publish(self, author_id, message_id):
+        with self.engine().begin() as conn:
+            conn.execute(
+                select_sql(func.pg_notify(NOTIFY_CHANNEL, f"{author_id}:{message_id}"))
+            )
+
+    def listen(self):
+        """Deliver every notification to this worker's streams, reconnecting after errors."""
+
+        while True:
+            try:
+                self.listen_once()
+            except Exception:
+                self.app.logger.exception("Lost the %s listener", NOTIFY_CHANNEL)
+                sleep(self.POLL_SECONDS)
+
+    def listen_once(self):
+        # detached, so the listening connection doesn't take up a place in the pool
+        connection = self.engine().raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        try:
+            dbapi_connection.autocommit = True
+            dbapi_connection.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+            while True:
+                select.select([dbapi_connection], [], [], self.POLL_SECONDS)
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    author_id, message_id = notify.payload.split(":")
+                    self.broker.deliver(int(author_id), int(message_id))
+        finally:
+            connection.close()
+
+
+BACKENDS = {"local": LocalBackend, "postgres": PostgresBackend}
+
+
+def event_stream(events, author_ids, heartbeat, duration):
+    """Yield the Server-Sent Events of the new messages of `author_ids` for `duration` seconds."""
+
+    subscription = events.subscribe(author_ids)
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+
+        deadline = monotonic() + duration
+        remaining = duration
+        while remaining > 0:
+            message_id = subscription.get(min(heartbeat, remaining))
+            if message_id is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"id: {message_id}\nevent: message\ndata: {message_id}\n\n"
+            remaining = deadline - monotonic()
+    finally:
+        events.broker.unsubscribe(subscription)
+
+
+def publish_message(author_id, message_id):
+    """Send a newly committed message's id to the streams following its author."""
+
+    current_app.extensions["events"].backend.publish(author_id, message_id)
+
+
+class MessageEvents:
+    """Flask extension delivering new messages to Server-Sent Event streams."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Set up the broker of `app`, and the EVENTS_BACKEND reaching other workers."""
+
+        self.broker = Broker(app.config["EVENTS_QUEUE_SIZE"])
+        self.backend = BACKENDS[app.config["EVENTS_BACKEND"]](self.broker, app)
+        app.extensions["events"] = self
+
+    def subscribe(self, author_ids):
+        self.backend.start()
+        return self.broker.subscribe(author_ids)
@@ -0,0 +1,230 @@
+"""Full-text search over message text.
+
+On PostgreSQL, messages have a `search_vector` tsvector column with a GIN index
+(ix_messages_search_vector), which a trigger keeps up to date as messages are
+added or edited. (A generated column would do the same, but adding one to an
+existing table rewrites the whole table under an exclusive lock.) On SQLite, an
+FTS5 table (messages_fts) holds a copy of each message's text under the
+message's id instead. It is updated as messages are posted and deleted (see
+index_message and unindex_messages), and can be rebuilt from the messages table
+with 'flask message reindex', ie after messages are loaded some other way.
+
+Results are ranked by relevance, best first, and paginated with a '?after='
+cursor encoding the (rank, id) of the last result shown.
+"""
+
+import re
+from sqlalchemy import DDL, Float, cast, delete, event, func, insert, select, text
+from sqlalchemy.sql import column, literal_column, table
+from app import db
+from app.models import Message
+from app.pagination import (
+    Page,
+    before_position,
+    decode_position,
+    encode_position,
+    per_page,
+)
+
+# Text search configuration used to stem and drop stop words, on PostgreSQL
+SEARCH_CONFIG = "english"
+
+# Messages whose search_vector is filled per transaction, when adding the column
+BACKFILL_BATCH_SIZE = 10000
+
+# Nullable and without a default, so adding it doesn't rewrite the table
+POSTGRES_COLUMN_DDL = (
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector"
+)
+POSTGRES_TRIGGER_DDL = [
+    "DROP TRIGGER IF EXISTS messages_search_vector_update ON messages",
+    "CREATE TRIGGER messages_search_vector_update "
+    "BEFORE INSERT OR UPDATE OF text ON messages FOR EACH ROW "
+    "EXECUTE PROCEDURE tsvector_update_trigger"
+    f"(search_vector, 'pg_catalog.{SEARCH_CONFIG}', text)",
+]
+POSTGRES_INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_messages_search_vector "
+    "ON messages USING gin (search_vector)"
+)
+POSTGRES_DDL = [POSTGRES_COLUMN_DDL, *POSTGRES_TRIGGER_DDL, POSTGRES_INDEX_DDL]
+
+SQLITE_DDL = "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, tokenize='porter')"
+
+messages_fts = table("messages_fts", column("rowid"), column("text"))
+
+for statement in POSTGRES_DDL:
+    event.listen(
+        Message.__table__,
+        "after_create",
+        DDL(statement).execute_if(dialect="postgresql"),
+    )
+event.listen(
+    Message.__table__, "after_create", DDL(SQLITE_DDL).execute_if(dialect="sqlite")
+)
+event.listen(
+    Message.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect="sqlite"),
+)
+
+
+def create_message_search(connection):
+    """Migration step adding the searchable text of the connection's database.
+
+    On PostgreSQL, the search_vector column and its trigger are added, and the
+    existing messages filled in a batch at a time; it must run as an 'online'
+    migration, so each batch is committed as it's done. Its index is built by
+    index_message_search. On SQLite, the FTS5 table is created and filled.
+    """
+
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(POSTGRES_COLUMN_DDL)
+        for statement in POSTGRES_TRIGGER_DDL:
+            connection.exec_driver_sql(statement)
+        backfill_search_vectors(connection)
+
+    elif connection.dialect.name == "sqlite":
+        connection.exec_driver_sql(SQLITE_DDL)
+        rebuild(connection)
+
+
+def backfill_search_vectors(connection, batch_size=BACKFILL_BATCH_SIZE):
+    """Fill the search_vector of existing messages, by ranges of `batch_size` ids."""
+
+    last_id = connection.execute(select(func.max(Message.id))).scalar() or 0
+    backfill = text(
+        "UPDATE messages SET search_vector = to_tsvector(:config, text) "
+        "WHERE id >= :start AND id < :end AND search_vector IS NULL"
+    )
+    for start in range(0, last_id + 1, batch_size):
+        connection.execute(
+            backfill,
+            {"config": SEARCH_CONFIG, "start": start, "end": start + batch_size},
+        )
+
+
+def index_message_search(connection):
+    """Migration step building the GIN index of search_vector, on PostgreSQL.
+
+    The index is built concurrently, so this must run as an 'online' migration.
+    """
+
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(
+            POSTGRES_INDEX_DDL.replace("INDEX", "INDEX CONCURRENTLY", 1)
+        )
+
+
+def uses_fts5():
+    """Is message text indexed by the SQLite FTS5 table, rather than by PostgreSQL?"""
+
+    return db.engine.dialect.name == "sqlite"
+
+
+def rebuild(connection=None):
+    """Rebuild the FTS5 index from the messages table, on SQLite."""
+
+    connection = connection or db.session
+    connection.execute(delete(messages_fts))
+    connection.execute(
+        insert(messages_fts).from_select(
+            ["rowid", "text"], select(Message.id, Message.text)
+        )
+    )
+
+
+def index_message(msg):
+    """Add a newly posted message to the search index.
+
+    The message must have been flushed, so that its id is set.
+    """
+
+    if uses_fts5():
+        # replaces any stale entry left under the id by messages deleted some other way
+        db.session.execute(
+            insert(messages_fts)
+            .prefix_with("OR REPLACE")
+            .values(rowid=msg.id, text=msg.text)
+        )
+
+
+def unindex_messages(condition):
+    """Remove the messages matching `condition` from the search index.
+
+    Must be called before the messages themselves are deleted, while
+    `condition` still matches them.
+    """
+
+    if uses_fts5():
+        deleted = select(Message.id).where(condition)
+        db.session.execute(
+            delete(messages_fts).where(messages_fts.c.rowid.in_(deleted))
+        )
+
+
+def fts5_query(text):
+    """Build an FTS5 query matching every word of `text`.
+
+    Each word is quoted, so FTS5 operators and punctuation in the text are
+    searched for rather than interpreted.
+    """
+
+    return " ".join(f'"{word}"' for word in re.findall(r"\w+", text))
+
+
+def ranked_matches(text):
+    """Build a query of (Message, rank) for messages matching `text`, higher ranks better."""
+
+    if uses_fts5():
+        # bm25 scores better matches lower, so they're negated to rank them higher
+        matches = (
+            select(
+                messages_fts.c.rowid.label("id"),
+                (-func.bm25(literal_column("messages_fts"))).label("rank"),
+            )
+            .where(literal_column("messages_fts").op("MATCH")(fts5_query(text)))
+            .subquery()
+        )
+        query = db.session.query(Message, matches.c.rank).join(
+            matches, matches.c.id == Message.id
+        )
+        return query, matches.c.rank
+
+    search_vector = literal_column("messages.search_vector")
+    tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, text)
+    # compared as double precision, so a rank read from a cursor matches exactly
+    rank = cast(func.ts_rank(search_vector, tsquery), Float(53))
+    query = db.session.query(Message, rank).filter(search_vector.op("@@")(tsquery))
+    return query, rank
+
+
+def decode_search_cursor(cursor):
+    """Decode a search cursor into a (rank, id) position, or None if not given."""
+
+    return decode_position(cursor, float, int)
+
+
+def search_messages(text, after=None, page_size=None, options=()):
+    """Get a page of the messages matching `text`, best first.
+
+    `after` is a (rank, id) position from decode_search_cursor; the messages are
+    loaded with the loader `options` (see app/eager.py).
+    """
+
+    page_size = page_size or per_page()
+    if not re.search(r"\w", text):
+        return Page([], None)
+
+    query, rank = ranked_matches(text)
+    query = query.options(*options)
+    if after:
+        query = query.filter(before_position(rank, Message.id, after))
+
+    rows = query.order_by(rank.desc(), Message.id.desc()).limit(page_size + 1).all()
+    if len(rows) <= page_size:
+        return Page([msg for msg, _ in rows], None)
+
+    rows = rows[:page_size]
+    last_msg, last_rank = rows[-1]
+    return Page([msg for msg, _ in rows], encode_position(last_rank, last_msg.id))
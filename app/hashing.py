@@ -0,0 +1,222 @@
+"""Password hashing for Warbler, run outside of the request thread.
+
+bcrypt is deliberately slow, so hashing a password inline holds a web worker for
+the whole hash. Instead, hashes are computed by a small per-process pool of
+worker processes (HASHING_WORKERS). At most HASHING_MAX_PENDING hashes may be
+queued or running at once; past that, HashingBusy is raised immediately rather
+than making the request wait, so a burst of logins can't starve cheap page views.
+
+The pool and its limit are per web worker, so they only help when a worker
+serves many requests at once, ie with the gevent workers of GUNICORN_ASYNC (see
+gunicorn.conf.py) or threads. A sync worker serves one request at a time and
+waits for its hash either way, so it would never have more than one pending;
+there the pool only adds the cost of sending each hash to another process. It's
+therefore only used by default with GUNICORN_ASYNC, and otherwise
+HASHING_WORKERS is 0, which hashes inline (as do the tests).
+
+The bcrypt cost (BCRYPT_LOG_ROUNDS) is calibrated once per deployment hardware
+with 'flask bcrypt calibrate', which finds the cost whose hash takes about
+BCRYPT_TARGET_MS, and then pinned by setting the BCRYPT_LOG_ROUNDS environment
+variable. It's never calibrated as the app starts: that would time hashes in
+every worker and command, and workers could settle on different costs. Stored
+hashes made with a lower cost are rehashed when their owner next logs in (see
+User.authenticate); stronger ones are kept.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from os import cpu_count, getpid
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+import click
+from flask import current_app
+from flask.cli import AppGroup
+import bcrypt
+
+# bcrypt's own limits on the cost
+MIN_LOG_ROUNDS = 4
+MAX_LOG_ROUNDS = 31
+
+
+class HashingBusy(Exception):
+    """Raised when too many password hashes are already pending."""
+
+
+def hash_password(password, rounds, prefix):
+    """Hash `password` with bcrypt; runs in a pool worker."""
+
+    salt = bcrypt.gensalt(rounds=rounds, prefix=prefix.encode("UTF-8"))
+    return bcrypt.hashpw(password.encode("UTF-8"), salt).decode("UTF-8")
+
+
+def check_password(pw_hash, password):
+    """Check `password` against a bcrypt hash; runs in a pool worker."""
+
+    return bcrypt.checkpw(password.encode("UTF-8"), pw_hash.encode("UTF-8"))
+
+
+def hash_rounds(pw_hash):
+    """Get the cost a bcrypt hash was made with, from its '$2b$12$...' prefix."""
+
+    try:
+        return int(pw_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def time_hash(rounds, prefix="2b"):
+    """Time a single bcrypt hash at `rounds`, in milliseconds."""
+
+    start = perf_counter()
+    hash_password("calibration password", rounds, prefix)
+    return (perf_counter() - start) * 1000
+
+
+def calibrate_rounds(target_ms, min_rounds=MIN_LOG_ROUNDS, prefix="2b"):
+    """Find the highest bcrypt cost whose hash takes no longer than `target_ms`.
+
+    Each extra round doubles the time taken, so costs are timed upwards from
+    `min_rounds` until one is over the target. `min_rounds` is returned if even
+    that is too slow, so the cost never drops below a configured floor.
+    """
+
+    rounds = min_rounds
+    while rounds < MAX_LOG_ROUNDS and time_hash(rounds + 1, prefix) <= target_ms:
+        rounds += 1
+
+    return rounds
+
+
+class PasswordHasher:
+    """Flask extension hashing and checking passwords in a bounded process pool."""
+
+    def __init__(self, app=None):
+        self._pool = None
+        self._pool_pid = None
+        self._pending = None
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the extension on `app`; its settings are read from app.config."""
+
+        app.extensions["password_hasher"] = self
+        app.cli.add_command(bcrypt_cli)
+
+    def generate_password_hash(self, password):
+        """Hash `password` with the configured bcrypt cost."""
+
+        config = current_app.config
+        return self._run(
+            hash_password,
+            password,
+            config["BCRYPT_LOG_ROUNDS"],
+            config["BCRYPT_HASH_PREFIX"],
+        )
+
+    def check_password_hash(self, pw_hash, password):
+        """Does `password` match the bcrypt hash `pw_hash`?"""
+
+        return self._run(check_password, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a lower cost than the current BCRYPT_LOG_ROUNDS?"""
+
+        rounds = hash_rounds(pw_hash)
+        return rounds is None or rounds < current_app.config["BCRYPT_LOG_ROUNDS"]
+
+    def shutdown(self):
+        """Stop this process' pool, if it was started."""
+
+        with self._lock:
+            if self._pool is not None and self._pool_pid == getpid():
+                self._pool.shutdown()
+            self._pool = None
+
+    def _run(self, func, *args):
+        """Run `func` in the pool, or inline if the pool is disabled.
+
+        Raises HashingBusy if the pool already has HASHING_MAX_PENDING hashes,
+        or if the hash doesn't finish within HASHING_TIMEOUT seconds.
+        """
+
+        config = current_app.config
+        if not config["HASHING_WORKERS"]:
+            return func(*args)
+
+        pool, pending = self._get_pool(config)
+        if not pending.acquire(blocking=False):
+            raise HashingBusy()
+
+        try:
+            future = pool.submit(func, *args)
+        except Exception:
+            pending.release()
+            raise
+
+        # Released once the hash finishes, even if this request stops waiting for it
+        future.add_done_callback(lambda _: pending.release())
+        try:
+            return future.result(timeout=config["HASHING_TIMEOUT"])
+        except TimeoutError:
+            raise HashingBusy()
+
+    def _get_pool(self, config):
+        """Get this process' pool, starting it on first use.
+
+        Web servers such as gunicorn fork their workers after the app is
+        created, so each process must start its own pool.
+        """
+
+        with self._lock:
+            if self._pool is None or self._pool_pid != getpid():
+                self._pool = ProcessPoolExecutor(max_workers=config["HASHING_WORKERS"])
+                self._pool_pid = getpid()
+                self._pending = BoundedSemaphore(config["HASHING_MAX_PENDING"])
+
+            return self._pool, self._pending
+
+
+bcrypt_cli = AppGroup("bcrypt", help="Measure and tune password hashing.")
+
+
+@bcrypt_cli.command("benchmark")
+@click.option(
+    "--rounds", type=int, help="bcrypt cost to test (default: BCRYPT_LOG_ROUNDS)"
+)
+@click.option("--seconds", default=3.0, help="How long to hash for.")
+def benchmark_command(rounds, seconds):
+    """Report how many password hashes per second one core can make."""
+
+    config = current_app.config
+    rounds = rounds or config["BCRYPT_LOG_ROUNDS"]
+
+    count = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        hash_password("benchmark password", rounds, config["BCRYPT_HASH_PREFIX"])
+        count += 1
+    per_core = count / (perf_counter() - start)
+
+    click.echo(f"Cost {rounds}: {per_core:.2f} hashes/s per core")
+    click.echo(f"{1000 / per_core:.1f} ms per hash")
+    click.echo(f"~{per_core * cpu_count():.2f} hashes/s across {cpu_count()} cores")
+
+
+@bcrypt_cli.command("calibrate")
+@click.option(
+    "--target-ms", type=float, help="Time per hash (default: BCRYPT_TARGET_MS)"
+)
+def calibrate_command(target_ms):
+    """Report the bcrypt cost that best meets a per-hash time target, to pin in BCRYPT_LOG_ROUNDS."""
+
+    config = current_app.config
+    target_ms = target_ms or config["BCRYPT_TARGET_MS"] or 250
+    rounds = calibrate_rounds(
+        target_ms, config["BCRYPT_MIN_ROUNDS"], config["BCRYPT_HASH_PREFIX"]
+    )
+    click.echo(
+        f"Cost {rounds} takes {time_hash(rounds):.1f} ms (target {target_ms} ms)"
+    )
+    click.echo(f"Pin it with BCRYPT_LOG_ROUNDS={rounds}")
@@ -1,47 +1,81 @@
-from flask import render_template, g
+import click
+from flask import render_template, request, g, session
 from . import home_bp
-from app.models import Message
+from app import db
+from app.eager import MESSAGE_CARD
+from app.instrumentation import query_budget
+from app.models import User
+from app.replica import use_replica
+from app.pagination import decode_cursor
+from app.timeline import home_timeline, mark_merged_authors, rebuild_timelines
+from app.user.user_util import CURR_USER_KEY, liked_ids
 
 
 @home_bp.route("/")
+@query_budget(6)
+@use_replica
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: a page of the most recent messages of followed_users,
+      starting before the optional 'before' cursor in the querystring
     """
     if g.get("user", None):
-        following_ids = [user.id for user in g.user.following]
-        messages = (
-            Message.query.filter(
-                (Message.user_id.in_(following_ids)) | (Message.user_id == g.user.id)
-            )
-            .order_by(Message.timestamp.desc())
-            .limit(100)
-            .all()
+        before = decode_cursor(request.args.get("before"))
+        page = home_timeline(g.user, before, options=MESSAGE_CARD)
+        liked_msg_ids = liked_ids(page.items)
+        return render_template(
+            "home/home.html",
+            messages=page.items,
+            next_cursor=page.next_cursor,
+            likes=liked_msg_ids,
         )
-        liked_msg_ids = [message.id for message in g.user.likes]
-        return render_template("home/home.html", messages=messages, likes=liked_msg_ids)
 
     else:
         return render_template("home/home-anon.html")
 
 
+@home_bp.cli.command("rebuild-timelines")
+@click.option("--chunk-size", default=1000, help="Users to rebuild per transaction.")
+def rebuild_timelines_command(chunk_size):
+    """Rebuild the materialized home timelines from follows and messages."""
+
+    mark_merged_authors(db.session)
+    db.session.commit()
+    for first_id, last_id in User.id_ranges(chunk_size):
+        rebuild_timelines((first_id, last_id))
+        db.session.commit()
+        click.echo(f"Rebuilt timelines up to user #{last_id}")
+
+    click.echo("Timelines rebuilt.")
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Turn off caching of logged-in users' pages, which show their own data and
+# shouldn't be kept by a shared cache or in the browser's history.
+#
+# Pages with an ETag (see app/caching.py) may be kept, as long as they're
+# revalidated on every use. Other responses keep their own caching headers; ie
+# fingerprinted assets are cached for a year (see app/assets.py).
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
 # Changed to after_app_request from after_request to occur after requests from other blueprints
 @home_bp.after_app_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to pages for a logged-in user."""
+
+    if req.mimetype != "text/html":
+        return req
 
-    req.headers[
-        "Cache-Control"
-    ] = "no-cache, no-store, must-revalidate, public, max-age=0"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
+    logged_in = CURR_USER_KEY in session
+    if req.get_etag()[0]:
+        req.headers["Cache-Control"] = "private, no-cache" if logged_in else "no-cache"
+    elif logged_in:
+        req.headers[
+            "Cache-Control"
+        ] = "no-cache, no-store, must-revalidate, private, max-age=0"
+        req.headers["Pragma"] = "no-cache"
+        req.headers["Expires"] = "0"
     return req
@@ -0,0 +1,196 @@
+"""Per-request SQL instrumentation for Warbler.
+
+When SQL_TIMING is set, every query run while handling a request is counted
+and timed through SQLAlchemy's engine events. The totals are sent back in a
+Server-Timing header (shown in the browser's developer tools), ie
+
+    Server-Timing: db;dur=12.31;desc="7 queries", app;dur=40.52
+
+and logged with the request's endpoint as structured fields (sql_queries,
+sql_ms, total_ms). With SQL_TIMING unset no events are listened for, so it
+costs nothing.
+
+Time spent waiting for a connection from the pool, when it's recorded (see
+app/pool.py), is added as a 'pool' entry.
+
+The totals of a streamed response (ie /users) only cover the queries run
+before its body starts streaming.
+
+Views can also declare a query budget with @query_budget(n): the most queries
+a request to them should need, however much data they show. A view that goes
+over its budget (ie by lazy loading a relationship for every row it shows) is
+reported according to QUERY_BUDGET_ACTION; 'warn' logs a warning (ie in
+development), and 'raise' raises QueryBudgetExceeded (ie to fail the tests).
+Budgets are only checked while SQL_TIMING is on.
+"""
+
+from functools import partial
+from threading import Lock
+from time import perf_counter
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when a view runs more queries than its declared budget."""
+
+
+def query_budget(max_queries):
+    """Declare the most queries a request to the decorated view should run."""
+
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+
+    return decorator
+
+
+def check_budget(stats, budget, endpoint, action, logger):
+    """Report a request whose queries went over its view's budget."""
+
+    if stats.count <= budget:
+        return
+
+    message = f"{endpoint} ran {stats.count} queries, over its budget of {budget}"
+    if action == "raise":
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+def checked_stream(body, check):
+    """Stream `body`, then check the budget once all of its queries have run."""
+
+    yield from body
+    check()
+
+
+class QueryStats:
+    """The number of queries run for a request, their total time, and the time
+    spent waiting for pooled connections (see app/pool.py).
+    """
+
+    __slots__ = ("count", "seconds", "pool_seconds", "started")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.pool_seconds = 0.0
+        self.started = perf_counter()
+
+
+def current_stats():
+    """Get the query stats of the current request, if it's being timed."""
+
+    return g.get("query_stats") if has_request_context() else None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault("query_started", []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    started = conn.info.get("query_started")
+    if stats is not None and started:
+        stats.count += 1
+        stats.seconds += perf_counter() - started.pop()
+
+
+def handle_error(context):
+    # a failed query never reaches after_cursor_execute, so its start is dropped here
+    started = (
+        context.connection.info.get("query_started") if context.connection else None
+    )
+    if started:
+        started.pop()
+
+
+class QueryTimer:
+    """Flask extension counting and timing the SQL queries of each request."""
+
+    def __init__(self, app=None):
+        self._listening = False
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Time the requests of `app`, if its SQL_TIMING setting is on."""
+
+        app.extensions["query_timer"] = self
+        if not app.config["SQL_TIMING"]:
+            return
+
+        self._listen()
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    def _listen(self):
+        """Listen for queries on every engine, once per process."""
+
+        with self._lock:
+            if not self._listening:
+                event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+                event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+                event.listen(Engine, "handle_error", handle_error)
+                self._listening = True
+
+    def start_request(self):
+        g.query_stats = QueryStats()
+
+    def finish_request(self, response):
+        """Add the request's totals to its Server-Timing header, log them, and
+        check them against the view's query budget.
+        """
+
+        # left in g, so queries made while a response streams are still counted
+        stats = g.get("query_stats")
+        if stats is None:
+            return response
+
+        sql_ms = stats.seconds * 1000
+        total_ms = (perf_counter() - stats.started) * 1000
+        response.headers.add(
+            "Server-Timing", f'db;dur={sql_ms:.2f};desc="{stats.count} queries"'
+        )
+        response.headers.add("Server-Timing", f"app;dur={total_ms:.2f}")
+        if stats.pool_seconds:
+            response.headers.add(
+                "Server-Timing", f"pool;dur={stats.pool_seconds * 1000:.2f}"
+            )
+
+        current_app.logger.info(
+            "%s %s: %d queries in %.2f ms",
+            request.method,
+            request.path,
+            stats.count,
+            sql_ms,
+            extra={
+                "endpoint": request.endpoint,
+                "sql_queries": stats.count,
+                "sql_ms": round(sql_ms, 2),
+                "total_ms": round(total_ms, 2),
+            },
+        )
+
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, "query_budget", None)
+        action = current_app.config["QUERY_BUDGET_ACTION"]
+        if budget is not None and action:
+            check = partial(
+                check_budget,
+                stats,
+                budget,
+                request.endpoint,
+                action,
+                current_app.logger,
+            )
+            if response.is_streamed:
+                response.response = checked_stream(response.response, check)
+            else:
+                check()
+
+        return response
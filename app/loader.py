@@ -0,0 +1,281 @@
+"""Bulk loading of CSV data into an empty database, ie by seed.py.
+
+Rows are streamed from each CSV file straight into the database rather than
+being held in the session: PostgreSQL reads the file itself with
+COPY FROM STDIN, and other databases are sent chunks of rows with executemany,
+one transaction per chunk.
+
+Secondary indexes are dropped before loading and built once the rows are in,
+which is much faster than updating them row by row. The tables derived from
+the loaded ones (the user counters, timelines and message search index) are
+then rebuilt in bulk, a range of users per transaction.
+
+Tables in the same stage of LOAD_STAGES don't reference each other, so with
+`parallel` they are loaded (and their indexes built) on separate connections at
+once. This only helps on PostgreSQL; SQLite allows a single writer, so there
+they're always loaded one at a time.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from csv import DictReader, reader
+from datetime import datetime
+from itertools import islice
+from os import path
+from time import perf_counter
+import click
+from sqlalchemy import DDL
+from app import db
+from app.fulltext import POSTGRES_INDEX_DDL, rebuild, uses_fts5
+from app.models import Follows, Message, TimelineEntry, User
+from app.schema import stamp
+from app.search import TRIGRAM_INDEX
+from app.timeline import mark_merged_authors, rebuild_timelines
+
+# Tables are loaded stage by stage, since later stages reference earlier ones
+LOAD_STAGES = [[User.__table__], [Message.__table__, Follows.__table__]]
+
+CSV_FILES = {"users": "users.csv", "messages": "messages.csv", "follows": "follows.csv"}
+
+# Rows per executemany, where COPY isn't available
+LOAD_CHUNK_SIZE = 10000
+
+# Users whose counters and timelines are rebuilt per transaction after loading
+REBUILD_CHUNK_SIZE = 1000
+
+# Seconds between progress reports while a table loads
+PROGRESS_INTERVAL = 5
+
+# Indexes created by DDL rather than declared on the models, by table (PostgreSQL only)
+POSTGRES_INDEXES = {
+    "users": {"ix_users_username_trgm": str(TRIGRAM_INDEX.statement)},
+    "messages": {"ix_messages_search_vector": POSTGRES_INDEX_DDL},
+}
+
+
+class Progress:
+    """Reports the rows loaded into a table, and the rate they're loaded at."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.start = perf_counter()
+        self.reported = self.start
+
+    def add(self, rows):
+        """Count `rows` more rows, reporting if it's been a while since the last report."""
+
+        self.rows += rows
+        now = perf_counter()
+        if now - self.reported >= PROGRESS_INTERVAL:
+            self.reported = now
+            click.echo(f"{self.name}: {self.rows:,} rows ({self.rate():,.0f} rows/s)")
+
+    def done(self, rows=None):
+        """Report the total rows loaded, correcting the count if `rows` is given."""
+
+        self.rows = self.rows if rows is None else rows
+        elapsed = perf_counter() - self.start
+        click.echo(
+            f"{self.name}: loaded {self.rows:,} rows in {elapsed:.1f}s "
+            f"({self.rate():,.0f} rows/s)"
+        )
+
+    def rate(self):
+        return self.rows / max(perf_counter() - self.start, 1e-9)
+
+
+class CountingFile:
+    """Wraps a file being read by COPY, counting the lines read for progress."""
+
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.progress.add(data.count("\n"))
+        return data
+
+    def readline(self, size=-1):
+        data = self.file.readline(size)
+        self.progress.add(data.count("\n"))
+        return data
+
+
+def secondary_indexes(table):
+    """Get the non-unique indexes declared on `table`.
+
+    Unique indexes enforce constraints, so they're kept while loading.
+    """
+
+    return [index for index in table.indexes if not index.unique]
+
+
+def drop_indexes(connection, tables):
+    """Drop the secondary indexes of `tables`, to be built after loading."""
+
+    for table in tables:
+        for index in secondary_indexes(table):
+            index.drop(connection, checkfirst=True)
+        if connection.dialect.name == "postgresql":
+            for name in POSTGRES_INDEXES.get(table.name, {}):
+                connection.execute(DDL(f"DROP INDEX IF EXISTS {name}"))
+
+
+def create_indexes(engine, table):
+    """Build the secondary indexes of `table`, on their own connection."""
+
+    start = perf_counter()
+    with engine.begin() as connection:
+        for index in secondary_indexes(table):
+            index.create(connection, checkfirst=True)
+        if connection.dialect.name == "postgresql":
+            for statement in POSTGRES_INDEXES.get(table.name, {}).values():
+                connection.execute(DDL(statement))
+            connection.exec_driver_sql(f"ANALYZE {table.name}")
+
+    click.echo(f"{table.name}: indexed in {perf_counter() - start:.1f}s")
+
+
+def copy_csv(engine, table, file, progress):
+    """Stream a CSV file into `table` with PostgreSQL's COPY FROM STDIN."""
+
+    columns = ", ".join(next(reader([file.readline()])))
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            # the loaded rows are simply reloaded if the server crashes mid-load
+            cursor.execute("SET LOCAL synchronous_commit = off")
+            cursor.copy_expert(
+                f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv)",
+                CountingFile(file, progress),
+            )
+            rows = cursor.rowcount
+        connection.commit()
+    finally:
+        connection.close()
+
+    progress.done(rows)
+
+
+def converters(table):
+    """Get functions converting CSV strings to the Python types of `table`'s columns."""
+
+    types = {}
+    for column in table.columns:
+        if isinstance(column.type, db.DateTime):
+            types[column.name] = datetime.fromisoformat
+        elif isinstance(column.type, db.Integer):
+            types[column.name] = int
+
+    return types
+
+
+def insert_csv(engine, table, file, progress, chunk_size):
+    """Stream a CSV file into `table` with chunks of executemany inserts."""
+
+    types = converters(table)
+    rows = DictReader(file)
+    insert = table.insert()
+
+    while True:
+        chunk = [
+            {
+                name: types[name](value) if name in types else value
+                for name, value in row.items()
+            }
+            for row in islice(rows, chunk_size)
+        ]
+        if not chunk:
+            break
+        with engine.begin() as connection:
+            connection.execute(insert, chunk)
+        progress.add(len(chunk))
+
+    progress.done()
+
+
+def load_table(engine, table, data_dir, chunk_size):
+    """Load a table from its CSV file in `data_dir`."""
+
+    progress = Progress(table.name)
+    with open(path.join(data_dir, CSV_FILES[table.name]), newline="") as file:
+        if engine.dialect.name == "postgresql":
+            copy_csv(engine, table, file, progress)
+        else:
+            insert_csv(engine, table, file, progress, chunk_size)
+
+
+def run_stage(func, tables, parallel):
+    """Call `func` for each of `tables`, at once on separate threads if `parallel`."""
+
+    if not parallel or len(tables) == 1:
+        for table in tables:
+            func(table)
+        return
+
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        # list() re-raises any exception from the threads
+        list(executor.map(func, tables))
+
+
+def rebuild_derived_tables(chunk_size):
+    """Rebuild the user counters, timelines and search index from the loaded tables.
+
+    Counters and timelines are rebuilt a range of `chunk_size` user ids per
+    transaction, so no single transaction covers the whole load.
+    """
+
+    for first_id, last_id in User.id_ranges(chunk_size):
+        User.recount(User.id.between(first_id, last_id))
+        db.session.commit()
+        click.echo(f"Recounted users up to #{last_id}")
+
+    mark_merged_authors(db.session)
+    db.session.commit()
+    for first_id, last_id in User.id_ranges(chunk_size):
+        rebuild_timelines((first_id, last_id))
+        db.session.commit()
+        click.echo(f"Rebuilt timelines up to user #{last_id}")
+
+    if uses_fts5():
+        rebuild()
+        db.session.commit()
+        click.echo("Rebuilt the message search index")
+
+
+def load(
+    data_dir,
+    parallel=False,
+    chunk_size=LOAD_CHUNK_SIZE,
+    rebuild_chunk_size=REBUILD_CHUNK_SIZE,
+):
+    """Recreate the database's tables and bulk load them from the CSVs in `data_dir`."""
+
+    engine = db.engine
+    parallel = parallel and engine.dialect.name == "postgresql"
+    start = perf_counter()
+
+    db.drop_all()
+    db.create_all()
+    # create_all builds the current schema, so no migrations need to run against it
+    stamp()
+
+    loaded_tables = [table for stage in LOAD_STAGES for table in stage]
+    with engine.begin() as connection:
+        drop_indexes(connection, loaded_tables + [TimelineEntry.__table__])
+
+    for stage in LOAD_STAGES:
+        run_stage(
+            lambda table: load_table(engine, table, data_dir, chunk_size),
+            stage,
+            parallel,
+        )
+
+    # the rebuilds below read the loaded tables through their indexes
+    run_stage(lambda table: create_indexes(engine, table), loaded_tables, parallel)
+
+    rebuild_derived_tables(rebuild_chunk_size)
+    create_indexes(engine, TimelineEntry.__table__)
+
+    click.echo(f"Loaded in {perf_counter() - start:.1f}s")
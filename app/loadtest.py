@@ -0,0 +1,286 @@
+"""Load testing Warbler's routes with concurrent simulated users.
+
+Each simulated user is a thread with its own test client (and so its own
+session cookie), driving the real WSGI app in-process: it logs in as one of the
+database's users, then repeatedly picks an action from the mix (view home,
+post, like or follow) until the run ends. Every request's latency is recorded
+against its action, and summarized as throughput and p50/p95/p99 latencies.
+
+Run against a seeded database, ie with loadtest.py; the users must share a
+known password ('password' for generated data, see generator/create_csvs.py).
+"""
+
+from math import ceil
+from random import Random
+from re import search
+from threading import Lock, Thread
+from time import perf_counter
+from sqlalchemy import select
+from app import db
+from app.models import Follows, Message, User
+
+# Relative weights of the actions each simulated user takes after logging in
+DEFAULT_MIX = {"home": 60, "like": 20, "post": 10, "follow": 10}
+
+# How many recent messages and users may be liked and followed
+TARGET_SAMPLE_SIZE = 1000
+
+PERCENTILES = [50, 95, 99]
+
+
+class Recorder:
+    """Collects (action, seconds, status) samples from every simulated user."""
+
+    def __init__(self):
+        self.samples = []
+        self.lock = Lock()
+
+    def record(self, action, seconds, status):
+        with self.lock:
+            self.samples.append((action, seconds, status))
+
+
+class SimulatedUser:
+    """A logged-in user taking random actions through their own test client."""
+
+    def __init__(self, app, user, targets, password, recorder, rng):
+        self.client = app.test_client()
+        self.user_id, self.username, self.following = user
+        message_ids, user_ids = targets
+        self.message_ids = message_ids
+        self.user_ids = [user_id for user_id in user_ids if user_id != self.user_id]
+        self.password = password
+        self.recorder = recorder
+        self.rng = rng
+        self.csrf_token = None
+        self.logged_in = False
+
+    def request(self, action, method, url, **kwargs):
+        """Make a timed request, recording it against `action`."""
+
+        start = perf_counter()
+        resp = self.client.open(url, method=method, **kwargs)
+        self.recorder.record(action, perf_counter() - start, resp.status_code)
+        return resp
+
+    def form_token(self, url):
+        """Get the CSRF token of the form at `url`, if CSRF is enabled (untimed)."""
+
+        match = search(
+            r'name="csrf_token" type="hidden" value="([^"]*)"',
+            self.client.get(url).text,
+        )
+        return match.group(1) if match else None
+
+    def login(self):
+        """Log in, returning whether it succeeded."""
+
+        data = {"username": self.username, "password": self.password}
+        token = self.form_token("/login")
+        if token:
+            data["csrf_token"] = token
+
+        resp = self.request("login", "POST", "/login", data=data)
+        if resp.status_code != 302:
+            return False
+
+        self.logged_in = True
+        self.csrf_token = self.form_token("/messages/new")
+        return True
+
+    def home(self):
+        self.request("home", "GET", "/")
+
+    def like(self):
+        if self.message_ids:
+            message_id = self.rng.choice(self.message_ids)
+            self.request("like", "POST", f"/users/add_like/{message_id}")
+
+    def post(self):
+        data = {"text": f"Load test warble from {self.username}"}
+        if self.csrf_token:
+            data["csrf_token"] = self.csrf_token
+        self.request("post", "POST", "/messages/new", data=data)
+
+    def follow(self):
+        """Follow a random user, or unfollow them if they're already followed."""
+
+        if not self.user_ids:
+            return
+
+        user_id = self.rng.choice(self.user_ids)
+        if user_id in self.following:
+            self.request("unfollow", "POST", f"/users/stop-following/{user_id}")
+            self.following.discard(user_id)
+        else:
+            self.request("follow", "POST", f"/users/follow/{user_id}")
+            self.following.add(user_id)
+
+    def run(self, mix, deadline, max_requests):
+        """Log in, then take actions until `deadline` or `max_requests` actions."""
+
+        if not self.login():
+            return
+
+        actions, weights = list(mix), list(mix.values())
+        taken = 0
+        while perf_counter() < deadline and (
+            max_requests is None or taken < max_requests
+        ):
+            getattr(self, self.rng.choices(actions, weights)[0])()
+            taken += 1
+
+
+def load_targets(count):
+    """Get the users to log in as, with who they follow, and the ids to like and follow.
+
+    Must be called within an app context.
+    """
+
+    users = db.session.execute(
+        select(User.id, User.username).order_by(User.id).limit(count)
+    ).all()
+    follows = db.session.execute(
+        select(Follows.user_following_id, Follows.user_being_followed_id).where(
+            Follows.user_following_id.in_([user_id for user_id, _ in users])
+        )
+    )
+    following = {user_id: set() for user_id, _ in users}
+    for follower_id, followed_id in follows:
+        following[follower_id].add(followed_id)
+
+    message_ids = (
+        db.session.execute(
+            select(Message.id).order_by(Message.id.desc()).limit(TARGET_SAMPLE_SIZE)
+        )
+        .scalars()
+        .all()
+    )
+    user_ids = (
+        db.session.execute(
+            select(User.id).order_by(User.id.desc()).limit(TARGET_SAMPLE_SIZE)
+        )
+        .scalars()
+        .all()
+    )
+    logins = [(user_id, username, following[user_id]) for user_id, username in users]
+    return logins, (message_ids, user_ids)
+
+
+def percentile(sorted_values, pct):
+    """Get the nearest-rank `pct` percentile of already sorted values."""
+
+    return sorted_values[max(ceil(pct / 100 * len(sorted_values)) - 1, 0)]
+
+
+def summarize(samples, elapsed):
+    """Summarize (seconds, status) samples as throughput, errors and latency percentiles."""
+
+    latencies = sorted(seconds for seconds, _ in samples)
+    summary = {
+        "requests": len(samples),
+        "errors": sum(1 for _, status in samples if status >= 400),
+        "throughput": round(len(samples) / elapsed, 2),
+    }
+    for pct in PERCENTILES:
+        summary[f"p{pct}_ms"] = round(percentile(latencies, pct) * 1000, 2)
+
+    return summary
+
+
+def run(
+    app, users=10, duration=30, max_requests=None, mix=None, password="password", seed=0
+):
+    """Run a load test against `app`, returning a report of results per action.
+
+    Each of `users` simulated users acts for `duration` seconds, or until it has
+    taken `max_requests` actions. The same `seed` gives each user the same
+    sequence of choices.
+    """
+
+    mix = mix or DEFAULT_MIX
+    with app.app_context():
+        logins, targets = load_targets(users)
+    if not logins:
+        raise ValueError("The database has no users to log in as; run seed.py first.")
+
+    recorder = Recorder()
+    simulated = [
+        SimulatedUser(app, user, targets, password, recorder, Random(seed + number))
+        for number, user in enumerate(logins)
+    ]
+
+    start = perf_counter()
+    deadline = start + duration
+    threads = [
+        Thread(target=user.run, args=(mix, deadline, max_requests))
+        for user in simulated
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    by_action = {}
+    for action, seconds, status in recorder.samples:
+        by_action.setdefault(action, []).append((seconds, status))
+
+    return {
+        "config": {
+            "users": len(simulated),
+            "duration": duration,
+            "max_requests": max_requests,
+            "mix": mix,
+            "seed": seed,
+            "database": app.config["SQLALCHEMY_DATABASE_URI"].split("://")[0],
+        },
+        "elapsed_s": round(elapsed, 2),
+        # users whose login was refused, ie because of a wrong --password, take no actions
+        "failed_logins": sum(1 for user in simulated if not user.logged_in),
+        "routes": {
+            action: summarize(samples, elapsed)
+            for action, samples in sorted(by_action.items())
+        },
+        "total": summarize(
+            [(seconds, status) for _, seconds, status in recorder.samples], elapsed
+        )
+        if recorder.samples
+        else None,
+    }
+
+
+def format_report(report, baseline=None):
+    """Format a report as a table, with changes from a `baseline` report if given."""
+
+    columns = ["requests", "errors", "throughput"] + [
+        f"p{pct}_ms" for pct in PERCENTILES
+    ]
+    lines = [f"{'route':<10}" + "".join(f"{column:>12}" for column in columns)]
+
+    rows = list(report["routes"].items())
+    if report["total"]:
+        rows.append(("total", report["total"]))
+
+    for route, summary in rows:
+        lines.append(
+            f"{route:<10}" + "".join(f"{summary[column]:>12}" for column in columns)
+        )
+        if not baseline:
+            continue
+
+        previous = (
+            baseline["total"] if route == "total" else baseline["routes"].get(route)
+        )
+        if previous:
+            changes = [
+                f"{(summary[column] - previous[column]) / previous[column]:+.0%}"
+                if previous[column]
+                else "-"
+                for column in columns
+            ]
+            lines.append(
+                f"{'  vs base':<10}" + "".join(f"{change:>12}" for change in changes)
+            )
+
+    return "\n".join(lines)
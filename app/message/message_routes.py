@@ -1,11 +1,38 @@
-from flask import redirect, render_template, flash, g
-from app.models import Message
+import click
+from flask import (
+    Response,
+    abort,
+    current_app,
+    redirect,
+    render_template,
+    flash,
+    g,
+    request,
+)
+from sqlalchemy import func, select
+from app.models import Follows, Likes, Message, User
 from .message_forms import MessageForm
 from . import message_bp
 from app import db
+from app.eager import MESSAGE_CARD
+from app.caching import page_etag, render_if_modified
+from app.events import event_stream, publish_message
+from app.instrumentation import query_budget
+from app.replica import use_replica
+from app.fulltext import (
+    decode_search_cursor,
+    index_message,
+    rebuild,
+    search_messages,
+    unindex_messages,
+    uses_fts5,
+)
+from app.timeline import push_message, remove_message
+from app.user.user_util import forget_user, liked_ids
 
 
 @message_bp.route("/messages/new", methods=["GET", "POST"])
+@query_budget(9)
 def messages_add():
     """Add a message:
 
@@ -19,24 +46,98 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        push_message(msg)
+        index_message(msg)
+        User.update_counts(g.user.id, messages_count=1)
+        # committing expires the message, so its id is kept rather than reloaded
+        message_id = msg.id
         db.session.commit()
+        forget_user(g.user.id)
+        publish_message(g.user.id, message_id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template("message/new.html", form=form)
 
 
+@message_bp.route("/messages/stream")
+@query_budget(2)
+def messages_stream():
+    """Stream the ids of new messages for the logged-in user's homepage.
+
+    The stream is a text/event-stream of Server-Sent Events (see app/events.py),
+    covering the user's own messages and those of everyone they follow.
+    """
+
+    if not g.user:
+        abort(401)
+
+    followed_ids = db.session.scalars(
+        select(Follows.user_being_followed_id).where(
+            Follows.user_following_id == g.user.id
+        )
+    )
+    config = current_app.config
+    stream = event_stream(
+        current_app.extensions["events"],
+        [g.user.id, *followed_ids],
+        config["EVENTS_HEARTBEAT_SECONDS"],
+        config["EVENTS_STREAM_SECONDS"],
+    )
+    return Response(
+        stream,
+        mimetype="text/event-stream",
+        # keep proxies (ie nginx) from buffering events
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@message_bp.route("/messages/search")
+@query_budget(4)
+def messages_search():
+    """Search message text for the 'q' param in the querystring.
+
+    Shows a page of the best matches first, starting after the optional
+    'after' cursor.
+    """
+
+    search = request.args.get("q", "")
+    after = decode_search_cursor(request.args.get("after"))
+    page = search_messages(search, after, options=MESSAGE_CARD)
+    return render_template(
+        "message/search.html",
+        search=search,
+        messages=page.items,
+        next_cursor=page.next_cursor,
+        likes=liked_ids(page.items),
+    )
+
+
 @message_bp.route("/messages/<int:message_id>", methods=["GET"])
+@query_budget(5)
+@use_replica
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message, or a 304 if the browser has its current version."""
 
-    msg = Message.query.get(message_id)
-    return render_template("message/show.html", message=msg)
+    stamps = (
+        db.session.query(Message.version, User.updated_at)
+        .join(User, User.id == Message.user_id)
+        .filter(Message.id == message_id)
+        .first_or_404()
+    )
+
+    def render():
+        msg = Message.query.options(*MESSAGE_CARD).get_or_404(message_id)
+        return render_template("message/show.html", message=msg, likes=liked_ids([msg]))
+
+    return render_if_modified(page_etag("message", message_id, *stamps), render)
 
 
 @message_bp.route("/messages/<int:message_id>/delete", methods=["POST"])
+@query_budget(10)
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -44,8 +145,65 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+    if msg.user_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    remove_message(msg)
+    unindex_messages(Message.id == msg.id)
+    User.update_counts(msg.user_id, messages_count=-1)
+    User.update_counts(
+        select(Likes.user_id).where(Likes.message_id == msg.id), likes_count=-1
+    )
     db.session.delete(msg)
     db.session.commit()
+    forget_user(g.user.id)
 
     return redirect(f"/users/{g.user.id}")
+
+
+@message_bp.cli.command("recount-likes")
+@click.option("--chunk-size", default=1000, help="Messages to recount per transaction.")
+@click.option(
+    "--verify", is_flag=True, help="Report mismatched counts without fixing them."
+)
+def recount_likes_command(chunk_size, verify):
+    """Recompute (or with --verify, check) every message's like count."""
+
+    last_id = db.session.query(func.max(Message.id)).scalar() or 0
+    mismatched = 0
+
+    for first_id in range(1, last_id + 1, chunk_size):
+        in_chunk = Message.id.between(first_id, first_id + chunk_size - 1)
+        if verify:
+            stored = dict(
+                db.session.query(Message.id, Message.like_count).filter(in_chunk)
+            )
+            for message_id, count in Message.count_likes(list(stored)).items():
+                if stored[message_id] != count:
+                    mismatched += 1
+                    click.echo(
+                        f"Message #{message_id}: {stored[message_id]} != {count}"
+                    )
+        else:
+            Message.recount_likes(in_chunk)
+            db.session.commit()
+
+    if verify:
+        click.echo(f"{mismatched} mismatched like counts.")
+    else:
+        click.echo("Like counts recounted.")
+
+
+@message_bp.cli.command("reindex")
+def reindex_command():
+    """Rebuild the message search index (SQLite only; PostgreSQL keeps its own)."""
+
+    if not uses_fts5():
+        click.echo("Message search is indexed by the database; nothing to rebuild.")
+        return
+
+    rebuild()
+    db.session.commit()
+    click.echo("Message search index rebuilt.")
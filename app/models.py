@@ -10,7 +10,9 @@ This makes the imports for the models more straightforward if they are all conta
 """
 
 from datetime import datetime
-from app import db, bcrypt
+from sqlalchemy import func, select
+from app import db, hasher
+from app.hashing import HashingBusy
 
 
 class Follows(db.Model):
@@ -30,6 +32,21 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key covers looking up a user's followers; this covers who they follow
+    __table_args__ = (
+        db.Index("ix_follows_following", user_following_id, user_being_followed_id),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? Answered from the primary key index."""
+
+        follow = cls.query.filter(
+            cls.user_being_followed_id == followed_id,
+            cls.user_following_id == follower_id,
+        )
+        return db.session.query(follow.exists()).scalar()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -40,8 +57,11 @@ class Likes(db.Model):
 
     user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="cascade"))
 
-    message_id = db.Column(
-        db.Integer, db.ForeignKey("messages.id", ondelete="cascade"), unique=True
+    message_id = db.Column(db.Integer, db.ForeignKey("messages.id", ondelete="cascade"))
+
+    # A user can like a message once, but a message can be liked by many users
+    __table_args__ = (
+        db.Index("ix_likes_user_message", user_id, message_id, unique=True),
     )
 
 
@@ -87,7 +107,39 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship("Message", back_populates="user")
+    # Denormalized counts, so pages can show them without loading the relationships.
+    # They're kept up to date by the routes that change them (see update_counts),
+    # and can be recomputed from the tables with 'flask user recount'.
+    messages_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+
+    followers_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+
+    following_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # Set once the user has more followers than TIMELINE_FANOUT_MAX_FOLLOWERS, so
+    # their messages are merged into timelines at read time (see app/timeline.py)
+    merged_at_read = db.Column(
+        db.Boolean, nullable=False, default=False, server_default=db.false()
+    )
+
+    # Version stamp for the pages showing this user (see app/caching.py). It's set
+    # by every UPDATE of the user, including the counter updates of posts, likes
+    # and follows; rows from before the column existed have none until then.
+    updated_at = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+    # These are left to the database's ON DELETE CASCADE, rather than being loaded
+    # (and their rows deleted one by one, or orphaned) when a user is deleted
+    messages = db.relationship("Message", back_populates="user", passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -95,6 +147,7 @@ class User(db.Model):
         primaryjoin=(Follows.user_being_followed_id == id),
         secondaryjoin=(Follows.user_following_id == id),
         back_populates="following",
+        passive_deletes=True,
     )
 
     following = db.relationship(
@@ -103,9 +156,22 @@ class User(db.Model):
         primaryjoin=(Follows.user_following_id == id),
         secondaryjoin=(Follows.user_being_followed_id == id),
         back_populates="followers",
+        passive_deletes=True,
     )
 
-    likes = db.relationship("Message", secondary="likes", back_populates="liked_by")
+    likes = db.relationship(
+        "Message", secondary="likes", back_populates="liked_by", passive_deletes=True
+    )
+
+    # Only the few merged users are indexed, so home timelines can find them cheaply
+    __table_args__ = (
+        db.Index(
+            "ix_users_merged_at_read",
+            id,
+            postgresql_where=merged_at_read,
+            sqlite_where=merged_at_read,
+        ),
+    )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
@@ -113,21 +179,126 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        return other_user in self.followers
+        return Follows.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        return other_user in self.following
+        return Follows.exists(follower_id=self.id, followed_id=other_user.id)
+
+    def following_ids_among(self, user_ids):
+        """Get the set of ids in `user_ids` that this user follows, with a single query."""
+
+        if not user_ids:
+            return set()
+
+        followed = db.session.execute(
+            select(Follows.user_being_followed_id).where(
+                Follows.user_following_id == self.id,
+                Follows.user_being_followed_id.in_(user_ids),
+            )
+        )
+        return set(followed.scalars())
+
+    def rehash_password(self, password):
+        """Rehash `password` if this user's hash was made with an outdated bcrypt cost.
+
+        This is best-effort: if hashing is busy, the old hash is kept until the next login.
+        """
+
+        if hasher.needs_rehash(self.password):
+            try:
+                self.password = hasher.generate_password_hash(password)
+            except HashingBusy:
+                pass
+
+    def liked_ids_among(self, message_ids):
+        """Get the set of ids in `message_ids` that this user has liked, with a single query."""
+
+        if not message_ids:
+            return set()
+
+        liked = db.session.execute(
+            select(Likes.message_id).where(
+                Likes.user_id == self.id, Likes.message_id.in_(message_ids)
+            )
+        )
+        return set(liked.scalars())
+
+    @classmethod
+    def update_counts(cls, user_ids, **changes):
+        """Add to the counter columns of the users in `user_ids`, ie `following_count=1`.
+
+        `user_ids` may be a single id or a subquery of ids. The update is done in
+        SQL, so concurrent changes to the same counter aren't lost, and bumps the
+        users' updated_at stamps.
+        """
+
+        if isinstance(user_ids, int):
+            matching = cls.id == user_ids
+        else:
+            matching = cls.id.in_(user_ids)
+
+        cls.query.filter(matching).update(
+            {
+                getattr(cls, counter): getattr(cls, counter) + change
+                for counter, change in changes.items()
+            },
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def touch(cls, user_ids):
+        """Bump the updated_at stamp of the users in `user_ids`, ie when their messages are liked."""
+
+        cls.update_counts(user_ids)
+
+    @classmethod
+    def id_ranges(cls, chunk_size):
+        """Yield (first_id, last_id) ranges of `chunk_size` ids covering every user.
+
+        Rebuilds over all users run a transaction per range, rather than one huge one.
+        """
+
+        last_id = db.session.query(func.max(cls.id)).scalar() or 0
+        for first_id in range(1, last_id + 1, chunk_size):
+            yield first_id, min(first_id + chunk_size - 1, last_id)
+
+    @classmethod
+    def recount(cls, condition):
+        """Recompute the counter columns of the users matching `condition` from the tables.
+
+        ie `User.recount(User.id.between(1, 1000))`
+        """
+
+        def count_of(column):
+            return (
+                select(func.count())
+                .where(column == cls.id)
+                .correlate(cls)
+                .scalar_subquery()
+            )
+
+        cls.query.filter(condition).update(
+            {
+                cls.messages_count: count_of(Message.user_id),
+                cls.followers_count: count_of(Follows.user_being_followed_id),
+                cls.following_count: count_of(Follows.user_following_id),
+                cls.likes_count: count_of(Likes.user_id),
+            },
+            synchronize_session=False,
+        )
 
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
 
         Hashes password and adds user to system.
+
+        Raises HashingBusy if the password can't be hashed right now.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode("UTF-8")
+        hashed_pwd = hasher.generate_password_hash(password)
 
         user = User(
             username=username,
@@ -148,13 +319,19 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A matching password whose hash was made with an outdated bcrypt cost is
+        rehashed; the caller should commit the session to save it.
+
+        Raises HashingBusy if the password can't be checked right now.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check_password_hash(user.password, password)
             if is_auth:
+                user.rehash_password(password)
                 return user
 
         return False
@@ -178,7 +355,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -187,6 +364,109 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized like count, kept up to date by add_like (see count_likes to verify it)
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # Version stamp for the pages showing this message (see app/caching.py),
+    # incremented along with its like count
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
     user = db.relationship("User", back_populates="messages")
 
     liked_by = db.relationship("User", secondary="likes", back_populates="likes")
+
+    # Lets a user's newest messages be read in order from the index alone
+    __table_args__ = (
+        db.Index("ix_messages_user_timestamp", user_id, timestamp.desc(), id.desc()),
+    )
+
+    @classmethod
+    def update_like_counts(cls, message_ids, change):
+        """Add `change` to the like count of the messages in `message_ids`.
+
+        `message_ids` may be a single id or a subquery of ids.
+        """
+
+        if isinstance(message_ids, int):
+            matching = cls.id == message_ids
+        else:
+            matching = cls.id.in_(message_ids)
+
+        cls.query.filter(matching).update(
+            {cls.like_count: cls.like_count + change, cls.version: cls.version + 1},
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def count_likes(cls, message_ids):
+        """Count the likes of each message in `message_ids` from the likes table.
+
+        Uses a single GROUP BY query, for checking or backfilling like_count;
+        returns {message_id: count}, including messages with no likes.
+        """
+
+        counts = db.session.execute(
+            select(Likes.message_id, func.count())
+            .where(Likes.message_id.in_(message_ids))
+            .group_by(Likes.message_id)
+        )
+        return {message_id: 0 for message_id in message_ids} | dict(counts.all())
+
+    @classmethod
+    def recount_likes(cls, condition):
+        """Recompute the like count of the messages matching `condition` from the likes table."""
+
+        like_count = (
+            select(func.count())
+            .where(Likes.message_id == cls.id)
+            .correlate(cls)
+            .scalar_subquery()
+        )
+        cls.query.filter(condition).update(
+            {cls.like_count: like_count, cls.version: cls.version + 1},
+            synchronize_session=False,
+        )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Rows are written when a message is posted (see app/timeline.py), so that
+    reading a homepage only needs the viewer's own entries.
+    """
+
+    __tablename__ = "timeline_entries"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey("messages.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # Kept alongside the message id so an unfollow can drop entries without a join
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        nullable=False,
+    )
+
+    # Copied from the message so a timeline can be ordered without a join
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            "ix_timeline_entries_user_timestamp",
+            user_id,
+            timestamp.desc(),
+            message_id.desc(),
+        ),
+    )
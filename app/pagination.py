@@ -0,0 +1,169 @@
+"""Keyset (cursor) pagination for lists of messages and users.
+
+Pages of messages are ordered by (timestamp, id), newest first. Rather than an
+OFFSET, the next page is requested with an opaque '?before=' cursor encoding
+the position of the last message shown, so every page costs the same however
+far back it is.
+
+The user directory is ordered by username, which is unique, so its '?after='
+cursor is simply the last username shown.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+from collections import namedtuple
+from datetime import datetime
+from flask import abort, current_app
+from sqlalchemy import and_, or_
+from app.models import Message, User
+
+Page = namedtuple("Page", ["items", "next_cursor"])
+
+
+def encode_position(*parts):
+    """Encode the parts of a position as an opaque, URL-safe cursor."""
+
+    position = "|".join(str(part) for part in parts).encode("UTF-8")
+    return urlsafe_b64encode(position).decode("UTF-8").rstrip("=")
+
+
+def decode_position(cursor, *types):
+    """Decode a cursor back into its parts, converting each with `types`.
+
+    Returns None if no cursor is given, and aborts with a 400 for one that
+    cannot be decoded.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        parts = urlsafe_b64decode(padded).decode("UTF-8").split("|")
+        if len(parts) != len(types):
+            raise ValueError(cursor)
+        return tuple(convert(part) for convert, part in zip(types, parts))
+    except (DecodeError, UnicodeDecodeError, ValueError):
+        abort(400)
+
+
+def encode_cursor(timestamp, id):
+    """Encode a (timestamp, id) position as an opaque, URL-safe cursor."""
+
+    return encode_position(timestamp.isoformat(), id)
+
+
+def decode_cursor(cursor):
+    """Decode a cursor back into a (timestamp, id) position, or None if not given."""
+
+    return decode_position(cursor, datetime.fromisoformat, int)
+
+
+def per_page():
+    """Get the configured number of messages per page."""
+
+    return current_app.config["MESSAGES_PER_PAGE"]
+
+
+def before_position(timestamp_column, id_column, position):
+    """Build a filter for rows that come after `position` in newest-first order."""
+
+    timestamp, id = position
+    return or_(
+        timestamp_column < timestamp,
+        and_(timestamp_column == timestamp, id_column < id),
+    )
+
+
+def page_of(messages, page_size):
+    """Make a Page from up to `page_size + 1` messages, in newest-first order.
+
+    The extra message is only fetched to tell whether there is another page.
+    """
+
+    if len(messages) <= page_size:
+        return Page(messages, None)
+
+    messages = messages[:page_size]
+    last = messages[-1]
+    return Page(messages, encode_cursor(last.timestamp, last.id))
+
+
+def paginate_messages(query, before=None, page_size=None):
+    """Get a page of a Message query, starting after the `before` position."""
+
+    page_size = page_size or per_page()
+    if before:
+        query = query.filter(before_position(Message.timestamp, Message.id, before))
+
+    messages = (
+        query.order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(page_size + 1)
+        .all()
+    )
+    return page_of(messages, page_size)
+
+
+def paginate_users(query, after=None, page_size=None):
+    """Get a page of a User query in username order, starting after `after`."""
+
+    page_size = page_size or current_app.config["USERS_PER_PAGE"]
+    if after:
+        query = query.filter(User.username > after)
+
+    users = query.order_by(User.username).limit(page_size + 1).all()
+    if len(users) <= page_size:
+        return Page(users, None)
+
+    users = users[:page_size]
+    return Page(users, users[-1].username)
+
+
+class StreamedPage:
+    """A page of a query that is fetched in chunks as it is iterated.
+
+    Used for pages rendered by a streamed template, so that the first rows are
+    sent before the last are fetched. next_cursor is only set once the page has
+    been iterated to its end.
+    """
+
+    def __init__(self, query, page_size, cursor_of):
+        self.query = query
+        self.page_size = page_size
+        self.cursor_of = cursor_of
+        self.next_cursor = None
+
+    def chunks(self):
+        """Yield the page's rows as lists of up to STREAM_CHUNK_SIZE."""
+
+        chunk_size = current_app.config["STREAM_CHUNK_SIZE"]
+        rows = self.query.limit(self.page_size + 1).yield_per(chunk_size)
+
+        chunk = []
+        # the chunk may have just been sent when the page fills, so the last row
+        # is kept for the cursor rather than read back from the chunk
+        last_row = None
+        for count, row in enumerate(rows):
+            if count == self.page_size:
+                self.next_cursor = self.cursor_of(last_row)
+                break
+            chunk.append(row)
+            last_row = row
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+
+def stream_users(query, after=None, page_size=None):
+    """Get a StreamedPage of a User query in username order, starting after `after`."""
+
+    page_size = page_size or current_app.config["USERS_PER_PAGE"]
+    if after:
+        query = query.filter(User.username > after)
+
+    return StreamedPage(
+        query.order_by(User.username), page_size, lambda user: user.username
+    )
@@ -0,0 +1,194 @@
+"""Database connection pool configuration and monitoring for Warbler.
+
+Every worker process keeps its own pool of up to DB_POOL_SIZE + DB_MAX_OVERFLOW
+PostgreSQL connections, so the pools of every worker on every dyno must fit
+within the server's max_connections (less those reserved for superusers):
+
+    workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) <= max_connections - reserved
+
+Connections are checked with a cheap ping before use (DB_POOL_PRE_PING), so one
+dropped by the server or a proxy is replaced rather than failing a request, and
+are replaced after DB_POOL_RECYCLE seconds. A request that can't get a
+connection within DB_POOL_TIMEOUT seconds fails rather than queueing forever.
+
+DB_STATEMENT_TIMEOUT_MS makes PostgreSQL cancel any statement that runs longer.
+It's normally sent as a startup option of each connection. Behind PgBouncer in
+transaction pooling mode (DB_PGBOUNCER), server connections are shared between
+clients and startup options are refused, so it's set with SET LOCAL at the start
+of every transaction instead, and never leaks to another client's session.
+
+Other databases, ie SQLite for local and test runs, keep Flask-SQLAlchemy's
+own pooling, and have no statement timeout.
+
+Each pool records how long checkouts wait for a connection. With
+POOL_STATS_TOKEN set, GET /pool-stats (sent with 'Authorization: Bearer
+<token>') returns the worker's pool size, checked out and overflow connections,
+and its checkout waits and timeouts as JSON; each request's own wait is also
+added to its Server-Timing header (see app/instrumentation.py).
+"""
+
+from functools import partial
+from hmac import compare_digest
+from threading import Lock
+from time import perf_counter
+from flask import abort, current_app, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+from app.instrumentation import current_stats
+
+
+class CheckoutStats:
+    """How many checkouts a pool has made, how long they waited, and how many timed out."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self._lock = Lock()
+
+    def record(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            self.timeouts += timed_out
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "mean_wait_ms": round(
+                    self.wait_seconds / self.checkouts * 1000 if self.checkouts else 0,
+                    2,
+                ),
+                "max_wait_ms": round(self.max_wait_seconds * 1000, 2),
+                "timeouts": self.timeouts,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool recording how long each checkout waits for a connection.
+
+    The wait includes opening a new connection, when the pool has none free but
+    may still overflow.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_stats = CheckoutStats()
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeout:
+            self.checkout_stats.record(perf_counter() - start, timed_out=True)
+            raise
+
+        waited = perf_counter() - start
+        self.checkout_stats.record(waited)
+        stats = current_stats()
+        if stats is not None:
+            stats.pool_seconds += waited
+
+        return connection
+
+
+def set_local_statement_timeout(timeout_ms, conn):
+    """Limit how long each statement of the transaction `conn` is beginning may run."""
+
+    if conn.dialect.name == "postgresql":
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+
+def engine_options(config):
+    """Build the create_engine() options for the pool settings in `config`."""
+
+    uri = config["SQLALCHEMY_DATABASE_URI"]
+    if not uri or make_url(uri).get_backend_name() != "postgresql":
+        return {}
+
+    options = {
+        "poolclass": TimedQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+    timeout_ms = config["DB_STATEMENT_TIMEOUT_MS"]
+    if timeout_ms and not config["DB_PGBOUNCER"]:
+        options["connect_args"] = {"options": f"-c statement_timeout={int(timeout_ms)}"}
+
+    return options
+
+
+def pool_status(pool):
+    """Get the current size, use and checkout waits of `pool`."""
+
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            # negative while the pool has yet to open all of its connections
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,
+        )
+    if isinstance(pool, TimedQueuePool):
+        status.update(pool.checkout_stats.to_dict())
+
+    return status
+
+
+def send_pool_stats():
+    """Return this worker's pool status as JSON, to requests with the stats token."""
+
+    token = current_app.config["POOL_STATS_TOKEN"]
+    authorization = request.headers.get("Authorization", "")
+    if not compare_digest(authorization, f"Bearer {token}"):
+        abort(403)
+
+    engine = current_app.extensions["sqlalchemy"].db.engine
+    return jsonify(pool_status(engine.pool))
+
+
+class PoolMonitor:
+    """Flask extension configuring the database connection pool and reporting its use."""
+
+    def __init__(self, app=None):
+        self._timeout_listeners = set()
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Set the engine options of `app` from its DB_* settings."""
+
+        app.extensions["pool_monitor"] = self
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            **engine_options(app.config),
+            **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+        }
+
+        timeout_ms = app.config["DB_STATEMENT_TIMEOUT_MS"]
+        if timeout_ms and app.config["DB_PGBOUNCER"]:
+            self._listen(timeout_ms)
+
+        if app.config["POOL_STATS_TOKEN"]:
+            app.add_url_rule("/pool-stats", "pool_stats", send_pool_stats)
+
+    def _listen(self, timeout_ms):
+        """Set the statement timeout of every transaction, once per process and timeout."""
+
+        with self._lock:
+            if timeout_ms not in self._timeout_listeners:
+                event.listen(
+                    Engine, "begin", partial(set_local_statement_timeout, timeout_ms)
+                )
+                self._timeout_listeners.add(timeout_ms)
@@ -0,0 +1,86 @@
+"""Read replica routing for Warbler.
+
+When a 'replica' bind is configured (REPLICA_DATABASE_URL), the read-only
+queries of GET views decorated with @use_replica are sent to it, and everything
+else (writes, flushes, and every query of other views) to the primary.
+
+Replicas lag slightly behind the primary, so a browser that has just written
+(ie posted a warble) is pinned to the primary for REPLICA_PIN_SECONDS, by a
+timestamp in its session; its own writes are then always visible to it.
+"""
+
+from time import time
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND = "replica"
+PINNED_UNTIL_KEY = "primary_until"
+
+
+def use_replica(view):
+    """Let the read-only queries of the decorated GET view go to the replica."""
+
+    view.use_replica = True
+    return view
+
+
+def has_replica(app):
+    """Is a replica configured for `app`?"""
+
+    return REPLICA_BIND in (app.config["SQLALCHEMY_BINDS"] or {})
+
+
+class RoutingSession(SignallingSession):
+    """A session sending reads to the replica during requests that may use it."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not has_request_context():
+            return super().get_bind(mapper, clause)
+
+        if self._flushing or isinstance(clause, UpdateBase):
+            g.wrote_to_primary = True
+        elif g.get("use_replica"):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that route reads to a replica."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaRouter:
+    """Flask extension choosing whether each request may read from the replica."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["replica_router"] = self
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    def start_request(self):
+        view = current_app.view_functions.get(request.endpoint)
+        g.use_replica = (
+            request.method == "GET"
+            and getattr(view, "use_replica", False)
+            and has_replica(current_app)
+            and session.get(PINNED_UNTIL_KEY, 0) <= time()
+        )
+
+    def finish_request(self, response):
+        """Pin a browser that has just written to the primary for a while."""
+
+        if g.pop("wrote_to_primary", False) and has_replica(current_app):
+            session[PINNED_UNTIL_KEY] = (
+                time() + current_app.config["REPLICA_PIN_SECONDS"]
+            )
+
+        return response
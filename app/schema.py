@@ -0,0 +1,311 @@
+"""Versioned schema migrations for Warbler.
+
+`db.create_all()` only creates tables that are missing entirely, so changes to
+an existing database (new tables and indexes on tables that already hold data)
+are made by the numbered migrations below. Each applied version is recorded in
+the `schema_versions` table, and `flask schema upgrade` runs those still
+pending, in order.
+
+Index migrations are 'online': on PostgreSQL they are built with CREATE INDEX
+CONCURRENTLY, outside of a transaction, so writes to the table are not blocked
+while the index is built. Other online migrations only take brief locks, ie
+adding a nullable column without a default, and fill existing rows in batches
+that are each committed as they're done; none rewrites a whole table. The
+indexes themselves are declared on the models, so a database created with
+`db.create_all()` already has them and only needs to be stamped as up to date
+(see seed.py).
+"""
+
+from collections import namedtuple
+from datetime import datetime
+import click
+from flask.cli import AppGroup
+from sqlalchemy import insert, inspect, select
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from app import db
+from app.models import Follows, Likes, Message, TimelineEntry, User
+from app.fulltext import create_message_search, index_message_search
+from app.search import create_trigram_index
+from app.timeline import mark_merged_authors
+
+schema_versions = db.Table(
+    "schema_versions",
+    db.Column("version", db.Integer, primary_key=True),
+    db.Column("description", db.Text, nullable=False),
+    db.Column("applied_at", db.DateTime, nullable=False),
+)
+
+Migration = namedtuple("Migration", ["version", "description", "upgrade", "online"])
+
+
+def create_table(table):
+    """Build a migration step that creates `table` if it does not exist."""
+
+    def upgrade(connection):
+        table.create(connection, checkfirst=True)
+
+    return upgrade
+
+
+def add_columns(table, *names):
+    """Build a migration step that adds the columns `names` declared on `table`.
+
+    Columns that already exist are skipped, like the if-not-exists checks of the
+    other steps, so a migration can be re-run safely.
+    """
+
+    def upgrade(connection):
+        existing = {
+            column["name"] for column in inspect(connection).get_columns(table.name)
+        }
+        for name in names:
+            if name in existing:
+                continue
+            column = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+            connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column}")
+
+    return upgrade
+
+
+def create_index(table, name):
+    """Build a migration step that creates the index `name` declared on `table`.
+
+    On PostgreSQL the index is built concurrently, which requires the step to be
+    run on an autocommit connection (ie as an 'online' migration).
+    """
+
+    index = next(index for index in table.indexes if index.name == name)
+
+    def upgrade(connection):
+        ddl = str(
+            CreateIndex(index, if_not_exists=True).compile(dialect=connection.dialect)
+        )
+        if connection.dialect.name == "postgresql":
+            ddl = ddl.replace("INDEX", "INDEX CONCURRENTLY", 1)
+        connection.exec_driver_sql(ddl)
+
+    return upgrade
+
+
+def run_all(*steps):
+    """Build a migration step running each of `steps` in order."""
+
+    def upgrade(connection):
+        for step in steps:
+            step(connection)
+
+    return upgrade
+
+
+def allow_many_likes(connection):
+    """Replace the unique constraint on likes.message_id with one on (user_id, message_id).
+
+    SQLite can't drop a constraint, so there the table is rebuilt instead.
+    """
+
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("DROP INDEX IF EXISTS ix_likes_user_message")
+        connection.exec_driver_sql("ALTER TABLE likes RENAME TO likes_old")
+        Likes.__table__.create(connection)
+        connection.exec_driver_sql(
+            "INSERT INTO likes (id, user_id, message_id) "
+            "SELECT id, user_id, message_id FROM likes_old"
+        )
+        connection.exec_driver_sql("DROP TABLE likes_old")
+        return
+
+    connection.exec_driver_sql(
+        "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key"
+    )
+    connection.exec_driver_sql(
+        "DROP INDEX CONCURRENTLY IF EXISTS ix_likes_user_message"
+    )
+    create_index(Likes.__table__, "ix_likes_user_message")(connection)
+
+
+# Versions must be unique and increasing; add new migrations at the end
+MIGRATIONS = [
+    Migration(
+        1,
+        "Create timeline_entries; fill it with 'flask home rebuild-timelines'",
+        create_table(TimelineEntry.__table__),
+        online=False,
+    ),
+    Migration(
+        2,
+        "Index messages by user and timestamp",
+        create_index(Message.__table__, "ix_messages_user_timestamp"),
+        online=True,
+    ),
+    Migration(
+        3,
+        "Index follows by following user",
+        create_index(Follows.__table__, "ix_follows_following"),
+        online=True,
+    ),
+    Migration(
+        4,
+        "Index likes by user",
+        create_index(Likes.__table__, "ix_likes_user_message"),
+        online=True,
+    ),
+    Migration(
+        5,
+        "Add counter columns to users; fill them with 'flask user recount'",
+        add_columns(
+            User.__table__,
+            "messages_count",
+            "followers_count",
+            "following_count",
+            "likes_count",
+        ),
+        online=False,
+    ),
+    Migration(
+        6,
+        "Let a message be liked by more than one user",
+        allow_many_likes,
+        online=True,
+    ),
+    Migration(
+        7,
+        "Add like_count to messages; fill it with 'flask message recount-likes'",
+        add_columns(Message.__table__, "like_count"),
+        online=False,
+    ),
+    Migration(
+        8,
+        "Index usernames by trigram for search (PostgreSQL only)",
+        create_trigram_index,
+        online=True,
+    ),
+    Migration(
+        9,
+        "Add searchable message text; its index is built by migration 12",
+        create_message_search,
+        online=True,
+    ),
+    Migration(
+        10,
+        "Add an updated_at version stamp to users",
+        add_columns(User.__table__, "updated_at"),
+        online=False,
+    ),
+    Migration(
+        11,
+        "Add a version stamp to messages",
+        add_columns(Message.__table__, "version"),
+        online=False,
+    ),
+    Migration(
+        12,
+        "Index message text for full-text search (PostgreSQL only)",
+        index_message_search,
+        online=True,
+    ),
+    Migration(
+        13,
+        "Mark the users whose messages are merged into timelines at read time",
+        run_all(add_columns(User.__table__, "merged_at_read"), mark_merged_authors),
+        online=False,
+    ),
+    Migration(
+        14,
+        "Index the users merged into timelines at read time",
+        create_index(User.__table__, "ix_users_merged_at_read"),
+        online=True,
+    ),
+]
+
+
+def applied_versions():
+    """Get the set of migration versions already applied to the database."""
+
+    schema_versions.create(db.engine, checkfirst=True)
+    with db.engine.connect() as connection:
+        return set(connection.execute(select(schema_versions.c.version)).scalars())
+
+
+def pending_migrations():
+    """Get the migrations not yet applied to the database, in order."""
+
+    applied = applied_versions()
+    return [
+        migration
+        for migration in sorted(MIGRATIONS, key=lambda migration: migration.version)
+        if migration.version not in applied
+    ]
+
+
+def record_migration(connection, migration):
+    """Record `migration` as applied."""
+
+    connection.execute(
+        insert(schema_versions).values(
+            version=migration.version,
+            description=migration.description,
+            applied_at=datetime.utcnow(),
+        )
+    )
+
+
+def upgrade():
+    """Apply every pending migration, returning the ones that were applied."""
+
+    migrations = pending_migrations()
+
+    for migration in migrations:
+        if migration.online:
+            autocommit = db.engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT"
+            )
+            with autocommit as connection:
+                migration.upgrade(connection)
+            with db.engine.begin() as connection:
+                record_migration(connection, migration)
+        else:
+            with db.engine.begin() as connection:
+                migration.upgrade(connection)
+                record_migration(connection, migration)
+
+    return migrations
+
+
+def stamp():
+    """Record every migration as applied, ie after `db.create_all()` on a new database."""
+
+    migrations = pending_migrations()
+    with db.engine.begin() as connection:
+        for migration in migrations:
+            record_migration(connection, migration)
+
+
+schema_cli = AppGroup("schema", help="Manage the database schema.")
+
+
+@schema_cli.command("upgrade")
+def upgrade_command():
+    """Apply any pending schema migrations."""
+
+    for migration in upgrade():
+        click.echo(f"Applied {migration.version}: {migration.description}")
+    click.echo("Schema is up to date.")
+
+
+@schema_cli.command("status")
+def status_command():
+    """List the schema migrations that have not been applied."""
+
+    migrations = pending_migrations()
+    for migration in migrations:
+        click.echo(f"Pending {migration.version}: {migration.description}")
+    if not migrations:
+        click.echo("Schema is up to date.")
+
+
+@schema_cli.command("stamp")
+def stamp_command():
+    """Mark every schema migration as applied without running it."""
+
+    stamp()
+    click.echo("Schema stamped as up to date.")
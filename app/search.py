@@ -0,0 +1,373 @@
+"""Username search and autocomplete for Warbler.
+
+Searching with LIKE '%text%' can't use a b-tree index, so every search would
+scan the whole users table. On PostgreSQL, usernames are instead indexed with
+a pg_trgm GIN index (ix_users_username_trgm), which ILIKE searches can use.
+SQLite has no such index, so each worker keeps an in-memory n-gram index of
+usernames instead: every 1 to 3 character substring maps to the ids of the
+users containing it, so a search reads only the postings of its own n-grams.
+
+Autocomplete ('/users/suggest') is served from an in-memory trie of usernames,
+where each node keeps its best SUGGEST_LIMIT matches (most followed first), so
+a lookup only walks the characters of the prefix.
+
+Both are built on first use in each worker and updated as users sign up, are
+renamed or are deleted in that worker. Changes made by other workers, and
+follower counts used for ranking, are picked up when the index is rebuilt
+after SEARCH_INDEX_MAX_AGE seconds, in a background thread so that no request
+waits for it.
+"""
+
+from bisect import insort
+from threading import Lock, Thread, current_thread
+from time import monotonic
+from flask import current_app
+from sqlalchemy import DDL, event, select
+from app import db
+from app.models import User
+
+NGRAM_SIZE = 3
+
+# ILIKE '%text%' searches on username can use this index, for text of 3 or more characters
+TRIGRAM_INDEX = DDL(
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gin (username gin_trgm_ops)"
+)
+
+event.listen(
+    User.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+event.listen(
+    User.__table__, "after_create", TRIGRAM_INDEX.execute_if(dialect="postgresql")
+)
+
+
+def create_trigram_index(connection):
+    """Migration step creating the username trigram index, on PostgreSQL only.
+
+    The index is built concurrently, so this must run as an 'online' migration.
+    """
+
+    if connection.dialect.name != "postgresql":
+        return
+
+    connection.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    connection.exec_driver_sql(
+        str(TRIGRAM_INDEX.statement).replace("INDEX", "INDEX CONCURRENTLY", 1)
+    )
+
+
+def ngrams(text):
+    """Get every substring of `text` of 1 to NGRAM_SIZE characters."""
+
+    return {
+        text[start : start + size]
+        for size in range(1, NGRAM_SIZE + 1)
+        for start in range(len(text) - size + 1)
+    }
+
+
+class NgramIndex:
+    """In-memory substring index of usernames, for databases without trigram indexes."""
+
+    def __init__(self):
+        self.postings = {}
+        self.names = {}
+
+    def add(self, user_id, username):
+        """Index `username` for `user_id`."""
+
+        name = username.lower()
+        self.names[user_id] = name
+        for gram in ngrams(name):
+            self.postings.setdefault(gram, set()).add(user_id)
+
+    def remove(self, user_id):
+        """Remove `user_id` from the index, if it was indexed."""
+
+        name = self.names.pop(user_id, None)
+        if name is None:
+            return
+
+        for gram in ngrams(name):
+            ids = self.postings[gram]
+            ids.discard(user_id)
+            if not ids:
+                del self.postings[gram]
+
+    def search(self, text):
+        """Get the ids of users whose username contains `text`, ignoring case.
+
+        Text of up to NGRAM_SIZE characters is itself an n-gram. Longer text is
+        matched by intersecting the postings of its n-grams, smallest first,
+        then checking the few candidates left against their full usernames.
+        """
+
+        text = text.lower()
+        if len(text) <= NGRAM_SIZE:
+            return set(self.postings.get(text, ()))
+
+        grams = {
+            text[start : start + NGRAM_SIZE]
+            for start in range(len(text) - NGRAM_SIZE + 1)
+        }
+        postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return {user_id for user_id in candidates if text in self.names[user_id]}
+
+
+class TrieNode:
+    """A node of a PrefixTrie, for the prefix spelled by the path to it."""
+
+    __slots__ = ("children", "entries", "top")
+
+    def __init__(self):
+        self.children = {}
+        # users whose username ends at this node, and the best matches under it
+        self.entries = []
+        self.top = []
+
+
+class PrefixTrie:
+    """Trie of usernames keeping the best `limit` matches for every prefix.
+
+    Entries are (rank, user_id, username) tuples, and a lower rank is better.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.root = TrieNode()
+
+    def add(self, entry):
+        """Add an entry, updating the best matches of each of its prefixes."""
+
+        node = self.root
+        for char in entry[2].lower():
+            node = node.children.setdefault(char, TrieNode())
+            insort(node.top, entry)
+            del node.top[self.limit :]
+        node.entries.append(entry)
+
+    def remove(self, entry):
+        """Remove an entry, refilling the best matches of the prefixes it was in.
+
+        A node's best matches are among its own entries and its children's best
+        matches, so they're refilled from the deepest node upwards.
+        """
+
+        path = [self.root]
+        for char in entry[2].lower():
+            node = path[-1].children.get(char)
+            if node is None:
+                return
+            path.append(node)
+
+        if entry in path[-1].entries:
+            path[-1].entries.remove(entry)
+
+        for depth in range(len(path) - 1, 0, -1):
+            node = path[depth]
+            if entry in node.top:
+                candidates = node.entries + [
+                    child_entry
+                    for child in node.children.values()
+                    for child_entry in child.top
+                ]
+                node.top = sorted(candidates)[: self.limit]
+            if not node.top:
+                del path[depth - 1].children[entry[2].lower()[depth - 1]]
+
+    def suggest(self, prefix):
+        """Get the best entries whose username starts with `prefix`, ignoring case."""
+
+        node = self.root
+        for char in prefix.lower():
+            node = node.children.get(char)
+            if node is None:
+                return []
+
+        return list(node.top)
+
+
+class UserIndex:
+    """A worker's username search indexes, built on first use.
+
+    Only the first build happens in a request. Once the indexes are older than
+    SEARCH_INDEX_MAX_AGE, they're rebuilt in a background thread while requests
+    keep using the old ones, and the new ones are swapped in when ready, along
+    with any changes made in this worker while they were being built.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.built_at = None
+        self.trie = None
+        self.ngrams = None
+        self.entries = {}
+        self.rebuild_thread = None
+        # changes made during a rebuild, by user id: (user_id, username,
+        # followers_count) for an added or renamed user, or None for a deleted one
+        self.pending = {}
+
+    def clear(self):
+        """Drop the indexes, so they're rebuilt when next used."""
+
+        with self.lock:
+            self.built_at = None
+            self.trie = None
+            self.ngrams = None
+            self.entries = {}
+            # a rebuild still running is discarded when it finishes
+            self.rebuild_thread = None
+            self.pending = {}
+
+    def ensure_built(self):
+        """Build the indexes if unbuilt, or start rebuilding them if too old."""
+
+        max_age = current_app.config["SEARCH_INDEX_MAX_AGE"]
+        with self.lock:
+            if self.built_at is None:
+                # there's nothing to search yet, so the first build is waited for
+                self._swap(self.build())
+                return
+
+            if self.rebuild_thread is not None or monotonic() - self.built_at < max_age:
+                return
+
+            self.rebuild_thread = Thread(
+                target=self.rebuild,
+                args=(current_app._get_current_object(),),
+                daemon=True,
+            )
+            self.rebuild_thread.start()
+
+    def build(self):
+        """Read the users table into a new UserIndex, not yet shared with requests."""
+
+        index = UserIndex()
+        index.trie = PrefixTrie(current_app.config["SUGGEST_LIMIT"])
+        index.ngrams = NgramIndex() if not uses_trigram_index() else None
+        users = db.session.execute(select(User.id, User.username, User.followers_count))
+        for user_id, username, followers_count in users:
+            index._add(user_id, username, followers_count)
+        index.built_at = monotonic()
+        return index
+
+    def rebuild(self, app):
+        """Build new indexes in the background, and swap them in for the old ones."""
+
+        try:
+            with app.app_context():
+                index = self.build()
+        except Exception:
+            app.logger.exception("Failed to rebuild the user search index")
+            index = None
+
+        with self.lock:
+            if self.rebuild_thread is not current_thread():
+                return
+
+            if index is not None:
+                for user_id, row in self.pending.items():
+                    index._remove(user_id)
+                    if row is not None:
+                        index._add(*row)
+                self._swap(index)
+            self.rebuild_thread = None
+            self.pending = {}
+
+    def _swap(self, index):
+        self.trie = index.trie
+        self.ngrams = index.ngrams
+        self.entries = index.entries
+        self.built_at = index.built_at
+
+    def update(self, user):
+        """Add or re-index `user`, ie after they sign up or are renamed."""
+
+        with self.lock:
+            if self.built_at is None:
+                return
+            self._remove(user.id)
+            self._add(user.id, user.username, user.followers_count)
+            if self.rebuild_thread is not None:
+                self.pending[user.id] = (user.id, user.username, user.followers_count)
+
+    def remove(self, user_id):
+        """Remove a user from the indexes, ie after they're deleted."""
+
+        with self.lock:
+            if self.built_at is not None:
+                self._remove(user_id)
+            if self.rebuild_thread is not None:
+                self.pending[user_id] = None
+
+    def _add(self, user_id, username, followers_count):
+        entry = ((-followers_count, username.lower()), user_id, username)
+        self.entries[user_id] = entry
+        self.trie.add(entry)
+        if self.ngrams is not None:
+            self.ngrams.add(user_id, username)
+
+    def _remove(self, user_id):
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return
+
+        self.trie.remove(entry)
+        if self.ngrams is not None:
+            self.ngrams.remove(user_id)
+
+
+user_index = UserIndex()
+
+
+def uses_trigram_index():
+    """Can the database search usernames with its own trigram index?"""
+
+    return db.engine.dialect.name == "postgresql"
+
+
+def like_pattern(text):
+    """Build a LIKE pattern matching `text` anywhere, with its wildcards escaped."""
+
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def search_users(text):
+    """Build a query of the users whose username contains `text`, ignoring case."""
+
+    if uses_trigram_index():
+        return User.query.filter(User.username.ilike(like_pattern(text), escape="\\"))
+
+    user_index.ensure_built()
+    return User.query.filter(User.id.in_(user_index.ngrams.search(text)))
+
+
+def suggest_users(prefix, limit=None):
+    """Get the best (user_id, username) matches for a username prefix."""
+
+    user_index.ensure_built()
+    # a limit under 1 would slice from the end of the matches, so it's raised to 1
+    limit = max(
+        1, min(limit or current_app.config["SUGGEST_LIMIT"], user_index.trie.limit)
+    )
+    return [
+        (user_id, username)
+        for _, user_id, username in user_index.trie.suggest(prefix)[:limit]
+    ]
+
+
+def index_user(user):
+    """Update the search indexes for a new or renamed user."""
+
+    user_index.update(user)
+
+
+def unindex_user(user_id):
+    """Remove a deleted user from the search indexes."""
+
+    user_index.remove(user_id)
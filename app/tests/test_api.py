@@ -0,0 +1,217 @@
+"""JSON API tests."""
+
+# run these tests with:
+# python3 -m unittest app.tests.test_api
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+from app import db, init_app
+from app.models import Follows, Likes, Message, TimelineEntry, User
+from app.timeline import rebuild_timelines
+from app.user.user_util import CURR_USER_KEY
+
+# Environment variables are handled in config.py and .env, no need to set here
+app = init_app("test.env")
+
+# Context is pushed so that it exists to create the tables
+app.app_context().push()
+
+# Create our tables, dropping first to ensure they are newly created
+db.drop_all()
+db.create_all()
+
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        """Create test client, add a user following another with some messages."""
+
+        self.client = app.test_client()
+
+        self.testuser = self.add_user("testuser")
+        self.author = self.add_user("author")
+        self.testuser.following.append(self.author)
+
+        start = datetime(2022, 9, 1)
+        for n in range(3):
+            db.session.add(
+                Message(
+                    text=f"Warble {n}",
+                    user_id=self.author.id,
+                    timestamp=start + timedelta(minutes=n),
+                )
+            )
+        db.session.commit()
+
+        rebuild_timelines()
+        db.session.commit()
+
+        self.testuser_id = self.testuser.id
+        self.author_id = self.author.id
+        # requests should load their own rows, rather than find these in the session
+        db.session.expunge_all()
+
+    def add_user(self, name):
+        """Add a user to the db for testing."""
+
+        user = User(email=f"{name}@test.com", username=name, password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+    def test_timeline(self):
+        """Is the timeline returned a page at a time, with each author listed once?"""
+
+        per_page = app.config["MESSAGES_PER_PAGE"]
+        app.config["MESSAGES_PER_PAGE"] = 2
+        try:
+            with self.client as c:
+                self.login(c)
+
+                resp = c.get("/api/v1/timeline")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.mimetype, "application/json")
+                data = resp.json
+                self.assertEqual(
+                    [msg["text"] for msg in data["messages"]], ["Warble 2", "Warble 1"]
+                )
+                self.assertEqual(
+                    data["users"],
+                    [
+                        {
+                            "id": self.author_id,
+                            "username": "author",
+                            "image_url": "/static/images/default-pic.png",
+                        }
+                    ],
+                )
+                self.assertEqual(data["liked"], [])
+
+                # no rows were loaded as ORM objects
+                self.assertFalse(
+                    any(
+                        isinstance(obj, Message)
+                        for obj in db.session.identity_map.values()
+                    )
+                )
+
+                resp = c.get(f"/api/v1/timeline?before={data['next']}")
+                self.assertEqual(
+                    [msg["text"] for msg in resp.json["messages"]], ["Warble 0"]
+                )
+                self.assertIsNone(resp.json["next"])
+        finally:
+            app.config["MESSAGES_PER_PAGE"] = per_page
+
+    def test_login_required(self):
+        """Are the logged-in user's timeline and follow lists refused to anonymous users?"""
+
+        for url in (
+            "/api/v1/timeline",
+            f"/api/v1/users/{self.author_id}/following",
+            f"/api/v1/users/{self.author_id}/followers",
+        ):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(resp.json, {"error": "Unauthorized"})
+
+    def test_user_messages(self):
+        """Are a user's messages returned, and a missing user not found?"""
+
+        resp = self.client.get(f"/api/v1/users/{self.author_id}/messages")
+        self.assertEqual(len(resp.json["messages"]), 3)
+        self.assertEqual(resp.json["users"][0]["username"], "author")
+
+        resp = self.client.get("/api/v1/users/999999/messages")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json, {"error": "Not Found"})
+
+        resp = self.client.get(f"/api/v1/users/{self.author_id}/messages?before=bad")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_unknown_paths(self):
+        """Are unknown API paths and methods reported as JSON, and other paths not?"""
+
+        resp = self.client.get("/api/v1/nope")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json, {"error": "Not Found"})
+
+        resp = self.client.post("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 405)
+        self.assertEqual(resp.json, {"error": "Method Not Allowed"})
+
+        resp = self.client.get("/nope")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.mimetype, "text/html")
+
+    def test_user_likes(self):
+        """Are the messages a user liked returned, marked as liked by the viewer?"""
+
+        msg_id = Message.query.filter_by(text="Warble 1").one().id
+        db.session.add(Likes(user_id=self.testuser_id, message_id=msg_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f"/api/v1/users/{self.testuser_id}/likes")
+            self.assertEqual([msg["id"] for msg in resp.json["messages"]], [msg_id])
+            self.assertEqual(resp.json["liked"], [msg_id])
+
+    def test_follow_lists(self):
+        """Are follow lists returned a page at a time, in username order?"""
+
+        for name in ("fan1", "fan2"):
+            fan = self.add_user(name)
+            db.session.add(
+                Follows(user_being_followed_id=self.author_id, user_following_id=fan.id)
+            )
+        db.session.commit()
+
+        per_page = app.config["USERS_PER_PAGE"]
+        app.config["USERS_PER_PAGE"] = 2
+        try:
+            with self.client as c:
+                self.login(c)
+
+                resp = c.get(f"/api/v1/users/{self.author_id}/followers")
+                data = resp.json
+                self.assertEqual(
+                    [user["username"] for user in data["users"]], ["fan1", "fan2"]
+                )
+                self.assertEqual(data["following"], [])
+                self.assertEqual(data["next"], "fan2")
+
+                resp = c.get(f"/api/v1/users/{self.author_id}/followers?after=fan2")
+                self.assertEqual(
+                    [user["username"] for user in resp.json["users"]], ["testuser"]
+                )
+                self.assertIsNone(resp.json["next"])
+
+                resp = c.get(f"/api/v1/users/{self.testuser_id}/following")
+                self.assertEqual(
+                    [user["username"] for user in resp.json["users"]], ["author"]
+                )
+                self.assertEqual(resp.json["following"], [self.author_id])
+        finally:
+            app.config["USERS_PER_PAGE"] = per_page
+
+    def tearDown(self):
+        """Clear testing data from the tables."""
+
+        db.session.rollback()
+        TimelineEntry.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        db.session.commit()
+
+        # SQLite reuses the ids of deleted rows, so drop the deleted objects from the
+        # session rather than letting the next test's rows collide with them
+        db.session.expunge_all()
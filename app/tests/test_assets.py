@@ -0,0 +1,122 @@
+"""Static asset pipeline tests."""
+
+# run these tests with:
+# python3 -m unittest app.tests.test_assets
+
+
+import gzip
+from os import path
+from re import search
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from app import db, init_app
+from app.assets import build, load_manifest
+from app.models import User
+from app.user.user_util import CURR_USER_KEY
+
+# Environment variables are handled in config.py and .env, no need to set here
+app = init_app("test.env")
+
+# Context is pushed so that it exists to create the tables
+app.app_context().push()
+
+# Create our tables, dropping first to ensure they are newly created
+db.drop_all()
+db.create_all()
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        """Create test client."""
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        User.query.delete()
+        db.session.commit()
+        db.session.expunge_all()
+
+    def stylesheet_url(self):
+        """Get the stylesheet URL that pages link to."""
+
+        resp = self.client.get("/login")
+        return search(r'href="(/[^"]*style[^"]*\.css)"', resp.text).group(1)
+
+    def test_build(self):
+        """Are static files copied under fingerprinted names, with their URLs rewritten?"""
+
+        with TemporaryDirectory() as assets_dir:
+            manifest = build(app.static_folder, assets_dir)
+
+            built_css = manifest.assets["stylesheets/style.css"]
+            self.assertRegex(built_css, r"^stylesheets/style\.[0-9a-f]{12}\.css$")
+            with open(path.join(assets_dir, built_css)) as file:
+                css = file.read()
+            self.assertIn(f'/assets/{manifest.assets["images/nav-bg.png"]}', css)
+            self.assertNotIn("/static/", css)
+
+            # images are already compressed, so only the stylesheet has variants
+            self.assertIn("gzip", manifest.encodings[built_css])
+            self.assertTrue(path.exists(path.join(assets_dir, built_css + ".gz")))
+            self.assertNotIn(manifest.assets["images/nav-bg.png"], manifest.encodings)
+
+            loaded = load_manifest(assets_dir)
+            self.assertEqual(loaded.assets, manifest.assets)
+
+            # the same contents always get the same names
+            self.assertEqual(build(app.static_folder, assets_dir).assets, loaded.assets)
+
+    def test_serve_asset(self):
+        """Are fingerprinted assets cached for good, and compressed when accepted?"""
+
+        url = self.stylesheet_url()
+        self.assertRegex(url, r"^/assets/stylesheets/style\.[0-9a-f]{12}\.css$")
+
+        plain = self.client.get(url)
+        self.assertEqual(plain.status_code, 200)
+        self.assertEqual(plain.mimetype, "text/css")
+        self.assertIsNone(plain.content_encoding)
+        self.assertIn("immutable", plain.headers["Cache-Control"])
+        self.assertEqual(plain.cache_control.max_age, 365 * 24 * 60 * 60)
+        self.assertIn("Accept-Encoding", plain.headers["Vary"])
+
+        gzipped = self.client.get(url, headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(gzipped.content_encoding, "gzip")
+        self.assertEqual(gzipped.mimetype, "text/css")
+        self.assertEqual(gzip.decompress(gzipped.data), plain.data)
+
+        plain.close()
+        gzipped.close()
+
+    def test_unknown_asset(self):
+        """Are files that aren't in the build not found?"""
+
+        self.assertEqual(
+            self.client.get("/assets/stylesheets/style.css").status_code, 404
+        )
+        self.assertEqual(self.client.get("/assets/manifest.json").status_code, 404)
+
+    def test_no_store_when_logged_in(self):
+        """Are only a logged-in user's pages kept out of caches?"""
+
+        user = User(email="test@test.com", username="testuser", password="HASHED")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+        anonymous = self.client.get("/")
+        self.assertNotIn("no-store", anonymous.headers.get("Cache-Control", ""))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get("/")
+            self.assertIn("no-store", resp.headers["Cache-Control"])
+
+            asset = c.get(self.stylesheet_url())
+            self.assertNotIn("no-store", asset.headers["Cache-Control"])
+            asset.close()
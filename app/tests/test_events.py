@@ -0,0 +1,141 @@
+"""Server-Sent Events tests."""
+
+# run these tests with:
+# python3 -m unittest app.tests.test_events
+
+
+from unittest import TestCase
+from app import db, init_app
+from app.events import Broker
+from app.models import Follows, Message, TimelineEntry, User
+from app.user.user_util import CURR_USER_KEY
+
+# Environment variables are handled in config.py and .env, no need to set here
+app = init_app("test.env")
+
+# Context is pushed so that it exists to create the tables
+app.app_context().push()
+
+# Create our tables, dropping first to ensure they are newly created
+db.drop_all()
+db.create_all()
+
+
+class EventsTestCase(TestCase):
+    """Test streaming new messages to followers."""
+
+    def setUp(self):
+        """Create test clients for a user and someone they follow."""
+
+        self.client = app.test_client()
+        self.author_client = app.test_client()
+
+        follower = self.add_user("follower")
+        author = self.add_user("author")
+        other = self.add_user("other")
+        db.session.add(
+            Follows(user_being_followed_id=author.id, user_following_id=follower.id)
+        )
+        db.session.commit()
+
+        self.follower_id = follower.id
+        self.author_id = author.id
+        self.other_id = other.id
+        self.broker = app.extensions["events"].broker
+        db.session.expunge_all()
+
+    def add_user(self, name):
+        """Add a user to the db for testing."""
+
+        user = User(email=f"{name}@test.com", username=name, password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def open_stream(self):
+        """Open the follower's stream, reading up to its first event."""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.follower_id
+
+        resp = self.client.get("/messages/stream", buffered=False)
+        chunks = iter(resp.response)
+        self.assertEqual(next(chunks), b"retry: 3000\n\n")
+        return resp, chunks
+
+    def post_as(self, user_id, text):
+        with self.author_client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        self.author_client.post("/messages/new", data={"text": text})
+
+    def test_broker(self):
+        """Are messages delivered only to the streams following their author?"""
+
+        broker = Broker(queue_size=1)
+        following = broker.subscribe([1, 2])
+        not_following = broker.subscribe([3])
+
+        broker.deliver(2, 10)
+        broker.deliver(2, 11)
+        self.assertEqual(following.get(0), 10)
+        # the queue was full, so the second id was dropped
+        self.assertIsNone(following.get(0))
+        self.assertIsNone(not_following.get(0))
+
+        broker.unsubscribe(following)
+        broker.unsubscribe(not_following)
+        self.assertEqual(broker.subscription_count(), 0)
+
+    def test_stream_new_message(self):
+        """Are new messages of followed users streamed as they're posted?"""
+
+        resp, chunks = self.open_stream()
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        self.assertEqual(resp.headers["Cache-Control"], "no-cache")
+
+        self.post_as(self.other_id, "Not followed")
+        self.post_as(self.author_id, "Followed")
+        msg_id = Message.query.filter_by(text="Followed").one().id
+
+        self.assertEqual(
+            next(chunks),
+            f"id: {msg_id}\nevent: message\ndata: {msg_id}\n\n".encode(),
+        )
+
+        resp.close()
+        self.assertEqual(self.broker.subscription_count(), 0)
+
+    def test_stream_keepalive(self):
+        """Is an idle stream kept alive, and ended after EVENTS_STREAM_SECONDS?"""
+
+        heartbeat = app.config["EVENTS_HEARTBEAT_SECONDS"]
+        duration = app.config["EVENTS_STREAM_SECONDS"]
+        app.config["EVENTS_HEARTBEAT_SECONDS"] = 0.01
+        app.config["EVENTS_STREAM_SECONDS"] = 0.05
+        try:
+            resp, chunks = self.open_stream()
+            self.assertTrue(all(chunk == b": keepalive\n\n" for chunk in chunks))
+            self.assertEqual(self.broker.subscription_count(), 0)
+            resp.close()
+        finally:
+            app.config["EVENTS_HEARTBEAT_SECONDS"] = heartbeat
+            app.config["EVENTS_STREAM_SECONDS"] = duration
+
+    def test_stream_unauthorized(self):
+        """Are anonymous users refused a stream?"""
+
+        self.assertEqual(self.client.get("/messages/stream").status_code, 401)
+
+    def tearDown(self):
+        """Clear testing data from the tables."""
+
+        db.session.rollback()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        # SQLite reuses the ids of deleted rows, so drop the deleted objects from the
+        # session rather than letting the next test's rows collide with them
+        db.session.expunge_all()
@@ -0,0 +1,170 @@
+"""Bulk loader tests."""
+
+# run these tests with:
+# python3 -m unittest app.tests.test_loader
+
+
+from io import StringIO
+from os import path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from sqlalchemy import inspect
+from app import db, init_app
+from app.fulltext import search_messages
+from app.loader import Progress, copy_csv, load
+from app.models import Follows, Message, TimelineEntry, User
+
+# Environment variables are handled in config.py and .env, no need to set here
+app = init_app("test.env")
+
+# Context is pushed so that it exists to create the tables
+app.app_context().push()
+
+# Create our tables, dropping first to ensure they are newly created
+db.drop_all()
+db.create_all()
+
+USERS_CSV = """email,username,image_url,password,bio,header_image_url,location
+one@test.com,one,/static/images/default-pic.png,HASHED_PASSWORD,Bio,/static/images/warbler-hero.jpg,Here
+two@test.com,two,/static/images/default-pic.png,HASHED_PASSWORD,Bio,/static/images/warbler-hero.jpg,There
+three@test.com,three,/static/images/default-pic.png,HASHED_PASSWORD,Bio,/static/images/warbler-hero.jpg,Everywhere
+"""
+
+MESSAGES_CSV = """text,timestamp,user_id
+"Hello, world",2017-01-21 11:04:53.522807,1
+Singing birds,2017-10-21 07:01:06.023966,1
+Quiet day,2018-02-01 09:00:00,2
+"""
+
+FOLLOWS_CSV = """user_being_followed_id,user_following_id
+1,2
+1,3
+2,3
+"""
+
+
+class FakeCursor:
+    """Stands in for a psycopg2 cursor, reading what COPY would be sent."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, statement):
+        self.connection.statements.append(statement)
+
+    def copy_expert(self, statement, file):
+        self.connection.statements.append(statement)
+        # read in small pieces, as psycopg2 does with its own buffer size
+        while data := file.read(16):
+            self.connection.copied += data
+        self.rowcount = self.connection.copied.count("\n")
+
+
+class FakeConnection:
+    """Stands in for the raw connection of a PostgreSQL engine."""
+
+    def __init__(self):
+        self.statements = []
+        self.copied = ""
+        self.committed = False
+        self.closed = False
+
+    def raw_connection(self):
+        return self
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def close(self):
+        self.closed = True
+
+
+class LoaderTestCase(TestCase):
+    """Test bulk loading CSV data."""
+
+    def setUp(self):
+        """Write the sample CSVs to a temporary folder."""
+
+        self.data_dir = TemporaryDirectory()
+        for name, contents in [
+            ("users.csv", USERS_CSV),
+            ("messages.csv", MESSAGES_CSV),
+            ("follows.csv", FOLLOWS_CSV),
+        ]:
+            with open(path.join(self.data_dir.name, name), "w") as file:
+                file.write(contents)
+
+    def test_load(self):
+        """Are the CSVs loaded in chunks, with counters and timelines rebuilt?"""
+
+        load(self.data_dir.name, chunk_size=2, rebuild_chunk_size=2)
+
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Follows.query.count(), 3)
+
+        user = User.query.filter(User.username == "one").one()
+        self.assertEqual((user.messages_count, user.followers_count), (2, 2))
+
+        # 'three' follows both authors, so sees all three messages
+        three = User.query.filter(User.username == "three").one()
+        self.assertEqual(
+            TimelineEntry.query.filter(TimelineEntry.user_id == three.id).count(), 3
+        )
+        self.assertEqual(
+            [msg.text for msg in search_messages("birds").items], ["Singing birds"]
+        )
+
+    def test_copy_csv(self):
+        """Is a CSV streamed to COPY after its header, with the rows counted?"""
+
+        connection = FakeConnection()
+        progress = Progress("follows")
+        copy_csv(connection, Follows.__table__, StringIO(FOLLOWS_CSV), progress)
+
+        self.assertEqual(
+            connection.statements[-1],
+            "COPY follows (user_being_followed_id, user_following_id) "
+            "FROM STDIN WITH (FORMAT csv)",
+        )
+        self.assertEqual(connection.copied, "1,2\n1,3\n2,3\n")
+        self.assertEqual(progress.rows, 3)
+        self.assertTrue(connection.committed)
+        self.assertTrue(connection.closed)
+
+    def test_indexes_rebuilt(self):
+        """Are the indexes dropped for loading built again afterwards?"""
+
+        load(self.data_dir.name)
+
+        index_names = [
+            index["name"] for index in inspect(db.engine).get_indexes("messages")
+        ]
+        self.assertIn("ix_messages_user_timestamp", index_names)
+        index_names = [
+            index["name"]
+            for index in inspect(db.engine).get_indexes("timeline_entries")
+        ]
+        self.assertIn("ix_timeline_entries_user_timestamp", index_names)
+
+    def tearDown(self):
+        """Remove the CSVs and clear the loaded data."""
+
+        self.data_dir.cleanup()
+
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        db.session.commit()
+        db.session.expunge_all()
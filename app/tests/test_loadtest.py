@@ -0,0 +1,77 @@
+"""Load test harness tests."""
+
+# run these tests with:
+# python3 -m unittest app.tests.test_loadtest
+
+
+from unittest import TestCase
+from app import db, init_app
+from app.loadtest import percentile, run
+from app.models import Follows, Message, User
+
+# Environment variables are handled in config.py and .env, no need to set here
+app = init_app("test.env")
+
+# Context is pushed so that it exists to create the tables
+app.app_context().push()
+
+# Create our tables, dropping first to ensure they are newly created
+db.drop_all()
+db.create_all()
+
+
+class LoadTestTestCase(TestCase):
+    """Test running a small load test."""
+
+    def setUp(self):
+        """Add users to log in as, and a message to like."""
+
+        with app.app_context():
+            for name in ["first", "second"]:
+                User.signup(
+                    username=name,
+                    email=f"{name}@test.com",
+                    password="password",
+                    image_url=None,
+                )
+            db.session.commit()
+            db.session.add(Message(text="Like me", user_id=User.query.first().id))
+            db.session.commit()
+
+    def test_run(self):
+        """Does each simulated user log in and take its actions, without errors?"""
+
+        report = run(app, users=2, duration=30, max_requests=5)
+
+        self.assertEqual(report["failed_logins"], 0)
+        self.assertEqual(report["routes"]["login"]["requests"], 2)
+        self.assertEqual(report["total"]["requests"], 2 + 2 * 5)
+        self.assertEqual(report["total"]["errors"], 0)
+        self.assertLessEqual(report["total"]["p50_ms"], report["total"]["p99_ms"])
+
+    def test_wrong_password(self):
+        """Are users that can't log in reported, rather than acting logged out?"""
+
+        report = run(app, users=2, duration=30, max_requests=5, password="wrongpw")
+
+        self.assertEqual(report["failed_logins"], 2)
+        self.assertEqual(list(report["routes"]), ["login"])
+
+    def test_percentile(self):
+        """Are nearest-rank percentiles picked from the sorted values?"""
+
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+
+    def tearDown(self):
+        """Clear testing data from User, Message, Follows tables."""
+
+        with app.app_context():
+            db.session.rollback()
+            User.query.delete()
+            Message.query.delete()
+            Follows.query.delete()
+            db.session.commit()
+            db.session.expunge_all()
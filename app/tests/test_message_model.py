@@ -62,6 +62,37 @@ class MessageModelTestCase(TestCase):
 
         self.assertIn(msg, user2.likes)
 
+    def test_liked_ids_among(self):
+        """Are only the liked messages among a batch of ids returned?"""
+
+        user = self.add_user("test")
+        user2 = self.add_user("test2")
+        liked = self.add_msg("Liked", user.id)
+        not_liked = self.add_msg("Not liked", user.id)
+        user2.likes.append(liked)
+        db.session.commit()
+
+        self.assertEqual(user2.liked_ids_among([liked.id, not_liked.id]), {liked.id})
+        self.assertEqual(user.liked_ids_among([liked.id, not_liked.id]), set())
+
+    def test_count_likes(self):
+        """Can a message be liked by several users, and are its likes counted?"""
+
+        user = self.add_user("test")
+        msg = self.add_msg("Popular", user.id)
+        unliked = self.add_msg("Unpopular", user.id)
+        likers = [self.add_user("test2"), self.add_user("test3")]
+        msg.liked_by.extend(likers)
+        db.session.commit()
+
+        self.assertEqual(
+            Message.count_likes([msg.id, unliked.id]), {msg.id: 2, unliked.id: 0}
+        )
+
+        Message.recount_likes(Message.id == msg.id)
+        db.session.commit()
+        self.assertEqual(msg.like_count, 2)
+
     def test_liked_by_back_populate(self):
         """Does adding a message to a User's likes list back-populate to a Message's liked_by?"""
 
@@ -81,3 +112,7 @@ class MessageModelTestCase(TestCase):
         Message.query.delete()
         Follows.query.delete()
         db.session.commit()
+
+        # SQLite reuses the ids of deleted rows, so drop the deleted objects from the
+        # session rather than letting the next test's rows collide with them
+        db.session.expunge_all()
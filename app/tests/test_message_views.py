@@ -6,7 +6,9 @@
 
 from unittest import TestCase
 from app import db, init_app
-from app.models import Message, User
+from app.fulltext import rebuild
+from app.models import Message, User, TimelineEntry
+from app.timeline import rebuild_timelines
 from app.user.user_util import CURR_USER_KEY
 
 # Environment variables are handled in config.py and .env, no need to set here
@@ -66,6 +68,57 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def test_show_message(self):
+        """Does a message's page show it?"""
+
+        msg_id = self.add_msg("Worth a look", self.testuser.id).id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Worth a look", resp.text)
+
+    def test_show_message_not_modified(self):
+        """Is a message's page revalidated by its ETag until it's liked?"""
+
+        other_id = self.add_user("other").id
+        msg_id = self.add_msg("Worth a look", other_id).id
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/messages/{msg_id}")
+            etag = resp.headers["ETag"]
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
+            self.assertNotIn("no-store", resp.headers["Cache-Control"])
+
+            cached = c.get(f"/messages/{msg_id}", headers={"If-None-Match": etag})
+            self.assertEqual(cached.status_code, 304)
+            self.assertEqual(cached.data, b"")
+
+            c.post(f"/users/add_like/{msg_id}", headers={"Referer": "/"})
+            liked = c.get(f"/messages/{msg_id}", headers={"If-None-Match": etag})
+            self.assertEqual(liked.status_code, 200)
+            self.assertNotEqual(liked.headers["ETag"], etag)
+
+            # the page differs for someone who isn't logged in
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+            anonymous = c.get(
+                f"/messages/{msg_id}", headers={"If-None-Match": liked.headers["ETag"]}
+            )
+            self.assertEqual(anonymous.status_code, 200)
+
+    def test_show_missing_message(self):
+        """Is a message that doesn't exist not found?"""
+
+        self.assertEqual(self.client.get("/messages/999").status_code, 404)
+
     def test_delete_message(self):
         """Can a user delete their message?"""
 
@@ -81,9 +134,181 @@ class MessageViewTestCase(TestCase):
             msg_query = Message.query.one_or_none()
             self.assertIsNone(msg_query)
 
+    def test_delete_others_message(self):
+        """Are users kept from deleting messages that aren't theirs, or don't exist?"""
+
+        other = self.add_user("other")
+        msg = self.add_msg("Not yours", other.id)
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/messages/{msg_id}/delete", follow_redirects=True)
+            self.assertIn("Access unauthorized", resp.text)
+            self.assertIsNotNone(Message.query.get(msg_id))
+
+            resp = c.post("/messages/999999/delete")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_message_fans_out(self):
+        """Is a new message pushed to the timelines of the author's followers?"""
+
+        follower = self.add_user("follower")
+        follower.following.append(self.testuser)
+        db.session.commit()
+        follower_id = follower.id
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Fanned out"})
+            msg = Message.query.one()
+            timeline_users = {
+                entry.user_id
+                for entry in TimelineEntry.query.filter_by(message_id=msg.id)
+            }
+            self.assertEqual(timeline_users, {testuser_id, follower_id})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            resp = c.get("/")
+            self.assertIn("Fanned out", resp.text)
+
+    def test_message_merged_at_read(self):
+        """Are messages of widely-followed users merged into timelines when read?"""
+
+        follower = self.add_user("follower")
+        follower.following.append(self.testuser)
+        User.recount(User.id == self.testuser.id)
+        db.session.commit()
+        follower_id = follower.id
+
+        app.config["TIMELINE_FANOUT_MAX_FOLLOWERS"] = 0
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                c.post("/messages/new", data={"text": "Merged at read"})
+                entry = TimelineEntry.query.filter_by(user_id=follower_id).first()
+                self.assertIsNone(entry)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower_id
+
+                resp = c.get("/")
+                self.assertIn("Merged at read", resp.text)
+        finally:
+            app.config["TIMELINE_FANOUT_MAX_FOLLOWERS"] = 10000
+
+    def test_merged_author_back_under_limit(self):
+        """Are messages posted while merged at read still shown once their author drops under the limit?"""
+
+        follower = self.add_user("follower")
+        follower.following.append(self.testuser)
+        User.recount(User.id == self.testuser.id)
+        db.session.commit()
+        follower_id, testuser_id = follower.id, self.testuser.id
+
+        app.config["TIMELINE_FANOUT_MAX_FOLLOWERS"] = 0
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = testuser_id
+                c.post("/messages/new", data={"text": "Posted while merged"})
+        finally:
+            app.config["TIMELINE_FANOUT_MAX_FOLLOWERS"] = 10000
+
+        # the author is under the limit again, but stays merged until timelines are rebuilt
+        self.assertTrue(User.query.get(testuser_id).merged_at_read)
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+            self.assertIn("Posted while merged", c.get("/").text)
+
+        rebuild_timelines()
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertFalse(User.query.get(testuser_id).merged_at_read)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=follower_id).count(), 1)
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+            self.assertIn("Posted while merged", c.get("/").text)
+
+    def test_delete_message_from_timelines(self):
+        """Is a deleted message removed from the timelines it was pushed to?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Short-lived"})
+            msg = Message.query.one()
+            c.post(f"/messages/{msg.id}/delete")
+
+            self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_search_messages(self):
+        """Are posted messages found by their words, best match first, a page at a time?"""
+
+        # clear out entries left by messages the other tests deleted directly
+        rebuild()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Birds are singing"})
+            c.post("/messages/new", data={"text": "Singing birds, singing birds!"})
+            c.post("/messages/new", data={"text": "Nothing to see here"})
+
+            per_page = app.config["MESSAGES_PER_PAGE"]
+            app.config["MESSAGES_PER_PAGE"] = 1
+            try:
+                resp = c.get("/messages/search?q=bird+sing")
+                self.assertIn("Singing birds, singing birds!", resp.text)
+                self.assertNotIn("Birds are singing", resp.text)
+                self.assertIn("more-results", resp.text)
+
+                cursor = resp.text.split("after=")[1].split('"')[0]
+                resp = c.get(f"/messages/search?q=bird+sing&after={cursor}")
+                self.assertIn("Birds are singing", resp.text)
+                self.assertNotIn("more-results", resp.text)
+            finally:
+                app.config["MESSAGES_PER_PAGE"] = per_page
+
+            self.assertIn("no warbles found", c.get("/messages/search?q=AND+(").text)
+            self.assertEqual(c.get("/messages/search?q=x&after=bad").status_code, 400)
+
+    def test_delete_message_from_search(self):
+        """Is a deleted message no longer found by search?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Soon forgotten"})
+            msg_id = Message.query.one().id
+            self.assertIn("Soon forgotten", c.get("/messages/search?q=forgotten").text)
+
+            c.post(f"/messages/{msg_id}/delete")
+            resp = c.get("/messages/search?q=forgotten")
+            self.assertNotIn("Soon forgotten", resp.text)
+
     def tearDown(self):
         """Clear testing data from User and Message tables."""
 
         User.query.delete()
         Message.query.delete()
         db.session.commit()
+
+        # SQLite reuses the ids of deleted rows, so drop the deleted objects from the
+        # session rather than letting the next test's rows collide with them
+        db.session.expunge_all()
@@ -0,0 +1,99 @@
+"""Connection pool tests."""
+
+# run these tests with:
+# python3 -m unittest app.tests.test_pool
+
+
+from os import path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from app import db, init_app
+from app.pool import TimedQueuePool, engine_options, pool_status
+
+# Environment variables are handled in config.py and .env, no need to set here
+app = init_app("test.env")
+
+# Context is pushed so that it exists to create the tables
+app.app_context().push()
+
+# Create our tables, dropping first to ensure they are newly created
+db.drop_all()
+db.create_all()
+
+
+class PoolTestCase(TestCase):
+    """Test configuring and monitoring the connection pool."""
+
+    def postgres_config(self, **settings):
+        """Get the app's config as if it were connecting to PostgreSQL."""
+
+        return {
+            **app.config,
+            "SQLALCHEMY_DATABASE_URI": "postgresql://warbler@localhost/warbler",
+            **settings,
+        }
+
+    def test_engine_options(self):
+        """Are the pool settings turned into engine options for PostgreSQL only?"""
+
+        options = engine_options(
+            self.postgres_config(
+                DB_POOL_SIZE=3, DB_MAX_OVERFLOW=2, DB_STATEMENT_TIMEOUT_MS=5000
+            )
+        )
+        self.assertIs(options["poolclass"], TimedQueuePool)
+        self.assertEqual(options["pool_size"], 3)
+        self.assertEqual(options["max_overflow"], 2)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(
+            options["connect_args"], {"options": "-c statement_timeout=5000"}
+        )
+
+        self.assertEqual(engine_options(app.config), {})
+
+    def test_pgbouncer_options(self):
+        """Is the statement timeout left out of the startup options behind PgBouncer?"""
+
+        options = engine_options(
+            self.postgres_config(DB_PGBOUNCER=True, DB_STATEMENT_TIMEOUT_MS=5000)
+        )
+        self.assertNotIn("connect_args", options)
+
+    def test_checkout_stats(self):
+        """Are checkouts, their waits and timeouts recorded?"""
+
+        with TemporaryDirectory() as directory:
+            engine = create_engine(
+                f"sqlite:///{path.join(directory, 'pool.db')}",
+                poolclass=TimedQueuePool,
+                pool_size=1,
+                max_overflow=0,
+                pool_timeout=0.05,
+                connect_args={"check_same_thread": False},
+            )
+            connection = engine.connect()
+            with self.assertRaises(PoolTimeout):
+                engine.connect()
+
+            status = pool_status(engine.pool)
+            self.assertEqual(status["size"], 1)
+            self.assertEqual(status["checked_out"], 1)
+            self.assertEqual(status["overflow"], 0)
+            self.assertEqual(status["checkouts"], 2)
+            self.assertEqual(status["timeouts"], 1)
+            self.assertGreaterEqual(status["max_wait_ms"], 50)
+
+            connection.close()
+            engine.dispose()
+
+    def test_pool_stats_route(self):
+        """Is the pool status only shown to requests with the stats token?"""
+
+        client = app.test_client()
+        self.assertEqual(client.get("/pool-stats").status_code, 403)
+
+        resp = client.get("/pool-stats", headers={"Authorization": "Bearer test-token"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("pool", resp.json)
@@ -0,0 +1,140 @@
+"""Read replica routing tests."""
+
+# run these tests with:
+# python3 -m unittest app.tests.test_replica
+
+
+from os import path
+from tempfile import gettempdir
+from unittest import TestCase
+from app import db, init_app
+from app.models import Message, User
+from app.replica import PINNED_UNTIL_KEY, REPLICA_BIND
+from app.user.user_util import CURR_USER_KEY
+
+# Environment variables are handled in config.py and .env, no need to set here
+app = init_app("test.env")
+
+# A second SQLite file stands in for the replica; unlike a real one, nothing is
+# copied to it, so each test can tell which database served a page
+REPLICA_PATH = path.join(gettempdir(), "warbler_test_replica.db")
+app.config["SQLALCHEMY_BINDS"] = {REPLICA_BIND: f"sqlite:///{REPLICA_PATH}"}
+
+# Context is pushed so that it exists to create the tables
+app.app_context().push()
+
+# Create our tables in both databases, dropping first to ensure they are newly created
+db.drop_all()
+db.create_all()
+replica = db.get_engine(app, bind=REPLICA_BIND)
+db.Model.metadata.drop_all(replica)
+db.Model.metadata.create_all(replica)
+
+
+class ReplicaTestCase(TestCase):
+    """Test which database the queries of each request go to."""
+
+    def setUp(self):
+        """Create test client, add a user to both databases."""
+
+        self.client = app.test_client()
+
+        self.testuser = self.add_user(1, "testuser", replicated=True)
+
+    def add_user(self, user_id, name, primary=True, replicated=False):
+        """Add a user to the primary, the replica, or both, returning their id."""
+
+        row = {
+            "id": user_id,
+            "email": f"{name}@test.com",
+            "username": name,
+            "password": "HASHED_PASSWORD",
+        }
+        if primary:
+            db.session.add(User(**row))
+            db.session.commit()
+        if replicated or not primary:
+            with replica.begin() as conn:
+                conn.execute(User.__table__.insert(), row)
+
+        return row["id"]
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser
+
+    def test_reads_from_replica(self):
+        """Do marked GET views read from the replica?"""
+
+        replica_only = self.add_user(2, "replicauser", primary=False)
+        self.add_user(3, "primaryuser")
+        db.session.expunge_all()
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/users")
+            self.assertIn("@replicauser", resp.text)
+            self.assertNotIn("@primaryuser", resp.text)
+
+            self.assertEqual(c.get(f"/users/{replica_only}").status_code, 200)
+
+    def test_other_views_read_from_primary(self):
+        """Do unmarked views keep reading from the primary?"""
+
+        replica_only = self.add_user(2, "replicauser", primary=False)
+        db.session.expunge_all()
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f"/users/{replica_only}/following")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_write_pins_to_primary(self):
+        """Does a browser read its own writes from the primary for a while?"""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.post("/messages/new", data={"text": "Fresh warble"})
+            self.assertEqual(resp.status_code, 302)
+            with c.session_transaction() as sess:
+                self.assertIn(PINNED_UNTIL_KEY, sess)
+
+            msg_id = Message.query.one().id
+            db.session.expunge_all()
+
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Fresh warble", resp.text)
+
+            # once the pin expires, the replica (which never got it) is read again
+            with c.session_transaction() as sess:
+                sess[PINNED_UNTIL_KEY] = 0
+            self.assertEqual(c.get(f"/messages/{msg_id}").status_code, 404)
+
+    def test_reads_do_not_pin(self):
+        """Are browsers that only read left reading from the replica?"""
+
+        with self.client as c:
+            self.login(c)
+
+            c.get("/users").get_data()
+            with c.session_transaction() as sess:
+                self.assertNotIn(PINNED_UNTIL_KEY, sess)
+
+    def tearDown(self):
+        """Clear testing data from both databases."""
+
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        with replica.begin() as conn:
+            conn.execute(Message.__table__.delete())
+            conn.execute(User.__table__.delete())
+
+        # SQLite reuses the ids of deleted rows, so drop the deleted objects from the
+        # session rather than letting the next test's rows collide with them
+        db.session.expunge_all()
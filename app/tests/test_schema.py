@@ -0,0 +1,88 @@
+"""Schema migration tests."""
+
+# run these tests with:
+# python3 -m unittest app.tests.test_schema
+
+
+from unittest import TestCase
+from sqlalchemy import inspect
+from app import db, init_app
+from app.fulltext import backfill_search_vectors
+from app.schema import MIGRATIONS, pending_migrations, schema_versions, stamp, upgrade
+
+# Environment variables are handled in config.py and .env, no need to set here
+app = init_app("test.env")
+
+# Context is pushed so that it exists to create the tables
+app.app_context().push()
+
+# Create our tables, dropping first to ensure they are newly created
+db.drop_all()
+db.create_all()
+
+
+class SchemaTestCase(TestCase):
+    """Test applying schema migrations."""
+
+    def setUp(self):
+        """Start from a database with no migrations recorded."""
+
+        with db.engine.begin() as connection:
+            connection.execute(schema_versions.delete())
+
+    def test_upgrade(self):
+        """Are pending migrations applied and recorded?"""
+
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("DROP INDEX ix_likes_user_message")
+
+        applied = upgrade()
+
+        self.assertEqual(len(applied), len(MIGRATIONS))
+        self.assertEqual(pending_migrations(), [])
+        index_names = [
+            index["name"] for index in inspect(db.engine).get_indexes("likes")
+        ]
+        self.assertIn("ix_likes_user_message", index_names)
+
+    def test_upgrade_is_idempotent(self):
+        """Does a second upgrade apply nothing?"""
+
+        upgrade()
+        self.assertEqual(upgrade(), [])
+
+    def test_stamp(self):
+        """Does stamping mark every migration as applied without running them?"""
+
+        stamp()
+        self.assertEqual(pending_migrations(), [])
+
+    def test_backfill_search_vectors(self):
+        """Are existing messages' search vectors filled a range of ids at a time?"""
+
+        class RecordingConnection:
+            """Stands in for a PostgreSQL connection, whose highest message id is 25."""
+
+            def __init__(self):
+                self.ranges = []
+
+            def execute(self, statement, params=None):
+                if params is None:
+                    return FakeResult(25)
+                self.ranges.append((params["start"], params["end"]))
+
+        class FakeResult:
+            def __init__(self, value):
+                self.value = value
+
+            def scalar(self):
+                return self.value
+
+        connection = RecordingConnection()
+        backfill_search_vectors(connection, batch_size=10)
+        self.assertEqual(connection.ranges, [(0, 10), (10, 20), (20, 30)])
+
+    def tearDown(self):
+        """Leave every migration recorded as applied."""
+
+        stamp()
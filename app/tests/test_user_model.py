@@ -5,7 +5,8 @@
 
 
 from unittest import TestCase
-from app import db, init_app
+from app import db, hasher, init_app
+from app.hashing import HashingBusy, calibrate_rounds, hash_password, hash_rounds
 from app.models import Message, User, Follows
 
 # Environment variables are handled in config.py and .env, no need to set here
@@ -41,6 +42,24 @@ class UserModelTestCase(TestCase):
         self.assertEqual(len(u.messages), 0)
         self.assertEqual(len(u.followers), 0)
 
+    def test_following_ids_among(self):
+        """Are the followed users among a batch of ids found in one lookup?"""
+
+        user = User(email="a@test.com", username="a", password="HASHED_PASSWORD")
+        followed = User(email="b@test.com", username="b", password="HASHED_PASSWORD")
+        other = User(email="c@test.com", username="c", password="HASHED_PASSWORD")
+        db.session.add_all([user, followed, other])
+        user.following.append(followed)
+        db.session.commit()
+
+        self.assertEqual(
+            user.following_ids_among([followed.id, other.id]), {followed.id}
+        )
+        self.assertEqual(user.following_ids_among([]), set())
+        self.assertTrue(user.is_following(followed))
+        self.assertFalse(user.is_following(other))
+        self.assertTrue(followed.is_followed_by(user))
+
     def test_login_success(self):
         """Does User authentication work with correct login info?"""
         user = User.signup("testuser", "test@test.com", "testuser", None)
@@ -55,6 +74,73 @@ class UserModelTestCase(TestCase):
         login = User.authenticate("testuser", "wrong password")
         self.assertFalse(login)
 
+    def test_rehash_on_login(self):
+        """Is a password hashed with an outdated cost rehashed when its user logs in?"""
+
+        app.config["BCRYPT_LOG_ROUNDS"] = 5
+        try:
+            with app.app_context():
+                user = User.signup("testuser", "test@test.com", "testuser", None)
+                user.password = hash_password("testuser", 4, "2b")
+                db.session.commit()
+
+                login = User.authenticate("testuser", "testuser")
+                self.assertEqual(hash_rounds(login.password), 5)
+                self.assertTrue(User.authenticate("testuser", "testuser"))
+        finally:
+            app.config["BCRYPT_LOG_ROUNDS"] = 4
+
+    def test_stronger_hash_kept(self):
+        """Is a password hashed with a higher cost than configured left as it is?"""
+
+        with app.app_context():
+            user = User.signup("testuser", "test@test.com", "testuser", None)
+            user.password = stronger = hash_password("testuser", 5, "2b")
+            db.session.commit()
+
+            login = User.authenticate("testuser", "testuser")
+            self.assertEqual(login.password, stronger)
+
+    def test_calibrate_rounds(self):
+        """Does calibration keep to the cost floor when the target can't be met?"""
+
+        self.assertEqual(calibrate_rounds(0, min_rounds=6), 6)
+        self.assertGreaterEqual(calibrate_rounds(50), 4)
+
+    def test_benchmark_command(self):
+        """Does the benchmark command report a hashing rate?"""
+
+        result = app.test_cli_runner().invoke(
+            args=["bcrypt", "benchmark", "--rounds", "4", "--seconds", "0.1"]
+        )
+        self.assertIn("hashes/s per core", result.output)
+
+    def test_pooled_hashing(self):
+        """Are passwords hashed and checked correctly by the worker pool?"""
+
+        app.config["HASHING_WORKERS"] = 1
+        try:
+            with app.app_context():
+                pw_hash = hasher.generate_password_hash("testuser")
+                self.assertTrue(hasher.check_password_hash(pw_hash, "testuser"))
+                self.assertFalse(hasher.check_password_hash(pw_hash, "wrong password"))
+        finally:
+            app.config["HASHING_WORKERS"] = 0
+            hasher.shutdown()
+
+    def test_hashing_backpressure(self):
+        """Is a hash refused outright once the pool has no room for it?"""
+
+        app.config["HASHING_WORKERS"] = 1
+        app.config["HASHING_MAX_PENDING"] = 0
+        try:
+            with app.app_context(), self.assertRaises(HashingBusy):
+                User.signup("testuser", "test@test.com", "testuser", None)
+        finally:
+            app.config["HASHING_WORKERS"] = 0
+            app.config["HASHING_MAX_PENDING"] = 8
+            hasher.shutdown()
+
     def tearDown(self):
         """Clear testing data from User, Message, Follows tables."""
 
@@ -63,3 +149,7 @@ class UserModelTestCase(TestCase):
         Message.query.delete()
         Follows.query.delete()
         db.session.commit()
+
+        # SQLite reuses the ids of deleted rows, so drop the deleted objects from the
+        # session rather than letting the next test's rows collide with them
+        db.session.expunge_all()
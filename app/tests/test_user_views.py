@@ -4,10 +4,16 @@
 # python3 -m unittest app.tests.test_user_views
 
 
+from threading import Thread
 from unittest import TestCase
-from app import db, init_app
-from app.models import Message, User, Follows
-from app.user.user_util import CURR_USER_KEY
+from app import db, hasher, init_app
+from app.models import Follows, Likes, Message, TimelineEntry, User
+from app.hashing import hash_password
+from app.instrumentation import QueryBudgetExceeded
+from app.search import user_index
+from app.timeline import rebuild_timelines
+from app.user.user_util import CURR_USER_KEY, add_user_to_g, identity_cache
+from flask import g
 
 # Environment variables are handled in config.py and .env, no need to set here
 app = init_app("test.env")
@@ -27,6 +33,8 @@ class UserViewsTestCase(TestCase):
         """Create test client."""
 
         self.client = app.test_client()
+        # the username indexes are per worker, so they'd still hold the last test's users
+        user_index.clear()
         self.testuser = User.signup(
             username="testuser",
             email="test@test.com",
@@ -91,6 +99,54 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(empty_login_resp.status_code, 200)
             self.assertIn("This field is required", empty_login_resp.text)
 
+    def test_login_busy(self):
+        """Does login fail fast with a 503 when password hashing is saturated?"""
+
+        app.config["HASHING_WORKERS"] = 1
+        app.config["HASHING_MAX_PENDING"] = 0
+        try:
+            with self.client as c:
+                resp = c.post(
+                    "/login", data={"username": "testuser", "password": "testuser"}
+                )
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn("Warbler is busy", resp.text)
+        finally:
+            app.config["HASHING_WORKERS"] = 0
+            app.config["HASHING_MAX_PENDING"] = 8
+            hasher.shutdown()
+
+    def test_login_busy_concurrent(self):
+        """Are logins refused with a 503 while the pool is busy with other requests' hashes?"""
+
+        # a slow enough stored hash that every login overlaps the first one's check
+        self.testuser.password = hash_password("testuser", 12, "2b")
+        db.session.commit()
+        db.session.expunge_all()
+
+        def log_in(statuses):
+            resp = app.test_client().post(
+                "/login", data={"username": "testuser", "password": "testuser"}
+            )
+            statuses.append(resp.status_code)
+
+        app.config["HASHING_WORKERS"] = 1
+        app.config["HASHING_MAX_PENDING"] = 1
+        statuses = []
+        try:
+            threads = [Thread(target=log_in, args=(statuses,)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            app.config["HASHING_WORKERS"] = 0
+            app.config["HASHING_MAX_PENDING"] = 8
+            hasher.shutdown()
+
+        self.assertIn(302, statuses)
+        self.assertIn(503, statuses)
+
     def test_invalid_signup(self):
         """Does User creation fail successfully if improper credentials are given?"""
 
@@ -146,6 +202,179 @@ class UserViewsTestCase(TestCase):
             self.assertIn("Followers", resp.text)
             self.assertIn("Likes", resp.text)
 
+    def test_view_profile_not_modified(self):
+        """Is a profile revalidated by its ETag until the user posts?"""
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            resp = c.get(f"/users/{testuser_id}")
+            etag = resp.headers["ETag"]
+
+            cached = c.get(f"/users/{testuser_id}", headers={"If-None-Match": etag})
+            self.assertEqual(cached.status_code, 304)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post("/messages/new", data={"text": "Something new"})
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+
+            resp = c.get(f"/users/{testuser_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Something new", resp.text)
+
+    def test_view_follows_and_likes(self):
+        """Do the following, followers and likes pages list their users and messages?"""
+
+        other = self.add_user("other")
+        liked = self.add_msg("Liked warble", other.id)
+        other.following.append(self.testuser)
+        self.testuser.following.append(other)
+        self.testuser.likes.append(liked)
+        db.session.commit()
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/users/{testuser_id}/following")
+            self.assertIn("@other", resp.text)
+
+            resp = c.get(f"/users/{testuser_id}/followers")
+            self.assertIn("@other", resp.text)
+
+            resp = c.get(f"/users/{testuser_id}/likes")
+            self.assertIn("Liked warble", resp.text)
+
+    def test_view_others_likes(self):
+        """Can a user view someone else's likes within the page's query budget?"""
+
+        other = self.add_user("other")
+        liked = self.add_msg("Liked warble", self.testuser.id)
+        other.likes.append(liked)
+        db.session.commit()
+        testuser_id = self.testuser.id
+        other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            # nothing is left in the session for the request to find without a query
+            db.session.expunge_all()
+            resp = c.get(f"/users/{other_id}/likes")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Liked warble", resp.text)
+
+    def test_logout(self):
+        """Does logging out end the session?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/logout")
+            self.assertEqual(resp.status_code, 302)
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+    def test_server_timing(self):
+        """Are a request's SQL queries counted and timed in its Server-Timing header?"""
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser.id}")
+            timings = resp.headers.getlist("Server-Timing")
+
+            self.assertEqual(len(timings), 2)
+            self.assertRegex(timings[0], r'^db;dur=[\d.]+;desc="[1-9]\d* queries"$')
+            self.assertRegex(timings[1], r"^app;dur=[\d.]+$")
+
+    def test_query_budget(self):
+        """Does a request that runs more queries than its view's budget fail?"""
+
+        testuser_id = self.testuser.id
+
+        for endpoint, url in [
+            ("user.users_show", f"/users/{testuser_id}"),
+            ("user.list_users", "/users"),
+        ]:
+            view = app.view_functions[endpoint]
+            budget = view.query_budget
+            view.query_budget = 0
+            try:
+                with self.assertRaises(QueryBudgetExceeded):
+                    # a streamed page is only checked once it has been read
+                    self.client.get(url).get_data()
+            finally:
+                view.query_budget = budget
+
+    def test_feed_queries_constant(self):
+        """Do feeds render in the same number of queries however many authors they show?"""
+
+        testuser_id = self.testuser.id
+        urls = [
+            "/",
+            f"/users/{testuser_id}/likes",
+            f"/users/{testuser_id}/following",
+            "/messages/search?q=warble",
+        ]
+
+        def add_authors(names):
+            for name in names:
+                author = self.add_user(name)
+                msg = self.add_msg(f"Warble by {name}", author.id)
+                self.testuser.following.append(author)
+                self.testuser.likes.append(msg)
+            rebuild_timelines()
+            db.session.commit()
+
+        def query_counts():
+            counts = []
+            for url in urls:
+                # nothing is left in the session for the request to find without a query
+                db.session.expunge_all()
+                resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+                timing = resp.headers.getlist("Server-Timing")[0]
+                counts.append(int(timing.split('desc="')[1].split(" ")[0]))
+            return counts
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            add_authors(["author1"])
+            few = query_counts()
+            self.testuser = User.query.get(testuser_id)
+            add_authors(["author2", "author3", "author4", "author5"])
+            self.assertEqual(query_counts(), few)
+
+    def test_profile_pagination(self):
+        """Are a user's older messages reachable through the 'before' cursor?"""
+
+        for i in range(25):
+            self.add_msg(f"Message number {i}", self.testuser.id)
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            first_page = c.get(f"/users/{testuser_id}")
+            self.assertEqual(first_page.status_code, 200)
+            self.assertIn("Message number 24", first_page.text)
+            self.assertNotIn("Message number 4<", first_page.text)
+            self.assertIn("Older warbles", first_page.text)
+
+            cursor = first_page.text.split("before=")[1].split('"')[0]
+            second_page = c.get(f"/users/{testuser_id}?before={cursor}")
+            self.assertIn("Message number 4<", second_page.text)
+            self.assertIn("Message number 0<", second_page.text)
+            self.assertNotIn("Message number 5<", second_page.text)
+            self.assertNotIn("Older warbles", second_page.text)
+
+            invalid = c.get(f"/users/{testuser_id}?before=not-a-cursor")
+            self.assertEqual(invalid.status_code, 400)
+
     def test_edit_profile(self):
         """Can a user edit their profile page?"""
 
@@ -168,6 +397,39 @@ class UserViewsTestCase(TestCase):
             self.assertIn("About this user", resp.text)
             self.assertIn("Somewhere", resp.text)
 
+    def test_static_skips_user(self):
+        """Do requests for static files skip loading the current user?"""
+
+        with app.test_request_context("/static/stylesheets/style.css"):
+            add_user_to_g()
+            self.assertIsNone(g.user)
+
+    def test_cached_user_refreshed_on_edit(self):
+        """Is a cached user dropped from the identity cache when their profile changes?"""
+
+        app.config["USER_CACHE_TTL"] = 60
+        testuser_id = self.testuser.id
+        # users already in the session are used directly, rather than from the cache
+        db.session.expunge_all()
+        try:
+            with self.client as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = testuser_id
+
+                c.get("/")
+                self.assertIn(testuser_id, identity_cache)
+
+                resp = c.post(
+                    "/users/profile",
+                    data={"username": "renamed", "password": "testuser"},
+                    follow_redirects=True,
+                )
+                self.assertIn("@renamed", resp.text)
+                self.assertIn("@renamed", c.get("/").text)
+        finally:
+            app.config["USER_CACHE_TTL"] = 0
+            identity_cache.clear()
+
     def test_follow_others(self):
         """Can a user follow another?"""
 
@@ -210,6 +472,56 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertTrue(self.testuser.is_followed_by(follower_of_user))
 
+    def test_follow_self(self):
+        """Is a user kept from following themself, and does an old self-follow still let them post?"""
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.post(f"/users/follow/{testuser_id}", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("You can&#39;t follow yourself.", resp.text)
+            self.assertIsNone(Follows.query.get((testuser_id, testuser_id)))
+
+            # the baseline allowed self-follows, so some may still exist
+            db.session.add(
+                Follows(
+                    user_being_followed_id=testuser_id, user_following_id=testuser_id
+                )
+            )
+            db.session.commit()
+
+            resp = c.post("/messages/new", data={"text": "Still postable"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=testuser_id).count(), 1
+            )
+
+            rebuild_timelines()
+            db.session.commit()
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=testuser_id).count(), 1
+            )
+
+    def test_list_follow_buttons(self):
+        """Does the user list show Unfollow only for the users being followed?"""
+
+        followed = self.add_user("followed")
+        self.add_user("unfollowed")
+        self.testuser.following.append(followed)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/users")
+            self.assertEqual(resp.text.count(">Unfollow<"), 1)
+            self.assertEqual(resp.text.count(">Follow<"), 2)
+
     def test_not_following(self):
         """Do the User-following functions work correctly when the users are not followers?"""
 
@@ -237,6 +549,203 @@ class UserViewsTestCase(TestCase):
             self.assertFalse(self.testuser.is_followed_by(not_follower))
             self.assertFalse(self.testuser.is_following(not_follower))
 
+    def test_follow_updates_timeline(self):
+        """Are a user's messages added to and removed from a follower's timeline?"""
+
+        followed_user = self.add_user("followed")
+        self.add_msg("Backfilled text", followed_user.id)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/users/follow/{followed_user.id}")
+            resp = c.get("/")
+            self.assertIn("Backfilled text", resp.text)
+
+            c.post(f"/users/stop-following/{followed_user.id}")
+            resp = c.get("/")
+            self.assertNotIn("Backfilled text", resp.text)
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=self.testuser.id).count(), 0
+            )
+
+    def test_counters(self):
+        """Are a user's counts kept up to date by follows, messages and likes?"""
+
+        other = self.add_user("other")
+        msg = self.add_msg("Likeable", other.id)
+        other_id, msg_id, testuser_id = other.id, msg.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f"/users/follow/{other_id}")
+            c.post(f"/users/add_like/{msg_id}")
+            c.post("/messages/new", data={"text": "Counted"})
+
+            user = User.query.get(testuser_id)
+            db.session.refresh(user)
+            self.assertEqual(
+                (user.following_count, user.likes_count, user.messages_count),
+                (1, 1, 1),
+            )
+            self.assertEqual(User.query.get(other_id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{other_id}")
+            # only its author may delete the liked message
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            c.post(f"/messages/{msg_id}/delete")
+            db.session.expire_all()
+            user = User.query.get(testuser_id)
+            self.assertEqual((user.following_count, user.likes_count), (0, 0))
+            self.assertEqual(User.query.get(other_id).followers_count, 0)
+
+    def test_recount(self):
+        """Does recounting correct counts that have drifted?"""
+
+        other = self.add_user("other")
+        other.following.append(self.testuser)
+        self.add_msg("Uncounted", self.testuser.id)
+        testuser_id = self.testuser.id
+
+        User.recount(User.id == testuser_id)
+        db.session.commit()
+
+        user = User.query.get(testuser_id)
+        self.assertEqual((user.followers_count, user.messages_count), (1, 1))
+
+    def test_user_directory_pages(self):
+        """Is the user directory streamed a page at a time, in username order?"""
+
+        for name in ["alpha", "bravo", "charlie"]:
+            self.add_user(name)
+
+        per_page = app.config["USERS_PER_PAGE"]
+        app.config["USERS_PER_PAGE"] = 2
+        try:
+            with self.client as c:
+                resp = c.get("/users")
+                self.assertTrue(resp.is_streamed)
+                self.assertIn("@alpha", resp.text)
+                self.assertIn("@bravo", resp.text)
+                self.assertNotIn("@charlie", resp.text)
+                self.assertIn("/users?after=bravo", resp.text)
+
+                resp = c.get("/users?after=bravo")
+                self.assertIn("@charlie", resp.text)
+                self.assertIn("@testuser", resp.text)
+                self.assertNotIn("@bravo", resp.text)
+                self.assertNotIn("more-users", resp.text)
+        finally:
+            app.config["USERS_PER_PAGE"] = per_page
+
+    def test_user_directory_full_chunks(self):
+        """Is a page filling its last chunk exactly still ended with a cursor?"""
+
+        for name in ["alpha", "bravo", "charlie"]:
+            self.add_user(name)
+
+        per_page = app.config["USERS_PER_PAGE"]
+        chunk_size = app.config["STREAM_CHUNK_SIZE"]
+        app.config["USERS_PER_PAGE"] = 2
+        app.config["STREAM_CHUNK_SIZE"] = 1
+        try:
+            with self.client as c:
+                for url in ("/users", "/users?q=a"):
+                    resp = c.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn("@bravo", resp.text)
+                    self.assertNotIn("@charlie", resp.text)
+                    self.assertIn("after=bravo", resp.text)
+        finally:
+            app.config["USERS_PER_PAGE"] = per_page
+            app.config["STREAM_CHUNK_SIZE"] = chunk_size
+
+    def test_search_users(self):
+        """Does searching find usernames containing the text, ignoring case?"""
+
+        self.add_user("Warbling")
+        self.add_user("warbler2")
+        self.add_user("other")
+
+        with self.client as c:
+            resp = c.get("/users?q=WARBL")
+            self.assertIn("@Warbling", resp.text)
+            self.assertIn("@warbler2", resp.text)
+            self.assertNotIn("@other", resp.text)
+
+            resp = c.get("/users?q=arbler")
+            self.assertNotIn("@Warbling", resp.text)
+            self.assertIn("@warbler2", resp.text)
+
+            # wildcards are searched for literally
+            resp = c.get("/users?q=%25")
+            self.assertNotIn("@other", resp.text)
+
+    def test_suggest(self):
+        """Are usernames starting with a prefix suggested, most followed first?"""
+
+        popular = self.add_user("tester")
+        popular.followers.append(self.add_user("follower"))
+        db.session.commit()
+        User.recount(User.id == popular.id)
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users/suggest?q=TEST")
+            self.assertEqual(
+                [user["username"] for user in resp.json], ["tester", "testuser"]
+            )
+            self.assertEqual(
+                c.get("/users/suggest?q=test&limit=1").json[0]["id"], popular.id
+            )
+            self.assertEqual(c.get("/users/suggest?q=nobody").json, [])
+
+            # a limit under 1 still suggests the best match
+            self.assertEqual(
+                [user["id"] for user in c.get("/users/suggest?q=test&limit=-1").json],
+                [popular.id],
+            )
+
+    def test_suggest_after_rename(self):
+        """Is a renamed user suggested by their new username only?"""
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            self.assertEqual(len(c.get("/users/suggest?q=testuser").json), 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post(
+                "/users/profile", data={"username": "renamed", "password": "testuser"}
+            )
+
+            self.assertEqual(c.get("/users/suggest?q=testuser").json, [])
+            self.assertEqual(
+                c.get("/users/suggest?q=ren").json,
+                [{"id": testuser_id, "username": "renamed"}],
+            )
+
+    def test_suggest_rebuilt(self):
+        """Are old indexes kept in use while they're rebuilt in the background?"""
+
+        with self.client as c:
+            self.assertEqual(len(c.get("/users/suggest?q=test").json), 1)
+
+            # a user added by another worker, so not yet indexed by this one
+            self.add_user("tester")
+            user_index.built_at -= app.config["SEARCH_INDEX_MAX_AGE"]
+
+            self.assertEqual(len(c.get("/users/suggest?q=test").json), 1)
+            rebuild = user_index.rebuild_thread
+            if rebuild is not None:
+                rebuild.join()
+            self.assertEqual(len(c.get("/users/suggest?q=test").json), 2)
+
     def test_toggle_like(self):
         """Can a user successfully like or unlike a post?"""
 
@@ -254,11 +763,13 @@ class UserViewsTestCase(TestCase):
             resp_like = c.post(f"/users/add_like/{msg.id}")
             self.assertEqual(resp_like.status_code, 302)
             self.assertEqual(self.testuser.likes, [msg])
+            self.assertEqual(msg.like_count, 1)
 
             # after a post is liked, a repeat request should remove the like
             resp_unlike = c.post(f"/users/add_like/{msg.id}")
             self.assertEqual(resp_unlike.status_code, 302)
             self.assertEqual(self.testuser.likes, [])
+            self.assertEqual(msg.like_count, 0)
 
     def test_delete(self):
         """Can a user successfully delete their account?"""
@@ -277,6 +788,34 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, "/signup")
 
+    def test_delete_with_messages(self):
+        """Are a deleted user's messages, follows and likes deleted along with them?"""
+
+        testuser_id = self.testuser.id
+        other = self.add_user("other")
+        self.add_msg("Soon gone", testuser_id)
+        self.testuser.likes.append(self.add_msg("Liked", other.id))
+        self.testuser.following.append(other)
+        other.following.append(self.testuser)
+        db.session.commit()
+        other_id = other.id
+        db.session.expunge_all()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.post("/users/delete")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNone(User.query.get(testuser_id))
+            self.assertEqual([msg.text for msg in Message.query], ["Liked"])
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(Likes.query.count(), 0)
+
+            other = User.query.get(other_id)
+            self.assertEqual((other.followers_count, other.following_count), (0, 0))
+
     def tearDown(self):
         """Clear testing data from User, Message, Follows tables."""
 
@@ -285,3 +824,7 @@ class UserViewsTestCase(TestCase):
         Message.query.delete()
         Follows.query.delete()
         db.session.commit()
+
+        # SQLite reuses the ids of deleted rows, so drop the deleted objects from the
+        # session rather than letting the next test's rows collide with them
+        db.session.expunge_all()
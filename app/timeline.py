@@ -0,0 +1,248 @@
+"""Materialized home timelines for Warbler.
+
+Rather than gathering the messages of every followed user whenever the
+homepage is requested, a new message's id is pushed ("fanned out") to the
+timelines of its author's followers as it is posted. Reading a homepage is
+then a bounded lookup of the viewer's `timeline_entries` rows, plus a lookup of
+the merged users (below) that the viewer follows, which starts from the few
+merged users rather than from everyone the viewer follows.
+
+Users with more than TIMELINE_FANOUT_MAX_FOLLOWERS followers are not fanned
+out, since a single post would write an entry for every one of them. Their
+messages are instead merged into their followers' timelines at read time.
+
+Once a user passes the limit they're marked as merged (users.merged_at_read),
+and they stay merged if they drop back under it: the messages they posted in
+the meantime were never fanned out, so they'd vanish from their followers'
+timelines otherwise. rebuild_timelines() fans out every message of the users
+back under the limit, and unmarks them.
+"""
+
+from flask import current_app
+from sqlalchemy import insert, literal, select, true, update
+from app import db
+from app.models import Follows, Message, TimelineEntry, User
+from app.pagination import before_position, page_of, per_page
+
+TIMELINE_COLUMNS = ["user_id", "message_id", "author_id", "timestamp"]
+
+
+def fanout_limit():
+    """Get the most followers a user's messages are fanned out to."""
+
+    return current_app.config["TIMELINE_FANOUT_MAX_FOLLOWERS"]
+
+
+def is_merged_at_read(user_id):
+    """Are `user_id`'s messages merged into timelines at read time, rather than fanned out?
+
+    A user that has just passed the fan-out limit is marked as merged.
+    """
+
+    merged, follower_count = (
+        db.session.query(User.merged_at_read, User.followers_count)
+        .filter(User.id == user_id)
+        .one()
+    )
+    if not merged and follower_count > fanout_limit():
+        User.query.filter(User.id == user_id).update(
+            {User.merged_at_read: True}, synchronize_session=False
+        )
+        merged = True
+
+    return merged
+
+
+def push_message(msg):
+    """Add a newly posted message to its author's and followers' timelines.
+
+    The message must have been flushed, so that its id and timestamp are set.
+    """
+
+    db.session.execute(
+        insert(TimelineEntry).values(
+            user_id=msg.user_id,
+            message_id=msg.id,
+            author_id=msg.user_id,
+            timestamp=msg.timestamp,
+        )
+    )
+
+    if is_merged_at_read(msg.user_id):
+        return
+
+    followers = select(
+        Follows.user_following_id,
+        literal(msg.id),
+        literal(msg.user_id),
+        literal(msg.timestamp, db.DateTime),
+    ).where(
+        Follows.user_being_followed_id == msg.user_id,
+        # the author already has the message, even if an old self-follow remains
+        Follows.user_following_id != msg.user_id,
+    )
+    db.session.execute(insert(TimelineEntry).from_select(TIMELINE_COLUMNS, followers))
+
+
+def remove_message(msg):
+    """Remove a message from every timeline it was pushed to."""
+
+    TimelineEntry.query.filter(TimelineEntry.message_id == msg.id).delete(
+        synchronize_session=False
+    )
+
+
+def add_followed(follower_id, followed_id):
+    """Backfill a follower's timeline with the messages of a newly followed user."""
+
+    if is_merged_at_read(followed_id):
+        return
+
+    messages = select(
+        literal(follower_id),
+        Message.id,
+        Message.user_id,
+        Message.timestamp,
+    ).where(Message.user_id == followed_id)
+    db.session.execute(insert(TimelineEntry).from_select(TIMELINE_COLUMNS, messages))
+
+
+def remove_followed(follower_id, followed_id):
+    """Remove an unfollowed user's messages from a follower's timeline."""
+
+    TimelineEntry.query.filter(
+        TimelineEntry.user_id == follower_id,
+        TimelineEntry.author_id == followed_id,
+    ).delete(synchronize_session=False)
+
+
+def is_merged_author(user_id_column):
+    """Build a condition for whether the user in `user_id_column` is merged at read time."""
+
+    return (
+        select(User.merged_at_read).where(User.id == user_id_column).scalar_subquery()
+    )
+
+
+def mark_merged_authors(connection):
+    """Mark the users over the fan-out limit as merged, and unmark those back under it.
+
+    Used by rebuild_timelines, and as a migration step.
+    """
+
+    over_limit = User.followers_count > fanout_limit()
+    connection.execute(
+        update(User)
+        .where(User.merged_at_read != over_limit)
+        .values(merged_at_read=over_limit)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def merged_author_messages(user_id):
+    """Build a query of the messages of the merged users followed by `user_id`.
+
+    The merged users are read from the partial ix_users_merged_at_read index, and
+    each is checked against follows by its primary key, so the cost depends on
+    how many users are merged, not on how many users `user_id` follows. Each
+    followed one's newest messages are then read in order from
+    ix_messages_user_timestamp.
+    """
+
+    merged_ids = select(User.id).where(User.merged_at_read)
+    return (
+        Message.query.join(Follows, Follows.user_being_followed_id == Message.user_id)
+        .filter(Follows.user_following_id == user_id)
+        .filter(Follows.user_being_followed_id.in_(merged_ids))
+    )
+
+
+def home_timeline(user, before=None, page_size=None, options=(), columns=()):
+    """Get a page of the most recent messages for `user`'s homepage.
+
+    Messages from users that are merged at read time are combined with the
+    materialized entries; an id may appear in both if that user only recently
+    passed the fan-out limit, so the results are de-duplicated. Both queries
+    load their messages with the loader `options` (see app/eager.py), or with
+    `columns` fetch rows of just those columns (which must include Message.id
+    and Message.timestamp) rather than Message objects.
+    """
+
+    page_size = page_size or per_page()
+
+    def load(query):
+        return query.with_entities(*columns) if columns else query.options(*options)
+
+    query = (
+        load(Message.query)
+        .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+        .filter(TimelineEntry.user_id == user.id)
+    )
+    if before:
+        query = query.filter(
+            before_position(TimelineEntry.timestamp, TimelineEntry.message_id, before)
+        )
+    messages = (
+        query.order_by(TimelineEntry.timestamp.desc(), TimelineEntry.message_id.desc())
+        .limit(page_size + 1)
+        .all()
+    )
+
+    merged_query = load(merged_author_messages(user.id))
+    if before:
+        merged_query = merged_query.filter(
+            before_position(Message.timestamp, Message.id, before)
+        )
+    merged_messages = (
+        merged_query.order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(page_size + 1)
+        .all()
+    )
+    if not merged_messages:
+        return page_of(messages, page_size)
+
+    unique_messages = {msg.id: msg for msg in messages + merged_messages}.values()
+    newest_first = sorted(
+        unique_messages, key=lambda msg: (msg.timestamp, msg.id), reverse=True
+    )
+    return page_of(newest_first[: page_size + 1], page_size)
+
+
+def rebuild_timelines(user_ids=None):
+    """Rebuild materialized timelines from the follows and messages tables.
+
+    With `user_ids`, a (first_id, last_id) range, only the timelines of those
+    users are rebuilt, so a large rebuild can take a transaction per range. The
+    merged authors must then have been marked with mark_merged_authors first.
+    """
+
+    if user_ids is None:
+        mark_merged_authors(db.session)
+
+    def in_range(column):
+        return true() if user_ids is None else column.between(*user_ids)
+
+    TimelineEntry.query.filter(in_range(TimelineEntry.user_id)).delete(
+        synchronize_session=False
+    )
+
+    own_messages = select(
+        Message.user_id, Message.id, Message.user_id, Message.timestamp
+    ).where(in_range(Message.user_id))
+    db.session.execute(
+        insert(TimelineEntry).from_select(TIMELINE_COLUMNS, own_messages)
+    )
+
+    fanned_out = (
+        select(
+            Follows.user_following_id, Message.id, Message.user_id, Message.timestamp
+        )
+        .join(Message, Message.user_id == Follows.user_being_followed_id)
+        .where(
+            in_range(Follows.user_following_id),
+            ~is_merged_author(Follows.user_being_followed_id),
+            # own messages were already added above
+            Follows.user_following_id != Follows.user_being_followed_id,
+        )
+    )
+    db.session.execute(insert(TimelineEntry).from_select(TIMELINE_COLUMNS, fanned_out))
@@ -1,13 +1,44 @@
-from flask import render_template, redirect, flash, request, g, current_app
+import click
+from flask import (
+    render_template,
+    redirect,
+    flash,
+    request,
+    g,
+    current_app,
+    jsonify,
+    stream_template,
+)
+from sqlalchemy import select, union
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from .user_forms import UserAddForm, LoginForm, EditProfileForm
-from app.models import User, Message
-from .user_util import do_login, do_logout
+from app.models import User, Message, Likes, Follows
+from app.pagination import decode_cursor, paginate_messages, stream_users
+from .user_util import (
+    do_login,
+    do_logout,
+    following_ids,
+    forget_user,
+    liked_ids,
+    load_current_user,
+)
 from app import db
+from app.eager import MESSAGE_CARD, PROFILE_MESSAGE_CARD, USER_CARD
+from app.caching import page_etag, render_if_modified
+from app.instrumentation import query_budget
+from app.replica import use_replica
+from app.fulltext import unindex_messages
+from app.hashing import HashingBusy
+from app.search import index_user, search_users, suggest_users, unindex_user
+from app.timeline import add_followed, remove_followed
 from . import user_bp
 
+# Shown when the password hashing pool is full (see app/hashing.py)
+BUSY_MESSAGE = "Warbler is busy right now, please try again in a moment."
+
 
 @user_bp.route("/signup", methods=["GET", "POST"])
+@query_budget(3)
 def signup():
     """Handle user signup.
 
@@ -30,6 +61,11 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            index_user(user)
+
+        except HashingBusy:
+            flash(BUSY_MESSAGE, "danger")
+            return render_template("user/signup.html", form=form), 503
 
         except IntegrityError:
             db.session.rollback()
@@ -49,15 +85,22 @@ def signup():
 
 
 @user_bp.route("/login", methods=["GET", "POST"])
+@query_budget(3)
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data, form.password.data)
+        try:
+            user = User.authenticate(form.username.data, form.password.data)
+        except HashingBusy:
+            flash(BUSY_MESSAGE, "danger")
+            return render_template("user/login.html", form=form), 503
 
         if user:
+            # saves the password's new hash, if authenticate had to rehash it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -68,6 +111,7 @@ def login():
 
 
 @user_bp.route("/logout")
+@query_budget(0)
 def logout():
     """Handle logout of user."""
     do_logout()
@@ -75,40 +119,96 @@ def logout():
 
 
 @user_bp.route("/users")
+@query_budget(4)
+@use_replica
 def list_users():
     """Page with listing of users.
 
     Can take a 'q' param in querystring to search by that username.
+
+    Users are listed a page at a time in username order, starting after the
+    optional 'after' cursor. The page is streamed, so the first user cards are
+    sent while later ones are still being fetched.
     """
 
     search = request.args.get("q")
 
     if not search:
-        users = User.query.all()
+        query = User.query
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        query = search_users(search)
+
+    page = stream_users(query.options(*USER_CARD), request.args.get("after"))
+
+    def user_cards():
+        """Yield each user with whether they're followed, a chunk at a time."""
+
+        for users in page.chunks():
+            followed = following_ids(users)
+            for user in users:
+                yield user, user.id in followed
+
+    return stream_template("user/index.html", users=user_cards(), page=page)
+
+
+@user_bp.route("/users/suggest")
+@query_budget(1)
+def suggest():
+    """Suggest users whose username starts with the 'q' param, as JSON.
 
-    return render_template("user/index.html", users=users)
+    Matches are ranked with the most followed users first; an optional 'limit'
+    param caps how many are returned.
+    """
+
+    prefix = request.args.get("q", "")
+    limit = request.args.get("limit", type=int)
+    if not prefix:
+        return jsonify([])
+
+    return jsonify(
+        [
+            {"id": user_id, "username": username}
+            for user_id, username in suggest_users(prefix, limit)
+        ]
+    )
 
 
 @user_bp.route("/users/<int:user_id>")
+@query_budget(6)
+@use_replica
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile, or a 304 if the browser has its current version.
 
-    user = User.query.get_or_404(user_id)
+    The user's updated_at covers their messages too, since it's bumped when they
+    post, delete or have a message liked.
+    """
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (
-        Message.query.filter(Message.user_id == user_id)
-        .order_by(Message.timestamp.desc())
-        .limit(100)
-        .all()
-    )
-    return render_template("user/show.html", user=user, messages=messages)
+    stamp = db.session.query(User.updated_at).filter(User.id == user_id).first_or_404()
+    before = decode_cursor(request.args.get("before"))
+
+    def render():
+        user = User.query.get_or_404(user_id)
+
+        # snagging messages in order from the database;
+        # user.messages won't be in order by default
+        messages = Message.query.options(*PROFILE_MESSAGE_CARD).filter(
+            Message.user_id == user_id
+        )
+        page = paginate_messages(messages, before)
+        return render_template(
+            "user/show.html",
+            user=user,
+            messages=page.items,
+            next_cursor=page.next_cursor,
+            likes=liked_ids(page.items),
+        )
+
+    # each page of messages is its own URL, so it has its own ETag
+    return render_if_modified(page_etag("user", user_id, *stamp), render)
 
 
 @user_bp.route("/users/<int:user_id>/following")
+@query_budget(5)
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -117,10 +217,17 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template("user/following.html", user=user)
+    users = User.query.with_parent(user, User.following).options(*USER_CARD).all()
+    return render_template(
+        "user/following.html",
+        user=user,
+        users=users,
+        following_ids=following_ids(users),
+    )
 
 
 @user_bp.route("/users/<int:user_id>/followers")
+@query_budget(5)
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -129,10 +236,17 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template("user/followers.html", user=user)
+    users = User.query.with_parent(user, User.followers).options(*USER_CARD).all()
+    return render_template(
+        "user/followers.html",
+        user=user,
+        users=users,
+        following_ids=following_ids(users),
+    )
 
 
 @user_bp.route("/users/follow/<int:follow_id>", methods=["POST"])
+@query_budget(9)
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -140,14 +254,26 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}")
+
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    db.session.add(
+        Follows(user_being_followed_id=followed_user.id, user_following_id=g.user.id)
+    )
+    User.update_counts(g.user.id, following_count=1)
+    User.update_counts(followed_user.id, followers_count=1)
+    db.session.flush()
+    add_followed(g.user.id, followed_user.id)
     db.session.commit()
+    forget_user(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @user_bp.route("/users/stop-following/<int:follow_id>", methods=["POST"])
+@query_budget(7)
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -155,14 +281,20 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    follow = Follows.query.get((follow_id, g.user.id))
+    if follow:
+        db.session.delete(follow)
+        User.update_counts(g.user.id, following_count=-1)
+        User.update_counts(follow_id, followers_count=-1)
+        remove_followed(g.user.id, follow_id)
+        db.session.commit()
+        forget_user(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @user_bp.route("/users/profile", methods=["GET", "POST"])
+@query_budget(4)
 def profile():
     """Update profile for current user."""
 
@@ -172,7 +304,12 @@ def profile():
 
     form = EditProfileForm()
     if form.validate_on_submit():
-        user = User.authenticate(g.user.username, form.password.data)
+        try:
+            user = User.authenticate(g.user.username, form.password.data)
+        except HashingBusy:
+            flash(BUSY_MESSAGE, "danger")
+            return render_template("user/edit.html", form=form), 503
+
         if user:
             for field, value in form.data.items():
                 valid_field = field != "csrf_token" and field != "password"
@@ -181,6 +318,8 @@ def profile():
                     setattr(user, field, value)
             try:
                 db.session.commit()
+                forget_user(user.id)
+                index_user(user)
                 g.user = user
                 return redirect(f"/users/{user.id}")
             except SQLAlchemyError as e:
@@ -192,6 +331,7 @@ def profile():
 
 
 @user_bp.route("/users/delete", methods=["POST"])
+@query_budget(8)
 def delete_user():
     """Delete user."""
 
@@ -199,15 +339,52 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    # g.user is a lazy proxy, but the session needs the user object itself
+    user = load_current_user()
     do_logout()
 
-    db.session.delete(g.user)
+    # the counts of everyone this user followed, was followed by, or had their messages
+    # liked by will change once the user's rows are removed, so they're recounted
+    affected_ids = (
+        db.session.execute(
+            union(
+                select(Follows.user_being_followed_id).where(
+                    Follows.user_following_id == user.id
+                ),
+                select(Follows.user_following_id).where(
+                    Follows.user_being_followed_id == user.id
+                ),
+                select(Likes.user_id)
+                .join(Message, Message.id == Likes.message_id)
+                .where(Message.user_id == user.id),
+            )
+        )
+        .scalars()
+        .all()
+    )
+
+    liked_message_ids = (
+        db.session.execute(select(Likes.message_id).where(Likes.user_id == user.id))
+        .scalars()
+        .all()
+    )
+
+    forget_user(user.id)
+    unindex_user(user.id)
+    unindex_messages(Message.user_id == user.id)
+    db.session.delete(user)
+    db.session.flush()
+    User.recount(User.id.in_(affected_ids))
+    Message.recount_likes(Message.id.in_(liked_message_ids))
+    # their authors' profiles show the changed like counts
+    User.touch(select(Message.user_id).where(Message.id.in_(liked_message_ids)))
     db.session.commit()
 
     return redirect("/signup")
 
 
 @user_bp.route("/users/add_like/<int:msg_id>", methods=["POST"])
+@query_budget(8)
 def add_like(msg_id):
     """Toggle a like from the current user to a message."""
 
@@ -217,11 +394,19 @@ def add_like(msg_id):
 
     msg = Message.query.get_or_404(msg_id)
     if msg.user_id != g.user.id:
-        if msg in g.user.likes:
-            g.user.likes.remove(msg)
+        like = Likes.query.filter_by(user_id=g.user.id, message_id=msg.id).first()
+        if like:
+            db.session.delete(like)
+            User.update_counts(g.user.id, likes_count=-1)
+            Message.update_like_counts(msg.id, -1)
+            User.touch(msg.user_id)
         else:
-            g.user.likes.append(msg)
+            db.session.add(Likes(user_id=g.user.id, message_id=msg.id))
+            User.update_counts(g.user.id, likes_count=1)
+            Message.update_like_counts(msg.id, 1)
+            User.touch(msg.user_id)
         db.session.commit()
+        forget_user(g.user.id)
     else:
         flash("You cannot like your own messages.", "danger")
 
@@ -230,10 +415,36 @@ def add_like(msg_id):
 
 
 @user_bp.route("/users/<int:user_id>/likes", methods=["GET"])
+@query_budget(5)
+@use_replica
 def show_likes(user_id):
     """Display the messages that a user has liked."""
 
     user = User.query.get_or_404(user_id)
-    messages = user.likes
+    before = decode_cursor(request.args.get("before"))
+
+    liked_messages = (
+        Message.query.options(*MESSAGE_CARD)
+        .join(Likes, Likes.message_id == Message.id)
+        .filter(Likes.user_id == user_id)
+    )
+    page = paginate_messages(liked_messages, before)
+
+    return render_template(
+        "user/likes.html",
+        user=user,
+        messages=page.items,
+        next_cursor=page.next_cursor,
+        likes=liked_ids(page.items),
+    )
+
 
-    return render_template("user/likes.html", user=user, messages=messages)
+@user_bp.cli.command("recount")
+@click.option("--chunk-size", default=1000, help="Users to recount per transaction.")
+def recount_command(chunk_size):
+    """Recompute every user's message, follower, following and like counts."""
+
+    for first_id, last_id in User.id_ranges(chunk_size):
+        User.recount(User.id.between(first_id, last_id))
+        db.session.commit()
+        click.echo(f"Recounted users up to #{last_id}")
@@ -1,20 +1,137 @@
-from flask import session, g
+from threading import Lock
+from time import monotonic
+from flask import session, g, request, current_app
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from werkzeug.local import LocalProxy
 from . import user_bp
+from app import db
 from app.models import User
 
 CURR_USER_KEY = "curr_user"
 
+# Per-worker cache of recently loaded users, as {user_id: (expiry, detached user)}.
+# Only used when USER_CACHE_TTL is set; a user's entry is dropped when their profile
+# or counts change in this worker, and otherwise expires after the TTL.
+identity_cache = {}
+# Held while the cache is pruned, so threads serving requests at once don't both
+# remove the same entries
+identity_cache_lock = Lock()
+
+
 # changed from before_request to ensure it occurs even for other blueprints
 @user_bp.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    The user is not queried until g.user is first used, so requests that never
+    touch it (ie redirects after a POST) cost no lookup. Static files and assets
+    skip the session entirely.
+    """
 
-    else:
+    # g can outlive a request when an app context is pushed around several (ie in tests)
+    g.pop("current_user", None)
+    g.pop("following_cache", None)
+
+    if request.endpoint in ("static", "assets") or CURR_USER_KEY not in session:
         g.user = None
 
+    else:
+        g.user = LocalProxy(load_current_user)
+
+
+def load_current_user():
+    """Get the logged-in user, loading them on first use in this request."""
+
+    if "current_user" not in g:
+        g.current_user = get_user(session.get(CURR_USER_KEY))
+
+    return g.current_user
+
+
+def following_ids(users):
+    """Get the ids of `users` that the logged-in user follows.
+
+    Follow status for a whole page of users is resolved with one query, rather
+    than a query per user card, and cached for the rest of the request so later
+    lookups for the same users are free.
+    """
+
+    if not g.user:
+        return set()
+
+    cache = g.setdefault("following_cache", {})
+    missing = [user.id for user in users if user.id not in cache]
+    if missing:
+        followed = g.user.following_ids_among(missing)
+        cache.update({user_id: user_id in followed for user_id in missing})
+
+    return {user.id for user in users if cache[user.id]}
+
+
+def liked_ids(messages):
+    """Get the ids of `messages` that the logged-in user has liked, with one query.
+
+    Only the messages being shown are checked, rather than loading every message
+    the user has ever liked.
+    """
+
+    if not g.user:
+        return set()
+
+    return g.user.liked_ids_among([message.id for message in messages])
+
+
+def get_user(user_id):
+    """Get a user by id, using the identity cache when it is enabled."""
+
+    ttl = current_app.config["USER_CACHE_TTL"]
+    if not ttl or user_id is None:
+        return User.query.get(user_id)
+
+    # a user the route has already loaded is more current than the cached snapshot
+    in_session = db.session.identity_map.get(identity_key(User, user_id))
+    if in_session is not None:
+        return in_session
+
+    cached = identity_cache.get(user_id)
+    if cached and cached[0] > monotonic():
+        # merge without load attaches a copy of the cached user to this session, without a query
+        return db.session.merge(cached[1], load=False)
+
+    user = User.query.get(user_id)
+    if user:
+        cache_user(user, ttl)
+
+    return user
+
+
+def cache_user(user, ttl):
+    """Add a detached snapshot of `user`'s columns to the identity cache."""
+
+    snapshot = User(
+        **{attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+    )
+    make_transient_to_detached(snapshot)
+
+    with identity_cache_lock:
+        if len(identity_cache) >= current_app.config["USER_CACHE_SIZE"]:
+            now = monotonic()
+            for user_id, (expiry, _) in list(identity_cache.items()):
+                if expiry <= now:
+                    identity_cache.pop(user_id, None)
+            if len(identity_cache) >= current_app.config["USER_CACHE_SIZE"]:
+                identity_cache.pop(next(iter(identity_cache), None), None)
+
+        identity_cache[user.id] = (monotonic() + ttl, snapshot)
+
+
+def forget_user(user_id):
+    """Drop a user from the identity cache, ie after their profile or counts change."""
+
+    identity_cache.pop(user_id, None)
+
 
 def do_login(user):
     """Log in user."""
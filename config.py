@@ -1,5 +1,5 @@
 """Classes for Flask configurations."""
-from os import environ
+from os import environ, path
 
 
 class Config:
@@ -9,7 +9,86 @@ class Config:
     SQLALCHEMY_DATABASE_URI = environ.get("DATABASE_URL", "").replace(
         "postgres://", "postgresql://", 1
     )  # replace because heroku uses 'postgres' - not supported by SQLAlchemy
+    # PostgreSQL connections each worker keeps open, and may open beyond that under
+    # load; every worker's pool must fit within max_connections (see app/pool.py)
+    DB_POOL_SIZE = int(environ.get("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW = int(environ.get("DB_MAX_OVERFLOW", 5))
+    # Seconds to wait for a free connection, and after which connections are replaced
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_RECYCLE = 1800
+    # Ping each connection before it's used, replacing any the server has dropped
+    DB_POOL_PRE_PING = True
+    # Set when connecting through PgBouncer in transaction pooling mode
+    DB_PGBOUNCER = environ.get("DB_PGBOUNCER", "") == "1"
+    # Milliseconds any one statement may run before PostgreSQL cancels it (0 for no limit)
+    DB_STATEMENT_TIMEOUT_MS = int(environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+    # A read replica, which some GET pages read from (see app/replica.py), and the
+    # seconds a browser reads only from the primary after writing
+    SQLALCHEMY_BINDS = (
+        {
+            "replica": environ["REPLICA_DATABASE_URL"].replace(
+                "postgres://", "postgresql://", 1
+            )
+        }
+        if environ.get("REPLICA_DATABASE_URL")
+        else None
+    )
+    REPLICA_PIN_SECONDS = 10
+    # Bearer token allowing access to GET /pool-stats; the route is off without one
+    POOL_STATS_TOKEN = environ.get("POOL_STATS_TOKEN")
     SECRET_KEY = environ.get("SECRET_KEY")
+    # Users with more followers than this have their messages merged into
+    # timelines when read, rather than pushed to every follower when posted
+    TIMELINE_FANOUT_MAX_FOLLOWERS = 10000
+    # Number of messages shown per page of the home, profile and likes feeds
+    MESSAGES_PER_PAGE = 20
+    # Number of users per page of the user directory, and the rows fetched at a
+    # time while a page is streamed
+    USERS_PER_PAGE = 100
+    STREAM_CHUNK_SIZE = 25
+    # Server-Sent Events of new messages (see app/events.py): how they reach the
+    # streams of other workers ('local' for none, or 'postgres'), seconds between
+    # keepalives, seconds before a stream ends for the browser to reconnect, and
+    # the most message ids waiting to be sent on one stream
+    EVENTS_BACKEND = environ.get("EVENTS_BACKEND", "local")
+    EVENTS_HEARTBEAT_SECONDS = 15
+    EVENTS_STREAM_SECONDS = 300
+    EVENTS_QUEUE_SIZE = 100
+    # Seconds a worker may reuse a logged-in user without querying them again (0 disables)
+    USER_CACHE_TTL = 0
+    # Most users held in each worker's identity cache
+    USER_CACHE_SIZE = 10000
+    # bcrypt cost and hash prefix for new password hashes; pin the cost found by
+    # 'flask bcrypt calibrate' for the deployment's hardware in the environment
+    BCRYPT_LOG_ROUNDS = int(environ.get("BCRYPT_LOG_ROUNDS", 12))
+    BCRYPT_HASH_PREFIX = "2b"
+    # Milliseconds 'flask bcrypt calibrate' aims for a hash to take (250 if unset),
+    # choosing a cost no lower than BCRYPT_MIN_ROUNDS
+    BCRYPT_TARGET_MS = None
+    BCRYPT_MIN_ROUNDS = 10
+    # Worker processes hashing passwords (0 hashes in the request thread), the most
+    # hashes that may be queued before new ones are refused, and seconds to wait for
+    # one; the pool only helps web workers serving many requests at once, ie gevent
+    # ones (see app/hashing.py), so sync workers hash inline by default
+    HASHING_WORKERS = int(
+        environ.get("HASHING_WORKERS", 2 if environ.get("GUNICORN_ASYNC") == "1" else 0)
+    )
+    HASHING_MAX_PENDING = 8
+    HASHING_TIMEOUT = 5
+    # Most usernames suggested for a prefix, and seconds before a worker rebuilds
+    # its in-memory username indexes to pick up other workers' changes
+    SUGGEST_LIMIT = 10
+    SEARCH_INDEX_MAX_AGE = 300
+    # Count and time each request's SQL queries, reporting them in a Server-Timing
+    # header and the log (see app/instrumentation.py)
+    SQL_TIMING = False
+    # What to do when a view runs more queries than its @query_budget: None, 'warn'
+    # or 'raise'; only checked with SQL_TIMING on
+    QUERY_BUDGET_ACTION = None
+    # Where fingerprinted copies of the static files are built (see app/assets.py),
+    # and whether to rebuild them on every start rather than only when missing
+    ASSETS_DIR = path.join(path.dirname(path.abspath(__file__)), "build", "assets")
+    ASSETS_REBUILD = False
 
 
 class DevConfig(Config):
@@ -17,6 +96,9 @@ class DevConfig(Config):
 
     SQLALCHEMY_ECHO = True
     DEBUG = True
+    SQL_TIMING = True
+    QUERY_BUDGET_ACTION = "warn"
+    ASSETS_REBUILD = True
 
 
 class ProdConfig(Config):
@@ -24,6 +106,9 @@ class ProdConfig(Config):
 
     SQLALCHEMY_ECHO = False
     DEBUG = False
+    DB_STATEMENT_TIMEOUT_MS = int(environ.get("DB_STATEMENT_TIMEOUT_MS", 30000))
+    USER_CACHE_TTL = 5
+    BCRYPT_TARGET_MS = 250
 
 
 class TestConfig(Config):
@@ -34,3 +119,10 @@ class TestConfig(Config):
     TESTING = True
     # Per Springboard, don't have WTForms use CSRF at all, since it's difficult to test
     WTF_CSRF_ENABLED = False
+    SQL_TIMING = True
+    QUERY_BUDGET_ACTION = "raise"
+    POOL_STATS_TOKEN = "test-token"
+    ASSETS_REBUILD = True
+    HASHING_WORKERS = 0
+    # The lowest cost bcrypt allows, to keep the tests fast
+    BCRYPT_LOG_ROUNDS = 4
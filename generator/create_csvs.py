@@ -3,75 +3,150 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Generation is offline and deterministic: the same --seed always writes the
+same files. Rows are sampled with NumPy and written a chunk at a time, so
+millions of rows can be generated quickly. Follower counts follow a power law
+(a few 'celebrity' users with huge followings, most with few), as do the number
+of messages each user posts, and posting times cluster in bursts. Load the
+results with seed.py.
+
+Requires NumPy (pip install numpy). Run from the project folder, ie:
+python3 generator/create_csvs.py --users 100000 --messages 10000000 --follows 5000000
 """
 
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+from argparse import ArgumentParser
+from os import path
+import numpy as np
+from helpers import (
+    CITIES,
+    IMAGE_URLS,
+    WORDS,
+    burst_centers,
+    bursty_timestamps,
+    chunks,
+    power_law_weights,
+    random_text,
+    sample_follows,
+    sample_ids,
+)
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
-FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
-
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
-
-fake = Faker()
-
-# Generate random profile image URLs to use for users
-
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
+USERS_CSV_HEADERS = [
+    "email",
+    "username",
+    "image_url",
+    "password",
+    "bio",
+    "header_image_url",
+    "location",
 ]
-
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
-
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+MESSAGES_CSV_HEADERS = ["text", "timestamp", "user_id"]
+FOLLOWS_CSV_HEADERS = ["user_being_followed_id", "user_following_id"]
+
+# bcrypt hash of 'password', so every generated user can log in with it
+PASSWORD_HASH = "$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe"
+HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
+
+parser = ArgumentParser(description="Generate CSVs of random data for Warbler.")
+parser.add_argument("--users", type=int, default=300)
+parser.add_argument("--messages", type=int, default=1000)
+parser.add_argument("--follows", type=int, default=5000)
+parser.add_argument("--seed", type=int, default=0, help="Same seed, same CSVs")
+parser.add_argument("--out-dir", default="generator")
+parser.add_argument(
+    "--chunk-size", type=int, default=100000, help="Rows sampled at a time"
+)
+parser.add_argument(
+    "--follower-exponent",
+    type=float,
+    default=1.0,
+    help="Power-law exponent of follower counts (0 for uniform)",
+)
+parser.add_argument(
+    "--posting-exponent",
+    type=float,
+    default=0.8,
+    help="Power-law exponent of messages per user (0 for uniform)",
+)
+parser.add_argument(
+    "--burstiness",
+    type=float,
+    default=0.5,
+    help="Fraction of messages posted in bursts",
+)
+parser.add_argument(
+    "--bursts", type=int, default=200, help="Number of bursts of posting"
+)
+parser.add_argument(
+    "--burst-minutes",
+    type=float,
+    default=30,
+    help="Mean delay of a post after its burst starts",
+)
+parser.add_argument("--start", default="2021-01-01", help="Earliest message date")
+parser.add_argument("--end", default="2023-01-01", help="Latest message date")
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+start = np.datetime64(args.start, "us")
+end = np.datetime64(args.end, "us")
+
+with open(path.join(args.out_dir, "users.csv"), "w", newline="") as users_csv:
+    users_writer = csv.writer(users_csv)
+    users_writer.writerow(USERS_CSV_HEADERS)
+
+    for first, size in chunks(args.users, args.chunk_size):
+        # usernames are a word plus the user's id, so they're always unique
+        names = rng.integers(0, len(WORDS), size)
+        images = rng.integers(0, len(IMAGE_URLS), size)
+        cities = rng.integers(0, len(CITIES), size)
+        bios = random_text(rng, size, 4, 12, MAX_WARBLER_LENGTH)
+        users_writer.writerows(
+            (
+                f"{WORDS[name]}{user_id}@example.com",
+                f"{WORDS[name]}{user_id}",
+                IMAGE_URLS[image],
+                PASSWORD_HASH,
+                bio,
+                HEADER_IMAGE_URL,
+                CITIES[city],
+            )
+            for user_id, name, image, city, bio in zip(
+                range(first + 1, first + size + 1), names, images, cities, bios
+            )
+        )
+
+with open(path.join(args.out_dir, "messages.csv"), "w", newline="") as messages_csv:
+    messages_writer = csv.writer(messages_csv)
+    messages_writer.writerow(MESSAGES_CSV_HEADERS)
+
+    authors = power_law_weights(rng, args.users, args.posting_exponent)
+    centers = burst_centers(rng, start, end, args.bursts)
+
+    for _, size in chunks(args.messages, args.chunk_size):
+        texts = random_text(rng, size, 3, 25, MAX_WARBLER_LENGTH)
+        timestamps = np.datetime_as_string(
+            bursty_timestamps(
+                rng, size, start, end, centers, args.burstiness, args.burst_minutes
+            )
+        )
+        user_ids = sample_ids(rng, authors, size)
+        messages_writer.writerows(zip(texts, timestamps, user_ids.tolist()))
+
+with open(path.join(args.out_dir, "follows.csv"), "w", newline="") as follows_csv:
+    follows_writer = csv.writer(follows_csv)
+    follows_writer.writerow(FOLLOWS_CSV_HEADERS)
+
+    followed, followers = sample_follows(
+        rng, args.users, args.follows, args.follower_exponent, args.chunk_size
+    )
+    for first, size in chunks(args.follows, args.chunk_size):
+        follows_writer.writerows(
+            zip(
+                followed[first : first + size].tolist(),
+                followers[first : first + size].tolist(),
+            )
+        )
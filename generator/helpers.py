@@ -1,14 +1,179 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything is sampled with NumPy from a seeded Generator, a chunk of rows at a
+time, so the same seed always produces the same CSVs and no more than a chunk
+of rows is held in memory (apart from the follow pairs, see sample_follows).
+"""
 
+import numpy as np
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+# Words used for bios and messages; any text will do, as long as it's offline
+WORDS = (
+    "about above across after again air all almost along also always among and "
+    "another answer any appear area around ask away back base be bird become "
+    "before began begin behind being below best better between big black blue "
+    "boat body book both bring build but call came can car care carry cause "
+    "center change city class close cold color come common could country course "
+    "cover cross cut dark day deep did different do does done door down draw "
+    "dry during each early earth east eat end enough even ever every eye face "
+    "fact fall family far farm fast feel feet few field fill final find fine "
+    "fire first fish five fly follow food for form found four free friend from "
+    "full game gave get girl give go gold good got great green ground group "
+    "grow had half hand happen hard has have he head hear heard heat help her "
+    "here high him his hold home horse hot hour house how idea if in inch into "
+    "island it just keep kind king knew know land large last late laugh lay "
+    "lead learn leave left less let letter life light like line list listen "
+    "little live long look lost low made main make man many map mark may me "
+    "mean measure men might mile mind miss money moon more morning most mother "
+    "mountain move much music must my name near need never new next night no "
+    "north not note nothing notice now number of off often oh old on once one "
+    "only open or order other our out over own page paper part pass people "
+    "picture piece place plain plan plant play point port pose power press "
+    "problem produce pull put question quick rain ran reach read ready real "
+    "record red rest right river road rock room round rule run said same saw "
+    "say school science sea second see seem sentence set several shape she "
+    "ship short should show side simple since sing size sky slow small snow so "
+    "some song soon sound south space special spell stand star start state "
+    "stay step still stood stop story street strong study such sun sure surface "
+    "table tail take talk teach tell ten test than that the their them then "
+    "there these they thing think this those though thought three through time "
+    "to together told too took top toward town travel tree true try turn two "
+    "under unit until up upon us use usual very voice vowel wait walk want warm "
+    "was watch water wave way we week weight well went were west what wheel "
+    "when where which while white who whole why will wind with wonder wood word "
+    "work world would write year yes yet you young your"
+).split()
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+CITIES = [
+    "Springfield",
+    "Riverside",
+    "Fairview",
+    "Franklin",
+    "Greenville",
+    "Bristol",
+    "Clinton",
+    "Georgetown",
+    "Salem",
+    "Madison",
+    "Oakland",
+    "Ashland",
+    "Burlington",
+    "Manchester",
+    "Milton",
+    "Newport",
+    "Oxford",
+    "Arlington",
+]
 
-    return datetime.fromtimestamp(random_timestamp)
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+
+def chunks(total, chunk_size):
+    """Yield (start, size) for consecutive chunks covering `total` rows."""
+
+    for start in range(0, total, chunk_size):
+        yield start, min(chunk_size, total - start)
+
+
+def power_law_weights(rng, count, exponent):
+    """Get Zipf-like weights for `count` ids: the k-th most popular has weight k^-exponent.
+
+    The popularity ranks are shuffled, so the most popular ids are spread
+    throughout rather than being the lowest ones. An exponent of 0 weights
+    every id the same.
+    """
+
+    ranks = rng.permutation(count) + 1
+    weights = ranks.astype(np.float64) ** -exponent
+    return weights / weights.sum()
+
+
+def sample_ids(rng, weights, size):
+    """Sample `size` 1-based ids with the given weights, by inverting their CDF."""
+
+    cdf = np.cumsum(weights)
+    ids = np.searchsorted(cdf, rng.random(size) * cdf[-1], side="right")
+    return np.minimum(ids, len(weights) - 1) + 1
+
+
+def sample_follows(rng, num_users, num_follows, exponent, chunk_size):
+    """Sample distinct (followed, follower) pairs, with power-law follower counts.
+
+    Followed users are drawn with power_law_weights and followers uniformly;
+    self-follows and repeated pairs are dropped and more are drawn until there
+    are enough. Pairs are kept encoded as single int64s, so memory grows with
+    the number of follows rather than with every possible pair of users.
+    """
+
+    weights = power_law_weights(rng, num_users, exponent)
+    pairs = np.empty(0, dtype=np.int64)
+
+    while len(pairs) < num_follows:
+        size = min(chunk_size, 2 * (num_follows - len(pairs)))
+        followed = sample_ids(rng, weights, size)
+        follower = rng.integers(1, num_users + 1, size)
+        distinct = followed != follower
+        drawn = followed[distinct] * (num_users + 1) + follower[distinct]
+
+        found = len(pairs)
+        pairs = np.unique(np.concatenate([pairs, drawn]))
+        if len(pairs) == found:
+            raise ValueError(
+                f"Could not draw {num_follows} distinct follows among {num_users} users; "
+                "try fewer follows or a lower exponent"
+            )
+
+    # keep a random subset rather than the lowest pairs, which np.unique sorted first
+    pairs = (
+        rng.choice(pairs, num_follows, replace=False)
+        if len(pairs) > num_follows
+        else pairs
+    )
+    pairs.sort()
+    return pairs // (num_users + 1), pairs % (num_users + 1)
+
+
+def burst_centers(rng, start, end, bursts):
+    """Pick `bursts` random moments between `start` and `end` for posts to cluster around."""
+
+    return start + rng.integers(0, (end - start).astype(np.int64), bursts).astype(
+        "timedelta64[us]"
+    )
+
+
+def bursty_timestamps(rng, size, start, end, centers, burstiness, burst_minutes):
+    """Sample `size` posting times between `start` and `end` (numpy datetime64[us]).
+
+    A `burstiness` fraction of posts fall in bursts: each follows one of the
+    burst `centers` by an exponentially distributed delay, with a mean of
+    `burst_minutes`. The rest are spread uniformly over the whole period.
+    """
+
+    span = (end - start).astype(np.int64)
+    times = start + rng.integers(0, span, size).astype("timedelta64[us]")
+
+    in_burst = rng.random(size) < burstiness
+    burst_count = int(in_burst.sum())
+    if burst_count and len(centers):
+        delays = rng.exponential(burst_minutes * 60e6, burst_count).astype(np.int64)
+        burst_times = centers[
+            rng.integers(0, len(centers), burst_count)
+        ] + delays.astype("timedelta64[us]")
+        times[in_burst] = np.minimum(burst_times, end)
+
+    return times
+
+
+def random_text(rng, size, min_words, max_words, max_length):
+    """Get `size` strings of random words, each at most `max_length` characters."""
+
+    lengths = rng.integers(min_words, max_words + 1, size)
+    words = rng.integers(0, len(WORDS), (size, max_words))
+    return [
+        " ".join(WORDS[word] for word in row[:length]).capitalize()[:max_length]
+        for row, length in zip(words, lengths)
+    ]
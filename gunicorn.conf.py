@@ -0,0 +1,26 @@
+"""Gunicorn settings, read by 'gunicorn wsgi:app' (see Procfile).
+
+Each sync worker handles one request at a time, so every open event stream
+(GET /messages/stream, see app/events.py) would hold a whole worker. With
+GUNICORN_ASYNC=1, workers run gevent instead: each request is a greenlet, and
+waiting on a stream, a query or a socket yields to the others, so each worker
+can hold up to WORKER_CONNECTIONS connections, nearly all of them idle streams.
+psycopg2 is made to wait cooperatively too, so a slow query doesn't block its
+worker.
+
+Use EVENTS_BACKEND=postgres with more than one worker, so every stream hears of
+every new message.
+"""
+
+from os import environ
+
+if environ.get("GUNICORN_ASYNC") == "1":
+    worker_class = "gevent"
+    worker_connections = int(environ.get("WORKER_CONNECTIONS", 1000))
+
+    def post_fork(server, worker):
+        """Make psycopg2 yield to other greenlets while it waits on the database."""
+
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
@@ -0,0 +1,68 @@
+"""Load test Warbler's routes with concurrent simulated users."""
+# run with: python3 loadtest.py [--users 10] [--duration 30] [--json results.json]
+# against a database seeded by seed.py
+
+import json
+from argparse import ArgumentParser
+from app import init_app
+from app.loadtest import DEFAULT_MIX, format_report, run
+
+
+def parse_mix(text):
+    """Parse an action mix written as 'home=60,like=20,post=10,follow=10'."""
+
+    mix = {}
+    for part in text.split(","):
+        action, weight = part.split("=")
+        if action not in DEFAULT_MIX:
+            raise ValueError(f"Unknown action {action!r}")
+        mix[action] = float(weight)
+
+    return mix
+
+
+parser = ArgumentParser(description=__doc__)
+parser.add_argument("--users", type=int, default=10, help="Concurrent simulated users")
+parser.add_argument("--duration", type=float, default=30, help="Seconds to run for")
+parser.add_argument(
+    "--requests", type=int, help="Stop each user after this many actions instead"
+)
+parser.add_argument(
+    "--mix",
+    type=parse_mix,
+    default=DEFAULT_MIX,
+    help="Action weights, ie 'home=60,like=20,post=10,follow=10'",
+)
+parser.add_argument(
+    "--password", default="password", help="Password shared by the seeded users"
+)
+parser.add_argument("--seed", type=int, default=0, help="Seed for each user's choices")
+parser.add_argument("--json", help="Write the results to this file as JSON")
+parser.add_argument(
+    "--baseline", help="Compare with the JSON results of an earlier run"
+)
+args = parser.parse_args()
+
+app = init_app()
+report = run(
+    app,
+    users=args.users,
+    duration=args.duration,
+    max_requests=args.requests,
+    mix=args.mix,
+    password=args.password,
+    seed=args.seed,
+)
+
+baseline = None
+if args.baseline:
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+
+print(format_report(report, baseline))
+if report["failed_logins"]:
+    print(f"{report['failed_logins']} users could not log in; check --password")
+
+if args.json:
+    with open(args.json, "w") as file:
+        json.dump(report, file, indent=2)
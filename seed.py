@@ -1,23 +1,29 @@
 """Seed database with sample data from CSV Files."""
-# run with: python3 seed.py
+# run with: python3 seed.py [--parallel] [--chunk-size N] [--data-dir generator]
 
-from csv import DictReader
-from app import db, init_app
-from app.models import User, Message, Follows
+from argparse import ArgumentParser
+from app import init_app
+from app.loader import LOAD_CHUNK_SIZE, load
 
-app = init_app()
-app.app_context().push()
-
-db.drop_all()
-db.create_all()
-
-with open("generator/users.csv") as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+parser = ArgumentParser(description=__doc__)
+parser.add_argument(
+    "--data-dir",
+    default="generator",
+    help="Folder holding users.csv, messages.csv and follows.csv",
+)
+parser.add_argument(
+    "--parallel",
+    action="store_true",
+    help="Load independent tables at once (PostgreSQL only)",
+)
+parser.add_argument(
+    "--chunk-size",
+    type=int,
+    default=LOAD_CHUNK_SIZE,
+    help="Rows per insert when COPY isn't available (ie SQLite)",
+)
+args = parser.parse_args()
 
-with open("generator/messages.csv") as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open("generator/follows.csv") as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+app = init_app()
+with app.app_context():
+    load(args.data_dir, parallel=args.parallel, chunk_size=args.chunk_size)